@@ -0,0 +1,98 @@
+# coding=utf8
+import os
+import json
+import logging
+import threading
+from helper.database_helper import oracle_connection, script_log_values, SCRIPT_RUN_LOG_SQL
+
+
+class AuditLog(object):
+    '''
+    一次运行的SCRIPT_RUN_LOG记录: record只放入内存, flush用一次executemany写入数据库,
+    由AuditLogExtension定时和在spider_closed时调用
+    数据库不可用时记录追加到本地spool文件(每行一条json), 下次flush时先重放
+    同一连接和spool文件在进程内只有一个实例, 多个爬虫共用
+    conn为None时(AUDIT_TO_DATABASE = False)只写入spool文件
+    '''
+    _logs = {}
+    _lock = threading.Lock()
+
+    def __init__(self, conn, spool_path):
+        self.conn = conn
+        self.spool_path = spool_path
+        self.records = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, conn, spool_path):
+        with cls._lock:
+            key = (conn, spool_path)
+            if key not in cls._logs:
+                cls._logs[key] = cls(conn, spool_path)
+            return cls._logs[key]
+
+    @classmethod
+    def from_settings(cls, settings):
+        path = settings.get('AUDIT_SPOOL_FILE') or os.path.join(settings.get('TEMP_DATA_DIR'), 'audit_spool.jsonl')
+        conn = settings.get('DATABASE_URI') if settings.getbool('AUDIT_TO_DATABASE', True) else None
+        return cls.get(conn, path)
+
+    def record(self, script_name, data_table_name, start_time, result, action, remark):
+        '''
+        参数同insert_log_table, 结束时间为调用时间
+        '''
+        values = script_log_values(script_name, data_table_name, start_time, result, action, remark)
+        with self.lock:
+            self.records.append(values)
+
+    def read_spool(self):
+        if not os.path.exists(self.spool_path):
+            return []
+        records = []
+        with open(self.spool_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logging.warning('ignore broken audit spool line: %s' % line.strip())
+        return records
+
+    def write_spool(self, records):
+        parent = os.path.dirname(self.spool_path)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent)
+        tmp_path = self.spool_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for values in records:
+                f.write(json.dumps(values, ensure_ascii=False) + '\n')
+        os.replace(tmp_path, self.spool_path)
+
+    def flush(self):
+        '''
+        写入内存中的记录和spool文件中的旧记录, 失败时全部存入spool文件
+        :return: 写入数据库的条数
+        '''
+        with self.flush_lock:
+            with self.lock:
+                records, self.records = self.records, []
+            spooled = self.read_spool()
+            if not records and not spooled:
+                return 0
+            if self.conn is None:
+                self.write_spool(spooled + records)
+                return 0
+            try:
+                with oracle_connection(self.conn) as connection:
+                    cur = connection.cursor()
+                    cur.executemany(SCRIPT_RUN_LOG_SQL, spooled + records)
+                    connection.commit()
+            except Exception as e:
+                logging.error('audit log to %s: %s' % (self.spool_path, e))
+                self.write_spool(spooled + records)
+                return 0
+            if spooled:
+                os.remove(self.spool_path)
+                logging.info('replayed %s spooled audit records' % len(spooled))
+            logging.info('%s 条日志插入数据库' % (len(spooled) + len(records)))
+            return len(spooled) + len(records)
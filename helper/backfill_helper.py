@@ -0,0 +1,117 @@
+# coding=utf8
+import os
+import re
+import json
+import time
+import logging
+import threading
+import pandas as pd
+from helper.batch_helper import concat_frames
+
+
+def parse_years(value):
+    '''
+    解析backfill爬虫参数
+    :param value: 'all', '2015', '2010-2015'或'2010,2012'
+    :return: 年份集合, 'all'时为None
+    '''
+    value = str(value).strip().lower()
+    if value in ('', '1', 'true', 'all'):
+        return None
+    years = set()
+    for part in value.split(','):
+        m = re.match(r'^(\d{4})(?:-(\d{4}))?$', part.strip())
+        if not m:
+            raise ValueError('invalid backfill years: %s' % value)
+        first, last = int(m.group(1)), int(m.group(2) or m.group(1))
+        years.update(str(year) for year in range(first, last + 1))
+    return years
+
+
+class BackfillCheckpoint(object):
+    '''
+    回填进度, 按(类别, 年份)记录, 存为TEMP_DATA_DIR/backfill/<spider>/checkpoint.json
+    parsed: 表格已解析, DataFrame暂存为同目录下的pickle, 等待按目标表一次合入
+    merged: 已合入, 再次回填时不再抓取
+    同一文件在进程内只有一个实例
+    '''
+    _checkpoints = {}
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.dir = os.path.dirname(path)
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    @classmethod
+    def get(cls, path):
+        with cls._lock:
+            if path not in cls._checkpoints:
+                cls._checkpoints[path] = cls(path)
+            return cls._checkpoints[path]
+
+    @classmethod
+    def from_settings(cls, settings, spider_name):
+        return cls.get(os.path.join(settings.get('TEMP_DATA_DIR'), 'backfill', spider_name, 'checkpoint.json'))
+
+    @staticmethod
+    def key(category, year):
+        return '%s|%s' % (category, year)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except ValueError:
+            logging.warning('ignore broken backfill checkpoint: %s' % self.path)
+
+    def state(self, category, year):
+        with self.lock:
+            return self.entries.get(self.key(category, year), {}).get('state')
+
+    def spool(self, category, year, table, df):
+        '''
+        暂存已解析的表格并记为parsed
+        :param df: 以主键为索引的DataFrame
+        '''
+        frame = os.path.join(self.dir, '%s_%s.pkl' % (category, year))
+        with self.lock:
+            if not os.path.exists(self.dir):
+                os.makedirs(self.dir)
+        df.to_pickle(frame)
+        self._set(self.key(category, year), {'state': 'parsed', 'table': table, 'frame': frame})
+
+    def parsed(self):
+        '''
+        :return: {table: [(key, frame path)]}, 包括上次中断时已暂存的表格
+        '''
+        tables = {}
+        with self.lock:
+            for key, entry in sorted(self.entries.items()):
+                if entry.get('state') == 'parsed':
+                    tables.setdefault(entry['table'], []).append((key, entry['frame']))
+        return tables
+
+    def load_table(self, frames):
+        '''
+        读入一个目标表暂存的全部年份, 同一主键保留较晚暂存的行
+        '''
+        return concat_frames([pd.read_pickle(frame) for key, frame in frames])
+
+    def mark_merged(self, frames):
+        for key, frame in frames:
+            self._set(key, {'state': 'merged', 'table': self.entries[key]['table']})
+            if os.path.exists(frame):
+                os.remove(frame)
+
+    def _set(self, key, entry):
+        with self.lock:
+            self.entries[key] = dict(entry, updated=time.strftime('%Y-%m-%d %H:%M:%S'))
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,46 @@
+# coding=utf8
+import threading
+import pandas as pd
+
+
+def concat_frames(frames):
+    '''
+    拼接同一目标表的多个DataFrame, 主键(索引)相同的行保留最后一个
+    :param frames: 以主键为索引的DataFrame列表, 按先后顺序
+    '''
+    df = pd.concat(frames) if len(frames) > 1 else frames[0]
+    return df[~df.index.duplicated(keep='last')]
+
+
+class TableBatches(object):
+    '''
+    一次运行中按目标表收集的DataFrame和抓取状态, 爬虫关闭时每个表合入一次
+    由pipeline的多个线程写入
+    '''
+
+    def __init__(self):
+        self.frames = {}
+        self.fetch_states = {}
+        self.lock = threading.Lock()
+
+    def add(self, table, df, url=None, fetch_state=None):
+        '''
+        :param df: 以主键为索引的DataFrame
+        :param url: 表格页面url, 合入成功后保存fetch_state
+        '''
+        with self.lock:
+            self.frames.setdefault(table, []).append(df)
+            states = self.fetch_states.setdefault(table, [])
+            if url and fetch_state:
+                states.append((url, fetch_state))
+
+    def tables(self):
+        with self.lock:
+            return sorted(self.frames)
+
+    def pop(self, table):
+        '''
+        :return: (frames, [(url, fetch_state)]), 没有该表时frames为空列表
+        '''
+        with self.lock:
+            return self.frames.pop(table, []), self.fetch_states.pop(table, [])
@@ -2,190 +2,607 @@
 import os
 import logging
 import datetime
-import cx_Oracle
+import time
+import threading
+import sqlite3
+from collections import namedtuple
+from functools import lru_cache
+from contextlib import contextmanager
+try:
+    import cx_Oracle
+except ImportError:
+    # the sqlite, mysql and parquet paths work without the Oracle client, get_pool raises
+    cx_Oracle = None
 os.environ["NLS_LANG"] = ".UTF8"
+import numpy as np
 import pandas as pd
+from pandas.api.types import is_datetime64_any_dtype, is_numeric_dtype, is_integer_dtype, is_float_dtype, is_bool_dtype
 from scrapy.utils.project import get_project_settings
 
+# process-wide session pools, keyed by 'user/pwd@ip:port/db'
+_pools = {}
+_pools_lock = threading.Lock()
 
-def merge_db_oracle(datas, table, meta, conn, insert=False, istimestamp=False):
+# rows per executemany of the batched timestamp path
+BATCH_SIZE = 10000
+# rows per direct-path insert and commit of bulk_load_oracle
+BULK_BATCH_SIZE = 50000
+
+# table metadata cache, keyed by (conn, TABLE), entries expire after TABLE_META_TTL seconds
+TABLE_META_TTL = 3600
+_table_meta = {}
+_table_meta_lock = threading.Lock()
+
+TableMeta = namedtuple('TableMeta', ['columns', 'types', 'nullable', 'created'])
+
+# process-wide sqlite connections, keyed by database path, each with a lock and the tables known to exist
+_sqlite_connections = {}
+_sqlite_lock = threading.Lock()
+SqliteConnection = namedtuple('SqliteConnection', ['connection', 'lock', 'tables'])
+SQLITE_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-65536',
+    'PRAGMA temp_store=MEMORY',
+]
+
+
+class RowsRejectedError(Exception):
     '''
-    update or insert
-    :param datas: a list of dict
-    :param table: tablename
-    :param meta: like {'col1': 'key', 'col2': 'key', 'col3': None, 'col4': None]
+    rows rejected by the batched timestamp path (batcherrors)
+    committed: the other rows were written, rejected was within max_rejected; else the load was rolled back
+    '''
+    def __init__(self, table, count, rejected, committed):
+        self.table = table
+        self.count = count
+        self.rejected = rejected
+        self.committed = committed
+        super(RowsRejectedError, self).__init__('{0}: {1} rows rejected, {2} rows {3}'.format(
+            table, rejected, count, 'committed' if committed else 'rolled back'))
+
+
+def _parse_conn(conn):
+    '''
+    split 'user/pwd@ip:port/db' into (user, pwd, dsn)
+    '''
+    user_pwd, dsn = conn.rsplit('@', 1)
+    user, pwd = user_pwd.split('/', 1)
+    return user, pwd, dsn
+
+
+def get_pool(conn=None):
+    '''
+    get (lazily create) the session pool of a connection string
+    :param conn: 'user/pwd@ip:port/db', default DATABASE_URI of project settings
+    :return: cx_Oracle.SessionPool
+    '''
+    if conn is None:
+        conn = get_project_settings().get('DATABASE_URI')
+    pool = _pools.get(conn)
+    if pool is not None:
+        return pool
+    if cx_Oracle is None:
+        raise ImportError('cx_Oracle is needed for the oracle helpers')
+    with _pools_lock:
+        pool = _pools.get(conn)
+        if pool is None:
+            pool_settings = get_project_settings().getdict('DATABASE_POOL')
+            user, pwd, dsn = _parse_conn(conn)
+            pool = cx_Oracle.SessionPool(
+                user=user,
+                password=pwd,
+                dsn=dsn,
+                min=pool_settings.get('MIN', 1),
+                max=pool_settings.get('MAX', 4),
+                increment=pool_settings.get('INCREMENT', 1),
+                threaded=True,
+                getmode=cx_Oracle.SPOOL_ATTRVAL_WAIT,
+            )
+            logging.info('create oracle session pool: %s' % dsn)
+            _pools[conn] = pool
+    return pool
+
+
+def acquire_connection(conn=None):
+    '''
+    acquire a healthy connection from the pool, dead sessions are dropped
     :param conn: 'user/pwd@ip:port/db'
-    :param insert: direct insert, performance better than update_or_insert
-    :param istimestamp: cx_Oracle datetime type default date (no microsecond), set true to support timestamp
-    :return:
+    :return: cx_Oracle.Connection
     '''
-    keys = []
-    cols = []
-    cols_update = []
-    count = 0
+    pool = get_pool(conn)
+    connection = pool.acquire()
+    if not check_connection(connection):
+        logging.warning('drop dead oracle session')
+        pool.drop(connection)
+        connection = pool.acquire()
+    return connection
+
+
+def release_connection(connection, conn=None):
+    '''
+    give a connection back to its pool
+    '''
+    get_pool(conn).release(connection)
+
 
-    for k, v in meta.items():
-        cols.append(k)
-        if v is not None and v == 'key':
-            keys.append(k)
+def check_connection(connection):
+    '''
+    health check, ping the server
+    :return: True if alive
+    '''
+    try:
+        connection.ping()
+        return True
+    except cx_Oracle.Error:
+        return False
+
+
+@contextmanager
+def oracle_connection(conn=None):
+    '''
+    with oracle_connection(conn) as connection: ...
+    uncommitted work is rolled back when the block raises
+    '''
+    connection = acquire_connection(conn)
+    try:
+        yield connection
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        release_connection(connection, conn)
+
+
+def close_pools():
+    '''
+    close all session pools, called on spider_closed
+    '''
+    with _pools_lock:
+        for conn, pool in list(_pools.items()):
+            try:
+                pool.close(force=True)
+            except cx_Oracle.Error as e:
+                logging.error(e)
+        _pools.clear()
+
+
+def dataframe_to_binds(df, cols):
+    '''
+    convert dataframe columns to bind arrays, one vectorized step per column
+    :param df: dataframe
+    :param cols: column names, the order of the binds
+    :return: a list of tuple, NaN/NaT as None
+    '''
+    arrays = []
+    for col in cols:
+        series = df[col]
+        if is_datetime64_any_dtype(series):
+            # box each distinct date once, NaT has code -1 and picks the trailing None
+            codes, uniques = pd.factorize(series)
+            dates = np.empty(len(uniques) + 1, dtype=object)
+            dates[:-1] = uniques.to_pydatetime()
+            values = dates[codes]
         else:
-            cols_update.append(k)
+            values = series.to_numpy(dtype=object)
+            mask = series.isna().to_numpy()
+            if mask.any():
+                values[mask] = None
+        arrays.append(values)
+    return list(zip(*arrays))
+
+
+def _setinputsizes(cur, datas, cols, params):
+    '''
+    setinputsizes by name for dict rows, by position for tuple rows
+    :param params: like {'col1': cx_Oracle.TIMESTAMP}, lower case names
+    '''
+    if datas and not isinstance(datas[0], dict):
+        cur.setinputsizes(*[params.get(col.lower()) for col in cols])
+    else:
+        cur.setinputsizes(**params)
+
+
+def describe_table(cur, table, conn=None):
+    '''
+    column names, types and nullability of a table, cached per process
+    :param cur: cursor used to probe the table on a cache miss
+    :param table: tablename
+    :param conn: 'user/pwd@ip:port/db', part of the cache key
+    :return: TableMeta(columns=['COL1', ...], types={'col1': type}, nullable={'COL1': True}, created)
+    '''
+    key = (conn, table.upper())
+    meta = _table_meta.get(key)
+    if meta is not None and time.time() - meta.created < TABLE_META_TTL:
+        return meta
+    cur.execute('SELECT * FROM {0} WHERE 1=2'.format(table))
+    meta = TableMeta(
+        columns=[d[0] for d in cur.description],
+        types={d[0].lower(): d[1] for d in cur.description},
+        nullable={d[0]: bool(d[6]) for d in cur.description},
+        created=time.time(),
+    )
+    _table_meta[key] = meta
+    return meta
+
 
+def invalidate_table_meta(table=None, conn=None):
+    '''
+    drop cached metadata
+    :param table: tablename, None for all tables
+    :param conn: 'user/pwd@ip:port/db', None for all connections
+    '''
+    with _table_meta_lock:
+        for key in list(_table_meta.keys()):
+            if (table is None or key[1] == table.upper()) and (conn is None or key[0] == conn):
+                del _table_meta[key]
+
+
+def _ensure_tmp_table(cur, table, conn=None, rebuildtmp=False):
+    '''
+    make sure the global temporary table TMP_x of table exists, the probe is cached
+    :return: TableMeta of TMP_x
+    '''
+    tmp_table = 'TMP_{0}'.format(table.split('.')[-1])
+    with _table_meta_lock:
+        if rebuildtmp:
+            try:
+                cur.execute('DROP TABLE {0}'.format(tmp_table))
+            except cx_Oracle.DatabaseError:
+                pass
+            _table_meta.pop((conn, tmp_table.upper()), None)
+        try:
+            return describe_table(cur, tmp_table, conn)
+        except cx_Oracle.DatabaseError:
+            logging.info('create {0}'.format(tmp_table.lower()))
+        cur.execute('CREATE GLOBAL TEMPORARY TABLE {0} ON COMMIT DELETE ROWS AS SELECT * FROM {1} WHERE 1=2'.format(tmp_table, table))
+        notnull = [col for col, nullable in describe_table(cur, tmp_table, conn).nullable.items() if not nullable]
+        if notnull:
+            cur.execute('ALTER TABLE {0} {1}'.format(tmp_table, ' '.join(['MODIFY {0} NULL'.format(col) for col in notnull])))
+        _table_meta.pop((conn, tmp_table.upper()), None)
+        return describe_table(cur, tmp_table, conn)
+
+
+def _executemany_batched(cur, datas, batch_size=BATCH_SIZE):
+    '''
+    executemany the prepared statement in chunks, bad rows are reported instead of aborting the load
+    :return: (rows affected, rows rejected)
+    '''
+    count = 0
+    rejected = 0
+    for start in range(0, len(datas), batch_size):
+        batch = datas[start:start + batch_size]
+        cur.executemany(None, batch, batcherrors=True, arraydmlrowcounts=True)
+        rowcount = sum(cur.getarraydmlrowcounts())
+        errors = cur.getbatcherrors()
+        count += rowcount
+        rejected += len(errors)
+        logging.info('batch [%s, %s): %s rows, %s errors' % (start, start + len(batch), rowcount, len(errors)))
+        for error in errors:
+            logging.error('row %s: %s' % (start + error.offset, error.message))
+    return count, rejected
+
+
+def _check_rejected(connection, table, count, rejected, max_rejected):
+    '''
+    roll back when more than max_rejected rows were rejected (None: any number), else commit
+    :raise RowsRejectedError: when any row was rejected, after the commit or the rollback
+    '''
+    if rejected and max_rejected is not None and rejected > max_rejected:
+        connection.rollback()
+        raise RowsRejectedError(table, count, rejected, False)
+    connection.commit()
+    if rejected:
+        raise RowsRejectedError(table, count, rejected, True)
+
+
+def _key_condition(field, notnull):
+    if field in notnull:
+        return 'T.{0} = S.{0}'.format(field)
+    return '(T.{0} = S.{0} OR (T.{0} IS NULL AND S.{0} IS NULL))'.format(field)
+
+
+@lru_cache(maxsize=256)
+def compile_merge_sql(table, keys, cols, mode='merge', notnull=()):
+    '''
+    MERGE/INSERT statement text, memoized per (table, keys, columns, mode)
+    :param table: tablename
+    :param keys: tuple of key columns
+    :param cols: tuple of all columns, the order of the binds
+    :param mode: 'merge' binds merged from DUAL, 'insert' binds inserted, 'bulk_insert' binds inserted direct-path,
+                 'tmp_insert' binds inserted into TMP_x, 'tmp_merge' TMP_x merged, 'tmp_update' TMP_x only updated
+    :param notnull: key columns declared NOT NULL on table, joined by plain equality so the key index is usable
+    :return: sql
+    '''
+    table_nospace = table.split('.')[-1]
+    cols_update = [col for col in cols if col not in keys]
+    on = ' AND '.join([_key_condition(field, notnull) for field in keys])
+    if mode == 'insert' or mode == 'tmp_insert' or mode == 'bulk_insert':
+        return '''
+            INSERT {3}INTO {0} 
+                ({1}) 
+              VALUES 
+                ({2})
+        '''.format(
+            'TMP_{0}'.format(table_nospace) if mode == 'tmp_insert' else table,
+            ','.join(['{0}'.format(col) for col in cols]),
+            ','.join([':{0}'.format(field) for field in cols]),
+            '/*+ APPEND_VALUES */ ' if mode == 'bulk_insert' else ''
+        )
+    if mode == 'merge':
+        source = 'SELECT {0} FROM DUAL'.format(','.join([':{0} as {0}'.format(field) for field in cols]))
+    elif mode == 'tmp_merge' or mode == 'tmp_update':
+        source = 'SELECT * FROM TMP_{0}'.format(table_nospace)
+    else:
+        raise ValueError('unknown mode: {0}'.format(mode))
     sql = '''
         MERGE INTO {0} T
-        USING (SELECT {1} FROM DUAL) S
+        USING ({1}) S
            ON ({2})
          WHEN MATCHED THEN
             UPDATE
                SET {3}
-         WHEN NOT MATCHED THEN
-            INSERT ({4})
-            VALUES ({5})
     '''.format(
         table,
-        ','.join([':{0} as {0}'.format(field) for field in cols]),
-        ' AND '.join(['(T.{0} = S.{0} OR (T.{0} IS NULL AND S.{0} IS NULL))'.format(field) for field in keys]),
+        source,
+        on,
         ','.join(['T.{0} = S.{0}'.format(field) for field in cols_update]),
+    )
+    if mode == 'tmp_update':
+        return sql
+    return sql + '''     WHEN NOT MATCHED THEN
+            INSERT ({0})
+            VALUES ({1})
+    '''.format(
         ','.join(['{0}'.format(col) for col in cols]),
         ','.join(['S.{0}'.format(field) for field in cols])
     )
-    if insert:
-        sql = '''
-            INSERT INTO {0} 
-                ({1}) 
-              VALUES 
-                ({2})
-        '''.format(
-            table,
-            ','.join(['{0}'.format(col) for col in cols]),
-            ','.join([':{0}'.format(field) for field in cols])
-        )
-        
-    conn = cx_Oracle.connect(conn)
-    cur = conn.cursor()
-    cur.prepare(sql)
-    if istimestamp:
-        cur2 = conn.cursor()
-        cur2.execute('SELECT * FROM {0} WHERE 1=2'.format(table))
 
-        params = {}
-        metakeys = [k.lower() for k in meta.keys()]
-        for d in cur2.description:
-            if d[0].lower() in metakeys:
-                params[d[0].lower()] = d[1]
 
-        cur.setinputsizes(**params)
-        for row in datas:
-            cur.executemany(None, [row,])
-            count += 1
-    else:
-        cur.executemany(None, datas)
-        count = len(datas)
-        
-    conn.commit()
-    # conn.close()
+def _notnull_keys(cur, table, keys, conn):
+    nullable = describe_table(cur, table, conn).nullable
+    return tuple(key for key in keys if not nullable.get(key.upper(), True))
+
+
+def merge_db_oracle(datas, table, meta, conn, insert=False, istimestamp=False, batch_size=BATCH_SIZE, max_rejected=None):
+    '''
+    update or insert
+    :param datas: a list of dict, or a list of tuple ordered like meta
+    :param table: tablename
+    :param meta: like {'col1': 'key', 'col2': 'key', 'col3': None, 'col4': None]
+    :param conn: 'user/pwd@ip:port/db'
+    :param insert: direct insert, performance better than update_or_insert
+    :param istimestamp: cx_Oracle datetime type default date (no microsecond), set true to support timestamp
+    :param batch_size: rows per executemany when istimestamp
+    :param max_rejected: istimestamp only, rows rejected by batcherrors that still commit the others, None any number
+    :return: count
+    :raise RowsRejectedError: when istimestamp and rows were rejected
+    '''
+    cols = tuple(meta.keys())
+    keys = tuple(k for k, v in meta.items() if v is not None and v == 'key')
+    count = 0
+    rejected = 0
+
+    with oracle_connection(conn) as connection:
+        cur = connection.cursor()
+        try:
+            if insert:
+                sql = compile_merge_sql(table, keys, cols, 'insert')
+            else:
+                sql = compile_merge_sql(table, keys, cols, 'merge', _notnull_keys(cur, table, keys, conn))
+            cur.prepare(sql)
+            if istimestamp:
+                types = describe_table(cur, table, conn).types
+                params = {k.lower(): types[k.lower()] for k in cols if k.lower() in types}
+                _setinputsizes(cur, datas, cols, params)
+                count, rejected = _executemany_batched(cur, datas, batch_size)
+            else:
+                cur.executemany(None, datas)
+                count = len(datas)
+        except cx_Oracle.DatabaseError:
+            invalidate_table_meta(table, conn)
+            raise
+
+        _check_rejected(connection, table, count, rejected, max_rejected)
     return count
 
 
-def merge_db_oracle_tmp(datas, table, meta, conn, istimestamp=False, onlyupdate=False, rebuildtmp=False):
+def merge_db_oracle_tmp(datas, table, meta, conn, istimestamp=False, onlyupdate=False, rebuildtmp=False, batch_size=BATCH_SIZE,
+                        max_rejected=None):
     '''
     update or insert
-    :param datas: a list of dict
+    :param datas: a list of dict, or a list of tuple ordered like meta
     :param table: tablename
     :param meta: like {'col1': 'key', 'col2': 'key', 'col3': None, 'col4': None]
     :param conn: 'user/pwd@ip:port/db'
     :param insert: direct insert, performance better than update_or_insert
     :param istimestamp: cx_Oracle datetime type default date (no microsecond), set true to support timestamp
-    :return:
+    :param batch_size: rows per executemany when istimestamp
+    :param max_rejected: istimestamp only, rows rejected by batcherrors that still commit the others, None any number
+    :return: count
+    :raise RowsRejectedError: when istimestamp and rows were rejected
     '''
-    keys = []
-    cols = []
-    cols_update = []
+    cols = tuple(meta.keys())
+    keys = tuple(k for k, v in meta.items() if v is not None and v == 'key')
     count = 0
-    
-    for k, v in meta.items():
-        cols.append(k)
-        if v is not None and v == 'key':
-            keys.append(k)
-        else:
-            cols_update.append(k)
+    rejected = 0
 
     table_nospace = table.split('.')[-1]
 
-    sqlinsert = '''
-        INSERT INTO TMP_{0} 
-            ({1}) 
-          VALUES 
-            ({2})
-    '''.format(
-        table_nospace,
-        ','.join(['{0}'.format(col) for col in cols]),
-        ','.join([':{0}'.format(field) for field in cols])
-    )
-    sqlmerge = '''
-        MERGE INTO {0} T
-        USING (SELECT * FROM TMP_{1}) S
-           ON ({2})
-         WHEN MATCHED THEN
-            UPDATE
-               SET {3}
-         WHEN NOT MATCHED THEN
-            INSERT ({4})
-            VALUES ({5})
-    '''.format(
-        table,
-        table_nospace,
-        ' AND '.join(['(T.{0} = S.{0} OR (T.{0} IS NULL AND S.{0} IS NULL))'.format(field) for field in keys]),
-        ','.join(['T.{0} = S.{0}'.format(field) for field in cols_update]),
-        ','.join(['{0}'.format(col) for col in cols]),
-        ','.join(['S.{0}'.format(field) for field in cols])
-    )
-    if onlyupdate:
-        sqlmerge = '''
-            MERGE INTO {0} T
-            USING (SELECT * FROM TMP_{1}) S
-               ON ({2})
-             WHEN MATCHED THEN
-                UPDATE
-                   SET {3}
-        '''.format(
-            table,
-            table_nospace,
-            ' AND '.join(['(T.{0} = S.{0} OR (T.{0} IS NULL AND S.{0} IS NULL))'.format(field) for field in keys]),
-            ','.join(['T.{0} = S.{0}'.format(field) for field in cols_update]),
-        )
-    conn = cx_Oracle.connect(conn)
-    cur = conn.cursor()
+    with oracle_connection(conn) as connection:
+        cur = connection.cursor()
+        tmp_meta = _ensure_tmp_table(cur, table, conn, rebuildtmp)
+        try:
+            sqlinsert = compile_merge_sql(table, keys, cols, 'tmp_insert')
+            sqlmerge = compile_merge_sql(table, keys, cols, 'tmp_update' if onlyupdate else 'tmp_merge',
+                                         _notnull_keys(cur, table, keys, conn))
+            cur.prepare(sqlinsert)
+            if istimestamp:
+                _setinputsizes(cur, datas, cols, tmp_meta.types)
+                count, rejected = _executemany_batched(cur, datas, batch_size)
+            else:
+                cur.executemany(None, datas)
+                count = len(datas)
 
-    try:
-        cur.execute('SELECT * FROM TMP_{0} WHERE 1=2'.format(table_nospace))
-        if rebuildtmp:
-            cur.execute('DROP TABLE TMP_{0}'.format(table_nospace))
-            cur.execute('SELECT * FROM TMP_{0} WHERE 1=2'.format(table_nospace))
-    except:
-        logging.info('create tmp_{0}'.format(table_nospace))
-        cur.execute('CREATE GLOBAL TEMPORARY TABLE TMP_{0} ON COMMIT DELETE ROWS AS SELECT * FROM {1} WHERE 1=2'.format(table_nospace, table))
-        cur.execute("SELECT COLUMN_NAME FROM USER_TAB_COLS WHERE USER_TAB_COLS.TABLE_NAME = 'TMP_{0}' AND NULLABLE = 'N'".format(table_nospace))
-        cur.execute("ALTER TABLE TMP_{0} {1}".format(table_nospace, ' '.join(['MODIFY {0} NULL'.format(r[0]) for r in cur])))
-    cur.prepare(sqlinsert)
-    if istimestamp:
-        cur2 = conn.cursor()
-        cur2.execute('SELECT * FROM TMP_{0} WHERE 1=2'.format(table_nospace))
-        cur.setinputsizes(**{d[0].lower(): d[1] for d in cur2.description})
-        for row in datas:
-            cur.executemany(None, [row,])
-            count += 1
+            cur.execute(sqlmerge)
+        except cx_Oracle.DatabaseError:
+            invalidate_table_meta(table, conn)
+            invalidate_table_meta('TMP_{0}'.format(table_nospace), conn)
+            raise
+        _check_rejected(connection, table, count, rejected, max_rejected)
+    return count
+
+
+def oracle_table_empty(table, conn):
+    '''
+    whether table has no rows, reads at most one row
+    '''
+    with oracle_connection(conn) as connection:
+        cur = connection.cursor()
+        cur.execute('SELECT 1 FROM {0} WHERE ROWNUM = 1'.format(table))
+        return cur.fetchone() is None
+
+
+def _nonunique_indexes(cur, table):
+    '''
+    names of the non-unique indexes of table, a unique index cannot be skipped by a direct-path insert
+    '''
+    if '.' in table:
+        owner, name = table.upper().split('.', 1)
+        cur.execute("SELECT OWNER || '.' || INDEX_NAME FROM ALL_INDEXES WHERE TABLE_OWNER = :owner AND TABLE_NAME = :name "
+                    "AND UNIQUENESS = 'NONUNIQUE'", owner=owner, name=name)
     else:
-        cur.executemany(None, datas)
-        count = len(datas)
+        cur.execute("SELECT INDEX_NAME FROM USER_INDEXES WHERE TABLE_NAME = :name AND UNIQUENESS = 'NONUNIQUE'", name=table.upper())
+    return [row[0] for row in cur.fetchall()]
 
-    cur.execute(sqlmerge)
-    conn.commit()
-    # conn.close()
+
+def bulk_load_oracle(datas, table, meta, conn, istimestamp=False, batch_size=BULK_BATCH_SIZE, rebuild_indexes=False):
+    '''
+    direct-path array insert into an empty or rebuilt table, committed every batch_size rows
+    the rows must not be in table yet, a duplicate key fails the batch with ORA-00001
+    :param datas: a list of dict, or a list of tuple ordered like meta
+    :param table: tablename
+    :param meta: like {'col1': 'key', 'col2': 'key', 'col3': None, 'col4': None]
+    :param conn: 'user/pwd@ip:port/db'
+    :param istimestamp: cx_Oracle datetime type default date (no microsecond), set true to support timestamp
+    :param batch_size: rows per insert and commit
+    :param rebuild_indexes: make the non-unique indexes unusable during the load and rebuild them after
+    :return: count
+    '''
+    cols = tuple(meta.keys())
+    keys = tuple(k for k, v in meta.items() if v is not None and v == 'key')
+    count = 0
+    start = time.time()
+
+    with oracle_connection(conn) as connection:
+        cur = connection.cursor()
+        indexes = _nonunique_indexes(cur, table) if rebuild_indexes else []
+        loaded = False
+        try:
+            for index in indexes:
+                cur.execute('ALTER INDEX {0} UNUSABLE'.format(index))
+            cur.prepare(compile_merge_sql(table, keys, cols, 'bulk_insert'))
+            if istimestamp:
+                types = describe_table(cur, table, conn).types
+                params = {k.lower(): types[k.lower()] for k in cols if k.lower() in types}
+                _setinputsizes(cur, datas, cols, params)
+            for offset in range(0, len(datas), batch_size):
+                batch = datas[offset:offset + batch_size]
+                cur.executemany(None, batch)
+                # rows inserted direct-path cannot be read or inserted again before the commit (ORA-12838)
+                connection.commit()
+                count += len(batch)
+            loaded = True
+        except cx_Oracle.DatabaseError:
+            connection.rollback()
+            invalidate_table_meta(table, conn)
+            raise
+        finally:
+            rebuild_error = None
+            for index in indexes:
+                try:
+                    cur.execute('ALTER INDEX {0} REBUILD'.format(index))
+                except cx_Oracle.DatabaseError as e:
+                    logging.error('rebuild index {0} of {1} failed: {2}'.format(index, table, e))
+                    rebuild_error = rebuild_error or e
+            # an error of the load is raised, not masked by the rebuild
+            if loaded and rebuild_error is not None:
+                raise rebuild_error
+    elapsed = time.time() - start
+    logging.info('bulk load {0}: {1} rows in {2:.2f}s, {3:.0f} rows/s'.format(table, count, elapsed, count / elapsed if elapsed else 0))
     return count
 
 
-def merge_db_oracle_dataframe(df, table, conn, insert=False, istimestamp=False, istmp=False, onlyupdate=False, rebuildtmp=False):
+class MergeResult(namedtuple('MergeResult', ['inserted', 'updated', 'unchanged'])):
+    '''
+    row counts of a diff merge, str() is the ACTIONS text of SCRIPT_RUN_LOG
+    '''
+    def __str__(self):
+        return '合入{0}条数据(新增{1}, 更新{2}, 未变{3})'.format(
+            self.inserted + self.updated, self.inserted, self.updated, self.unchanged)
+
+
+def fetch_existing_dataframe(df, table, keys, cols, conn):
+    '''
+    the rows of table in the key range of df, in one query
+    datetime and numeric keys are bounded by their min/max in df, other keys are not filtered
+    :param df: dataframe with keys as columns
+    :param keys: key columns
+    :param cols: columns to select
+    :return: dataframe with cols
+    '''
+    where = []
+    params = {}
+    for i, key in enumerate(keys):
+        series = df[key]
+        if not (is_datetime64_any_dtype(series) or is_numeric_dtype(series)) or series.isna().all():
+            continue
+        lo, hi = series.min(), series.max()
+        if is_datetime64_any_dtype(series):
+            lo, hi = lo.to_pydatetime(), hi.to_pydatetime()
+        else:
+            lo, hi = lo.item(), hi.item()
+        where.append('{0} BETWEEN :lo{1} AND :hi{1}'.format(key, i))
+        params['lo{0}'.format(i)] = lo
+        params['hi{0}'.format(i)] = hi
+    if not where:
+        logging.warning('no key range to diff {0}, fetch the whole table'.format(table))
+    sql = 'SELECT {0} FROM {1}{2}'.format(
+        ','.join(cols),
+        table,
+        ' WHERE ' + ' AND '.join(where) if where else ''
+    )
+    with oracle_connection(conn) as connection:
+        cur = connection.cursor()
+        cur.arraysize = BATCH_SIZE
+        cur.execute(sql, params)
+        return pd.DataFrame(cur.fetchall(), columns=list(cols))
+
+
+def diff_dataframe(df, existing, keys, cols):
+    '''
+    compare df against existing rows on keys, NaN equals NaN
+    :return: (rows of df to write, MergeResult)
+    '''
+    existing = existing.drop_duplicates(subset=list(keys), keep='last')
+    for key in keys:
+        if existing[key].dtype != df[key].dtype:
+            existing[key] = existing[key].astype(df[key].dtype)
+    merged = df[list(cols)].merge(existing, on=list(keys), how='left', suffixes=('', '__OLD'), indicator=True)
+    inserted = (merged['_merge'] == 'left_only').to_numpy()
+    changed = np.zeros(len(merged), dtype=bool)
+    for col in cols:
+        if col in keys:
+            continue
+        new, old = merged[col], merged[col + '__OLD']
+        same = (new == old).to_numpy() | (new.isna() & old.isna()).to_numpy()
+        changed |= ~same
+    changed &= ~inserted
+    result = MergeResult(int(inserted.sum()), int(changed.sum()), int(len(merged) - inserted.sum() - changed.sum()))
+    return merged.loc[inserted | changed, list(cols)], result
+
+
+def merge_db_oracle_dataframe(df, table, conn, insert=False, istimestamp=False, istmp=False, onlyupdate=False, rebuildtmp=False, batch_size=BATCH_SIZE, diff=False,
+                              mode=None, rebuild_indexes=False, max_rejected=None):
     '''
     update or insert from dataframe
     :param df: dataframe
@@ -195,22 +612,49 @@ def merge_db_oracle_dataframe(df, table, conn, insert=False, istimestamp=False,
     :param istimestamp: cx_Oracle datetime type default date (no microsecond), set true to support timestamp
     :param istmp: insert into Oracle temporary table, then merge into real table
     :param onlyupdate: just update, dont insert
-    :return:
+    :param batch_size: rows per executemany when istimestamp
+    :param diff: only write rows missing from or different to the table, needs index keys
+    :param mode: None or 'merge' merges; 'auto' bulk loads when the table is empty, else merges;
+                 'bulk' bulk loads (bulk_load_oracle) into a table being rebuilt, the rows must not be in it
+    :param rebuild_indexes: bulk load only, rebuild the non-unique indexes after the load
+    :param max_rejected: merge when istimestamp, rows rejected by batcherrors that still commit the others, None any number
+    :return: count, MergeResult when diff
+    :raise RowsRejectedError: when istimestamp and rows were rejected
     '''
+    if mode not in (None, 'merge', 'auto', 'bulk'):
+        raise ValueError('unknown mode: {0}'.format(mode))
     meta = {v: None for v in df.columns}
     keys = {v: 'key' for v in df.index.names if v is not None}
     meta.update(keys)
     df = df.reset_index(drop=len(keys)==0)
 
-    rows = df.to_dict(orient='records')
-    for row in rows:
-        for key in meta.keys():
-            if pd.isnull(row[key]):
-                row[key] = None
+    if mode == 'auto' and not onlyupdate and len(df) and oracle_table_empty(table, conn):
+        logging.info('{0} is empty, bulk load'.format(table))
+        mode = 'bulk'
+    if mode == 'bulk':
+        if keys:
+            # a key inserted twice would fail the whole load on the primary key, keep the last row like the merge
+            df = df.drop_duplicates(subset=list(keys), keep='last')
+        rows = dataframe_to_binds(df, list(meta.keys()))
+        count = bulk_load_oracle(rows, table, meta, conn, istimestamp, rebuild_indexes=rebuild_indexes)
+        return MergeResult(count, 0, 0) if diff else count
+
+    result = None
+    if diff and keys:
+        existing = fetch_existing_dataframe(df, table, list(keys), list(meta.keys()), conn)
+        df, result = diff_dataframe(df, existing, list(keys), list(meta.keys()))
+        logging.info('diff {0}: {1}'.format(table, result))
+        if len(df) == 0:
+            return result
+    elif diff:
+        logging.warning('no index keys to diff {0}, merge all rows'.format(table))
+
+    rows = dataframe_to_binds(df, list(meta.keys()))
     if istmp:
-        return merge_db_oracle_tmp(rows, table, meta, conn, istimestamp, onlyupdate, rebuildtmp)
+        count = merge_db_oracle_tmp(rows, table, meta, conn, istimestamp, onlyupdate, rebuildtmp, batch_size, max_rejected)
     else:
-        return merge_db_oracle(rows, table, meta, conn, insert, istimestamp)
+        count = merge_db_oracle(rows, table, meta, conn, insert, istimestamp, batch_size, max_rejected)
+    return count if result is None else result
 
 
 def merge_db_mysql(datas, table, conn):
@@ -237,35 +681,166 @@ def merge_db_mysql(datas, table, conn):
     conn.close()
 
 
-def merge_db_sqlite(datas, table, conn):
-    import sqlite3
-    cols = datas[0].keys()
-    sql = '''
-        REPLACE INTO {0}({1}) VALUES ({2})
-    '''.format(
+def get_sqlite_connection(conn):
+    '''
+    get (lazily open) the connection of a sqlite database, kept open and shared by the threads of the process
+    :param conn: database path
+    :return: SqliteConnection(connection, lock, tables)
+    '''
+    with _sqlite_lock:
+        entry = _sqlite_connections.get(conn)
+        if entry is None:
+            parent = os.path.dirname(conn)
+            if parent and not os.path.exists(parent):
+                os.makedirs(parent)
+            # transactions are begun explicitly, statements of the same sql are prepared once
+            connection = sqlite3.connect(conn, isolation_level=None, check_same_thread=False, cached_statements=256)
+            for pragma in SQLITE_PRAGMAS:
+                connection.execute(pragma)
+            logging.info('open sqlite database: %s' % conn)
+            entry = SqliteConnection(connection, threading.Lock(), set())
+            _sqlite_connections[conn] = entry
+    return entry
+
+
+def close_sqlite_connections():
+    '''
+    close all sqlite connections, called on spider_closed
+    '''
+    with _sqlite_lock:
+        for conn, entry in list(_sqlite_connections.items()):
+            with entry.lock:
+                entry.connection.close()
+        _sqlite_connections.clear()
+
+
+def _sqlite_primary_key(cur, table):
+    columns = cur.execute('PRAGMA table_info("{0}")'.format(table)).fetchall()
+    return tuple(row[1] for row in sorted(columns, key=lambda row: row[5]) if row[5] > 0)
+
+
+@lru_cache(maxsize=256)
+def compile_sqlite_sql(table, keys, cols, mode='upsert', types=None):
+    '''
+    sqlite statement text, memoized per (table, keys, columns, mode)
+    :param keys: tuple of key columns, the conflict target of the upsert
+    :param cols: tuple of all columns, the order of the binds
+    :param mode: 'upsert' INSERT ... ON CONFLICT (keys) DO UPDATE, 'insert' plain INSERT,
+                 'create' CREATE TABLE IF NOT EXISTS with keys as primary key
+    :param types: tuple of column types like cols, 'create' only
+    :return: sql
+    '''
+    if mode == 'create':
+        return 'CREATE TABLE IF NOT EXISTS "{0}" ({1}{2})'.format(
+            table,
+            ', '.join(['"{0}" {1}'.format(col, col_type) for col, col_type in zip(cols, types)]),
+            ', PRIMARY KEY ({0})'.format(', '.join(['"{0}"'.format(key) for key in keys])) if keys else '',
+        )
+    sql = 'INSERT INTO "{0}" ({1}) VALUES ({2})'.format(
         table,
-        ','.join(cols),
-        ','.join([':{0}'.format(field) for field in cols]),
+        ', '.join(['"{0}"'.format(col) for col in cols]),
+        ', '.join(['?' for col in cols]),
+    )
+    if mode == 'insert':
+        return sql
+    if mode != 'upsert':
+        raise ValueError('unknown mode: {0}'.format(mode))
+    cols_update = [col for col in cols if col not in keys]
+    return sql + ' ON CONFLICT ({0}) DO {1}'.format(
+        ', '.join(['"{0}"'.format(key) for key in keys]),
+        'UPDATE SET ' + ', '.join(['"{0}" = excluded."{0}"'.format(col) for col in cols_update]) if cols_update else 'NOTHING',
     )
-    conn = sqlite3.connect(conn)
-    cur = conn.cursor()
-    sel = cur.execute("SELECT COUNT(*) AS COUNT FROM SQLITE_MASTER WHERE TYPE='table' AND NAME='{0}' COLLATE NOCASE".format(table))
-    if sel.fetchone()[0] == 0:
-        logging.warning('no table {0}'.format(table))
-        pass
 
-    cur.executemany(sql, datas)
-    conn.commit()
-    conn.close()
+
+def merge_db_sqlite(datas, table, conn, meta=None, types=None, batch_size=BATCH_SIZE):
+    '''
+    update or insert, INSERT ... ON CONFLICT (keys) DO UPDATE in one transaction
+    :param datas: a list of dict, or a list of tuple ordered like meta
+    :param table: tablename
+    :param conn: database path, the connection is kept open (get_sqlite_connection)
+    :param meta: like {'col1': 'key', 'col2': 'key', 'col3': None, 'col4': None], default the keys of datas[0]
+                 and the primary key of table
+    :param types: like {'col1': 'TEXT'}, the table is created with them and meta's keys as primary key if missing
+    :param batch_size: rows per executemany
+    :return: count
+    '''
+    if not datas:
+        return 0
+    if meta is None:
+        meta = {col: None for col in datas[0].keys()}
+    cols = tuple(meta.keys())
+    keys = tuple(k for k, v in meta.items() if v is not None and v == 'key')
+    if isinstance(datas[0], dict):
+        datas = [tuple(row.get(col) for col in cols) for row in datas]
+    count = 0
+
+    entry = get_sqlite_connection(conn)
+    with entry.lock:
+        cur = entry.connection.cursor()
+        if table not in entry.tables:
+            if types is not None:
+                cur.execute(compile_sqlite_sql(table, keys, cols, 'create', tuple(types.get(col, '') for col in cols)))
+            elif not cur.execute("SELECT 1 FROM SQLITE_MASTER WHERE TYPE = 'table' AND NAME = ? COLLATE NOCASE", (table,)).fetchone():
+                raise ValueError('no table {0} in {1}, pass types to create it'.format(table, conn))
+            entry.tables.add(table)
+        if not keys:
+            keys = _sqlite_primary_key(cur, table)
+        sql = compile_sqlite_sql(table, keys, cols, 'upsert' if keys else 'insert')
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            for start in range(0, len(datas), batch_size):
+                batch = datas[start:start + batch_size]
+                cur.executemany(sql, batch)
+                count += len(batch)
+            cur.execute('COMMIT')
+        except Exception:
+            cur.execute('ROLLBACK')
+            raise
+    return count
+
+
+def _sqlite_type(series):
+    '''
+    declared column type of a dtype. sqlite has no datetime storage class, datetimes are ISO-8601 text
+    ('YYYY-MM-DD HH:MM:SS'): it sorts and compares like the dates, and sqlite's date functions read it.
+    TEXT affinity keeps it text; a TIMESTAMP column would have NUMERIC affinity.
+    '''
+    if is_bool_dtype(series) or is_integer_dtype(series):
+        return 'INTEGER'
+    if is_float_dtype(series):
+        return 'REAL'
+    if is_datetime64_any_dtype(series):
+        return 'TEXT'
+    return 'TEXT'
+
+
+def merge_db_sqlite_dataframe(df, table, conn, batch_size=BATCH_SIZE):
+    '''
+    update or insert from dataframe, the index columns are the keys like merge_db_oracle_dataframe
+    datetimes are stored as 'YYYY-MM-DD HH:MM:SS' TEXT (_sqlite_type), the table is created from the dtypes on first use
+    :param df: dataframe
+    :param table: tablename
+    :param conn: database path
+    :return: count
+    '''
+    meta = {v: None for v in df.columns}
+    keys = {v: 'key' for v in df.index.names if v is not None}
+    meta.update(keys)
+    df = df.reset_index(drop=len(keys)==0)
+    types = {col: _sqlite_type(df[col]) for col in meta}
+    for col in meta:
+        if is_datetime64_any_dtype(df[col]):
+            df[col] = df[col].dt.strftime('%Y-%m-%d %H:%M:%S').where(df[col].notna(), None)
+    rows = dataframe_to_binds(df, list(meta.keys()))
+    return merge_db_sqlite(rows, table, conn, meta, types, batch_size)
 
 
 def execute_sql(sql_str, conn_str):
     try:
-        conn = cx_Oracle.connect(conn_str)
-        cur = conn.cursor()
-        cur.execute(sql_str)
-        conn.commit()
-        # conn.close()
+        with oracle_connection(conn_str) as connection:
+            cur = connection.cursor()
+            cur.execute(sql_str)
+            connection.commit()
     except Exception as e:
         logging.error(e)
 
@@ -292,29 +867,34 @@ if __name__ =="__main__":
     ]
     merge_db_sqlite(datas, 'MinuteOne2', r'D:\data\test.db')
 
-def insert_log_table(script_name,data_table_name,start_time,result,action,remark):
+SCRIPT_RUN_LOG_SQL = """INSERT INTO SCRIPT_RUN_LOG (SCRIPT_NAME, TABLE_NAME, SERVER_IP, START_TIME, END_TIME, DURATION, 
+    ACTIONS, RESULT, INSERT_DT, REMARK) VALUES (:1, :2, :3, TO_TIMESTAMP(:4, 'YYYY-MM-DD HH24:MI:SS.FF6'),
+    TO_TIMESTAMP(:5, 'YYYY-MM-DD HH24:MI:SS.FF6'), :6, :7, :8, TO_TIMESTAMP(:9, 'YYYY-MM-DD HH24:MI:SS'), :10)"""
+
+
+def script_log_values(script_name, data_table_name, start_time, result, action, remark):
+    '''
+    binds of one SCRIPT_RUN_LOG row ending now, strings and a float
+    '''
     end_time = pd.Timestamp(pd.Timestamp.now())
     sys_date = pd.to_datetime(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
     run_duration = round((end_time - start_time).total_seconds(), 6)
-    log_value = [script_name,
-                 data_table_name,
-                 'dolphinscheduler',
-                 str(start_time),
-                 str(end_time),
-                 run_duration,
-                 action,
-                 result,
-                 str(sys_date),
-                 remark]
-
-    conn = get_project_settings().get('DATABASE_URI')
-    conn = cx_Oracle.connect(conn)
-    cur = conn.cursor()
+    return [script_name,
+            data_table_name,
+            'dolphinscheduler',
+            str(start_time),
+            str(end_time),
+            run_duration,
+            action,
+            result,
+            str(sys_date),
+            remark]
 
-    insert_sql = """INSERT INTO SCRIPT_RUN_LOG (SCRIPT_NAME, TABLE_NAME, SERVER_IP, START_TIME, END_TIME, DURATION, 
-    ACTIONS, RESULT, INSERT_DT, REMARK) VALUES (:1, :2, :3, TO_TIMESTAMP(:4, 'YYYY-MM-DD HH24:MI:SS.FF6'),
-    TO_TIMESTAMP(:5, 'YYYY-MM-DD HH24:MI:SS.FF6'), :6, :7, :8, TO_TIMESTAMP(:9, 'YYYY-MM-DD HH24:MI:SS'), :10)"""
-    cur.execute(insert_sql, log_value)
-    conn.commit()
-    conn.close()
-    print result,'日志插入数据库'
\ No newline at end of file
+
+def insert_log_table(script_name,data_table_name,start_time,result,action,remark):
+    log_value = script_log_values(script_name, data_table_name, start_time, result, action, remark)
+    with oracle_connection(get_project_settings().get('DATABASE_URI')) as connection:
+        cur = connection.cursor()
+        cur.execute(SCRIPT_RUN_LOG_SQL, log_value)
+        connection.commit()
+    logging.info('%s 日志插入数据库' % result)
@@ -0,0 +1,72 @@
+# coding=utf8
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+
+class FetchState(object):
+    '''
+    按url记录表格页面的ETag, Last-Modified和内容hash, 存为json文件
+    同一文件在进程内只有一个实例, 由下载中间件读取, 由pipeline在合入成功后写入
+    '''
+    _states = {}
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    @classmethod
+    def get(cls, path):
+        with cls._lock:
+            if path not in cls._states:
+                cls._states[path] = cls(path)
+            return cls._states[path]
+
+    @classmethod
+    def from_settings(cls, settings):
+        path = settings.get('MPOB_FETCH_STATE_FILE') or os.path.join(settings.get('TEMP_DATA_DIR'), 'fetch_state.json')
+        return cls.get(path)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except ValueError:
+            logging.warning('ignore broken fetch state file: %s' % self.path)
+
+    def lookup(self, url):
+        with self.lock:
+            return self.entries.get(url)
+
+    def update(self, url, entry):
+        '''
+        记录url的抓取状态并写入文件
+        :param entry: {'etag', 'last_modified', 'hash', 'table'}
+        '''
+        with self.lock:
+            entry = dict(entry, updated=time.strftime('%Y-%m-%d %H:%M:%S'))
+            self.entries[url] = entry
+            parent = os.path.dirname(self.path)
+            if parent and not os.path.exists(parent):
+                os.makedirs(parent)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+    def forget(self, url):
+        with self.lock:
+            self.entries.pop(url, None)
+
+
+def body_hash(body):
+    return hashlib.sha1(body).hexdigest()
+
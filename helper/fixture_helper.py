@@ -0,0 +1,220 @@
+# coding=utf8
+'''
+测试和scripts/下基准脚本共用的样例数据:
+合成的MPOB表格和页面, 入库用的长表, 改为向量化之前逐行逐列遍历的实现(loop_*, 作为对照), FTP归档目录
+'''
+import os
+import filecmp
+import numpy as np
+import pandas as pd
+
+EXPORT_MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUNE', 'JULY', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+
+
+def loop_export_transform(df_hor, header, year):
+    # PalmOilExportSpider.transform before reshape_helper
+    months = ['NULL', 'JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUNE', 'JULY', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+    datas = []
+    for r in df_hor.itertuples():
+        header_value = None
+        for i, c in enumerate(df_hor.columns):
+            if c == header:
+                header_value = r[i+1]
+            else:
+                datas.append({
+                    header: header_value,
+                    'DATADATE': '{0}-{1}'.format(year, months.index(c)),
+                    'VALUE': r[i+1],
+                })
+    df = pd.DataFrame(datas)
+    df.dropna(axis=0, subset=['VALUE'], inplace=True)
+    return df
+
+
+def loop_trim_header(df_hor, header):
+    # trim_header of the production and stock spiders before reshape_helper
+    months = ['NULL', 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+    df = df_hor.iloc[:, :-2]
+    month_to_year = df[df[header] == header].iloc[:, 1:].to_dict(orient='records')[0]
+    df = df[df[header] != header]
+    columns = []
+    for c in df.columns:
+        if c in month_to_year:
+            new_name = '%s-%s' % (int(month_to_year[c]), months.index(c[0:3]))
+        else:
+            new_name = c
+        columns.append(new_name)
+    df.columns = columns
+    return df
+
+
+def loop_transpose_date(df_hor, header):
+    # transpose_date of the production and stock spiders before reshape_helper
+    datas = []
+    for r in df_hor.itertuples():
+        header_value = None
+        for i, c in enumerate(df_hor.columns):
+            if c == header:
+                header_value = r[i+1]
+            else:
+                datas.append({
+                    'DATADATE': c,
+                    header: header_value,
+                    'VALUE': r[i+1],
+                })
+    return pd.DataFrame(datas)
+
+
+def loop_summary_transform(df_hor):
+    # PalmOilSummarySpider.transform before reshape_helper
+    category = None
+    unit = None
+    datas = []
+    for r in df_hor.itertuples():
+        product = None
+        if str(r[1]) == str(r[2]) or pd.isnull(r[2]):
+            first_col_value = str(r[1]).strip()
+            category = first_col_value[0:first_col_value.index('(')].strip()
+            unit = first_col_value[first_col_value.index('(')+1:first_col_value.index(')')].strip()
+        else:
+            for i, c in enumerate(df_hor.columns):
+                if c == 'MIXTURE':
+                    product = r[i+1]
+                else:
+                    datas.append({
+                        'CATEGORY': category,
+                        'PRODUCT': product,
+                        'DATADATE': c,
+                        'VALUE': r[i+1],
+                        'UNIT': unit
+                    })
+    return pd.DataFrame(datas)
+
+
+def loop_binds(df, cols):
+    # merge_db_oracle_dataframe before dataframe_to_binds, rows as tuples in cols order
+    rows = df.to_dict(orient='records')
+    for row in rows:
+        for key in cols:
+            if pd.isnull(row[key]):
+                row[key] = None
+    return [tuple(row[key] for key in cols) for row in rows]
+
+
+def export_table(rows, kind='float', seed=0):
+    '''
+    出口表格: COUNTRY列和JAN..DEC各月的值, 约一成为空
+    :param kind: float, int(整数值, 无空值)或mixed(MAR列混有'-')
+    '''
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'COUNTRY': ['C%d' % i for i in range(rows)]})
+    for m in EXPORT_MONTHS:
+        if kind == 'int':
+            df[m] = rng.integers(0, 9, rows)
+        else:
+            values = rng.random(rows) * 1000
+            values[rng.random(rows) < .1] = np.nan
+            df[m] = values
+    if kind == 'mixed':
+        df['MAR'] = df['MAR'].astype(object)
+        df.loc[0, 'MAR'] = '-'
+    return df
+
+
+def monthly_table(header, rows, seed=0):
+    '''
+    产量和库存表格: 第一行为年份行, 列为Jan..Dec, 最后两列被trim_header去掉
+    '''
+    rng = np.random.default_rng(seed)
+    columns = [header] + [m[:3].title() for m in EXPORT_MONTHS] + ['Total', 'Note']
+    data = [[header] + [2022] * 12 + [None, None]]
+    for i in range(rows):
+        data.append(['%s %d' % (header.upper(), i)] + list(rng.random(12) * 1e5) + [1, None])
+    return pd.DataFrame(data, columns=columns)
+
+
+def summary_table(sections, rows, seed=0):
+    '''
+    摘要表格: 数据行前无标题, 各段以PRODUCTION (TONNES)这样的标题行开始, 段尾有一行只有标题的空段
+    '''
+    rng = np.random.default_rng(seed)
+    data = [['X'] + [1.0] * 12]
+    for s in range(sections):
+        data.append(['SECTION %d (TONNES)' % s] * 13)
+        for i in range(rows):
+            data.append(['P%d' % i] + list(rng.random(12)))
+        data.append(['PRICE (1% OER EQUIVALENT)', np.nan] + [np.nan] * 11)
+    return pd.DataFrame(data, columns=['MIXTURE'] + ['2022-%d' % m for m in range(1, 13)])
+
+
+def long_table(rows, seed=0):
+    '''
+    入库前的长表: 日期和品名为键, 带NaN的数值, 带NaT的日期, 整数, 布尔和三个常量字符串列
+    '''
+    rng = np.random.default_rng(seed)
+    value = rng.random(rows) * 1000
+    value[rng.random(rows) < 0.1] = np.nan
+    published = pd.Series(pd.date_range('2022-01-05', periods=rows, freq='h'))
+    published[rng.random(rows) < 0.1] = pd.NaT
+    return pd.DataFrame({
+        'DATADATE': pd.to_datetime('2000-01-01') + pd.to_timedelta(rng.integers(0, 9000, rows), unit='D'),
+        'PRODUCT': np.array(['CPO', 'PK', 'PKO', 'RBD PALM OLEIN', None], dtype=object)[rng.integers(0, 5, rows)],
+        'VALUE': value,
+        'PUBLISHED': published,
+        'COUNT': rng.integers(0, 100, rows),
+        'REVISED': rng.random(rows) < 0.5,
+        'UNIT': 'TONNES',
+        'SOURCE': 'MPOB',
+        'FREQUENCY': 'MONTHLY',
+    })
+
+
+def stock_page(rows, seed=0):
+    '''
+    MPOB库存页面式的html: thead中年份行colspan, 地区列rowspan, 隐藏的行和单元格, 千分位, '-'和&nbsp;空白, 注释和<style>
+    '''
+    rng = np.random.default_rng(seed)
+    months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun']
+    head = ('<thead><tr><th rowspan="2">Region</th><th rowspan="2">States</th><th colspan="6">2022</th></tr>'
+            '<tr>%s</tr></thead>' % ''.join('<th>%s</th>' % m for m in months))
+    body = []
+    for i in range(rows):
+        region = '<td rowspan="2">R%d</td>' % (i // 2) if i % 2 == 0 else ''
+        cells = []
+        for m in range(6):
+            value = rng.random() * 100000
+            if (i + m) % 7 == 0:
+                cells.append('<td>-</td>')
+            elif (i + m) % 11 == 0:
+                cells.append('<td>&nbsp;</td>')
+            else:
+                cells.append('<td>{:,.2f}</td>'.format(value))
+        body.append('<tr>%s<td>State\n  %d<!-- note --></td>%s</tr>' % (region, i, ''.join(cells)))
+        if i % 5 == 0:
+            body.append('<tr style="display: none"><td>hidden</td><td>%d</td></tr>' % i)
+    table = ('<table><style>td {color: red}</style>%s<tbody>%s</tbody>'
+             '<tfoot><tr><td colspan="2">Total<span style="display:none"> (hidden)</span></td>%s</tr></tfoot></table>'
+             % (head, ''.join(body), '<td>1,234.50</td>' * 6))
+    return '<html><body><table style="display:none"><tr><td>menu</td></tr></table>%s</body></html>' % table
+
+
+def make_tree(root, years=(2020, 2021), tables=('export', 'stock'), files=3, size=50000):
+    '''
+    本地归档目录: <年份>/<类别>/T<n>.zip, 随机内容
+    '''
+    for year in years:
+        for table in tables:
+            path = os.path.join(root, str(year), table)
+            os.makedirs(path)
+            for n in range(files):
+                with open(os.path.join(path, 'T%d.zip' % n), 'wb') as f:
+                    f.write(os.urandom(size))
+
+
+def same_tree(left, right):
+    def same(cmp):
+        if cmp.left_only or cmp.right_only or cmp.funny_files:
+            return False
+        mismatch, errors = filecmp.cmpfiles(cmp.left, cmp.right, cmp.common_files, shallow=False)[1:]
+        return not mismatch and not errors and all(same(sub) for sub in cmp.subdirs.values())
+    return same(filecmp.dircmp(left, right, ignore=[]))
@@ -1,12 +1,37 @@
 # coding=utf-8
 
 import os
+import io
+import json
 import time
+import calendar
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 # from pathlib import Path
-from ftplib import FTP, error_perm, error_temp
+import socket
+from ftplib import FTP, FTP_TLS, error_perm, error_temp, error_reply, all_errors
 import logging
 logger = logging.getLogger(__name__)
 
+# a command failing with these lost the connection, FtpService logs in again
+_RECONNECT_ERRORS = (error_temp, error_reply, EOFError, OSError)
+
+
+def _block_size(session):
+    # FtpService.connect sets block_size on the session, ftplib's default otherwise
+    return getattr(session, 'block_size', 8192)
+
+
+def _log_transfer(action, size, start, path):
+    elapsed = max(time.time() - start, 1e-6)
+    logger.debug('%s(%s Byte) %s in %.2fs, %.1f KB/s' % (action, size, path, elapsed, size / 1024.0 / elapsed))
+
+
+def _is_data_connection_error(e):
+    # 425 Can't open data connection, or the server never connected back (active mode)
+    return (isinstance(e, error_temp) and str(e).startswith('425')) or isinstance(e, socket.timeout)
+
 
 class FtpUtil:
     @staticmethod
@@ -45,7 +70,29 @@ class FtpUtil:
             session.cwd(curr_path)
 
     @staticmethod
-    def make_dirs(session, remote_dir):
+    def make_dirs(session, remote_dir, known_dirs=None):
+        '''
+        make the remote directory and its missing parents
+        :param known_dirs: set of directories known to exist, they are not probed; the directories found or made are added
+        :return: whether remote_dir was made
+        '''
+        if known_dirs is None:
+            known_dirs = set()
+        if remote_dir in known_dirs:
+            return False
+        parent = os.path.dirname(remote_dir)
+        if parent != remote_dir and parent in known_dirs:
+            # one MKD under a known parent, it fails when the directory exists
+            try:
+                session.mkd(remote_dir)
+                logger.debug('create dir: %s' % remote_dir)
+                created = True
+            except error_perm:
+                if not FtpUtil.isdir(session, remote_dir):
+                    raise
+                created = False
+            known_dirs.add(remote_dir)
+            return created
         path_list = []
         # current = Path(remote_dir)
         # parent = current.parent
@@ -57,113 +104,601 @@ class FtpUtil:
             current = parent
             # parent = current.parent
             parent = os.path.dirname(current)
+        # usually the whole path exists already, one probe instead of one per level
+        if FtpUtil.isdir(session, remote_dir):
+            known_dirs.update('%s' % path for path in path_list)
+            return False
+        created = False
         for path in reversed(path_list):
             path_str = '%s' % path
-            if not FtpUtil.isdir(session, path_str):
+            if path_str in known_dirs:
+                continue
+            created = not FtpUtil.isdir(session, path_str)
+            if created:
                 session.mkd('%s' % path_str)
                 logger.debug('create dir: %s' % path_str)
-        pass
+            known_dirs.add(path_str)
+        return created
 
     @staticmethod
-    def upload_file(session, local_filename, remote_filename):
-        logger.debug('Upload(%s Byte): %s To: %s' % (os.path.getsize(local_filename), local_filename, remote_filename))
+    def upload_file(session, local_filename, remote_filename, known_dirs=None, offset=0):
+        '''
+        :param offset: resume position, the local file is sent from there with REST offset + STOR
+        '''
+        logger.debug('Upload(%s Byte from %s): %s To: %s' % (os.path.getsize(local_filename), offset, local_filename, remote_filename))
         # FtpUtil.make_dirs(session, Path(remote_filename).parent)
-        FtpUtil.make_dirs(session, os.path.dirname(remote_filename))
+        FtpUtil.make_dirs(session, os.path.dirname(remote_filename), known_dirs)
         fh = open(local_filename, 'rb')
-        session.storbinary('STOR %s' % remote_filename, fh)
+        fh.seek(offset)
+        start = time.time()
+        session.storbinary('STOR %s' % remote_filename, fh, blocksize=_block_size(session), rest=offset or None)
+        _log_transfer('Upload', fh.tell() - offset, start, remote_filename)
         fh.close()
 
     @staticmethod
-    def download_file(session, remote_filename, local_filename):
-        logger.debug('Download(%s Byte): %s To: %s' % (session.size(remote_filename), remote_filename, local_filename))
-        fh = open(local_filename, 'wb')
-        session.retrbinary('RETR ' + remote_filename, fh.write)
+    def upload_fileobj(session, fh, remote_filename, known_dirs=None):
+        FtpUtil.make_dirs(session, os.path.dirname(remote_filename), known_dirs)
+        sent = [0]
+
+        def count(block):
+            sent[0] += len(block)
+        session.storbinary('STOR %s' % remote_filename, fh, blocksize=_block_size(session), callback=count)
+        return sent[0]
+
+    @staticmethod
+    def download_file(session, remote_filename, local_filename, offset=0):
+        '''
+        :param offset: resume position, REST offset + RETR, appended to the local file
+        '''
+        logger.debug('Download(from %s Byte): %s To: %s' % (offset, remote_filename, local_filename))
+        fh = open(local_filename, 'ab' if offset else 'wb')
+        start = time.time()
+        session.retrbinary('RETR ' + remote_filename, fh.write, blocksize=_block_size(session), rest=offset or None)
+        _log_transfer('Download', fh.tell() - offset, start, remote_filename)
         fh.close()
 
     @staticmethod
-    def upload_dir(session, local_dir, remote_dir):
-        FtpUtil.make_dirs(session, remote_dir)
+    def list_entries(session, remote_dir):
+        '''
+        list a remote directory, MLSD returns the type, size and modify time of each entry at once;
+        servers without MLSD are listed with NLST and each entry is probed
+        :return: {name: {'type': 'file' or 'dir', 'size': bytes or None, 'modify': 'YYYYMMDDHHMMSS' or None}}
+        '''
+        entries = {}
+        try:
+            for name, facts in session.mlsd(remote_dir, facts=['type', 'size', 'modify']):
+                kind = facts.get('type', '').lower()
+                if kind not in ('file', 'dir'):   # cdir, pdir, links
+                    continue
+                size = facts.get('size')
+                entries[name] = {'type': kind, 'size': int(size) if size is not None else None, 'modify': facts.get('modify')}
+            return entries
+        except error_perm as e:
+            if not str(e)[:3] in ('500', '501', '502'):
+                raise
+        for path in session.nlst(remote_dir):
+            name = os.path.basename(path)
+            pathname = os.path.join(remote_dir, name)
+            if FtpUtil.isdir(session, pathname):
+                entries[name] = {'type': 'dir', 'size': None, 'modify': None}
+            else:
+                entries[name] = {'type': 'file', 'size': session.size(pathname), 'modify': None}
+        return entries
+
+    @staticmethod
+    def parse_modify(value):
+        '''
+        MLSD/MDTM modify time (UTC, YYYYMMDDHHMMSS[.sss]) to a timestamp, None when missing
+        '''
+        if not value:
+            return None
+        return calendar.timegm(time.strptime(value[:14], '%Y%m%d%H%M%S'))
+
+    @staticmethod
+    def upload_dir(session, local_dir, remote_dir, known_dirs=None):
+        FtpUtil.make_dirs(session, remote_dir, known_dirs)
         for f in os.listdir(local_dir):
             local_path = os.path.join(local_dir, f)
             remote_path = os.path.join(remote_dir, f)
             if os.path.isfile(local_path):
-                FtpUtil.upload_file(session, local_path, remote_path)
+                FtpUtil.upload_file(session, local_path, remote_path, known_dirs)
             elif os.path.isdir(local_path):
-                FtpUtil.upload_dir(session, local_path, remote_path)
+                FtpUtil.upload_dir(session, local_path, remote_path, known_dirs)
 
     @staticmethod
     def download_dir(session, remote_dir, local_dir):
         if not os.path.exists(local_dir):
             os.makedirs(local_dir, exist_ok=True)
-        for remote_path in session.nlst(remote_dir):
+        for name, facts in FtpUtil.list_entries(session, remote_dir).items():
             # local_path = os.path.join(local_dir, Path(remote_path).name)
-            local_path = os.path.join(local_dir, os.path.basename(remote_path))
-            if FtpUtil.isdir(session, remote_path):
+            remote_path = os.path.join(remote_dir, name)
+            local_path = os.path.join(local_dir, name)
+            if facts['type'] == 'dir':
                 FtpUtil.download_dir(session, remote_path, local_path)
-            elif FtpUtil.isfile(session, remote_path):
+            else:
                 FtpUtil.download_file(session, remote_path, local_path)
 
 
 class FtpService(object):
-    def __init__(self, host, port, username, password):
+    # Keeps one logged-in session and reuses it for every call, instead of
+    # a login per file. Used as a context manager the session is closed on
+    # exit, otherwise by close(). A session idle for more than keepalive
+    # seconds is checked with NOOP before use, and a command that fails
+    # because the connection dropped is retried once after a new login.
+    # Remote directories known to exist are cached in known_dirs, so
+    # make_dirs does not probe them again. Calls are serialized by a lock,
+    # one service may be shared by the pipeline threads. Directories are
+    # transferred by FtpTransfer over `connections` sessions.
+    # Transfers use passive or active mode, block_size bytes per block and
+    # a socket timeout (None: no timeout), tls logs in over FTPS with an
+    # encrypted data channel. In active mode a data connection that cannot
+    # be opened (425, or the server never connects back within the timeout)
+    # switches the service to passive mode for good when fallback is on.
+    def __init__(self, host, port, username, password, keepalive=60, connections=4,
+                 passive=False, block_size=8192, timeout=None, tls=False, fallback=True):
         self.host = host
         self.port = port
         self.username = username
         self.password = password
-        pass
+        self.keepalive = keepalive
+        self.connections = connections
+        self.passive = passive
+        self.block_size = block_size
+        self.timeout = timeout
+        self.tls = tls
+        self.fallback = fallback
+        self.session = None
+        self.last_used = 0
+        self.known_dirs = set()
+        self.lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    @classmethod
+    def from_settings(cls, settings):
+        '''
+        :param settings: FTP_SETTINGS
+        '''
+        return cls(settings.get('HOST'), settings.get('PORT', 21), settings.get('USERNAME'), settings.get('PASSWORD'),
+                   keepalive=settings.get('KEEPALIVE', 60),
+                   connections=settings.get('CONNECTIONS', 4),
+                   passive=settings.get('PASSIVE', False),
+                   block_size=settings.get('BLOCK_SIZE', 8192),
+                   timeout=settings.get('TIMEOUT'),
+                   tls=settings.get('TLS', False),
+                   fallback=settings.get('PASSIVE_FALLBACK', True))
+
+    def clone(self):
+        '''
+        a new FtpService of the same server and account with its own session, keeping the active/passive mode
+        '''
+        return FtpService(self.host, self.port, self.username, self.password, self.keepalive, self.connections,
+                          self.passive, self.block_size, self.timeout, self.tls, self.fallback)
 
     def connect(self):
-        ftp = FTP(self.host)
+        ftp_class = FTP_TLS if self.tls else FTP
+        ftp = ftp_class() if self.timeout is None else ftp_class(timeout=self.timeout)
         ftp.connect(self.host, self.port)
-        ftp.set_pasv(False)
         ftp.encoding = 'utf-8'
         ret = ftp.login(self.username, self.password)
-        logger.debug('login: %s' % ret)
+        if self.tls:
+            ftp.prot_p()
+        ftp.set_pasv(self.passive)
+        ftp.block_size = self.block_size
+        logger.debug('login: %s (%s, block size %s%s)' % (ret, 'passive' if self.passive else 'active',
+                                                          self.block_size, ', tls' if self.tls else ''))
         return ftp
 
+    def get_session(self):
+        '''
+        the logged in session, logs in again when there is none or the NOOP of an idle session fails
+        '''
+        with self.lock:
+            if self.session is not None and time.time() - self.last_used > self.keepalive:
+                try:
+                    self.session.voidcmd('NOOP')
+                except _RECONNECT_ERRORS as e:
+                    logger.info('ftp session expired: %s' % e)
+                    self.drop()
+            if self.session is None:
+                self.session = self.connect()
+            self.last_used = time.time()
+            return self.session
+
+    def drop(self):
+        # the connection is gone, close the socket without QUIT
+        with self.lock:
+            if self.session is not None:
+                self.session.close()
+            self.session = None
+
+    def close(self):
+        with self.lock:
+            if self.session is not None:
+                try:
+                    self.session.quit()
+                except all_errors:
+                    pass
+            self.drop()
+
+    def call(self, func, *args):
+        '''
+        run func(session, *args), once more after logging in again when the connection was lost
+        '''
+        with self.lock:
+            for attempt in (1, 2):
+                session = self.get_session()
+                try:
+                    result = func(session, *args)
+                    self.last_used = time.time()
+                    return result
+                except _RECONNECT_ERRORS as e:
+                    self.drop()
+                    fall_back = not self.passive and self.fallback and _is_data_connection_error(e)
+                    if fall_back:
+                        logger.warning('active mode data connection failed (%s), switching to passive mode' % e)
+                        self.passive = True
+                    if attempt == 2:
+                        raise
+                    if not fall_back:
+                        logger.warning('ftp connection lost (%s), reconnecting' % e)
+
     def list_dir(self, parent_path):
         try:
-            ftp = self.connect()
-            return ftp.nlst(parent_path)
+            return self.call(lambda session: session.nlst(parent_path))
         except Exception as e:
             logger.exception('failed to get_file_list: %s' % parent_path)
-        finally:
-            ftp.close()
 
     def make_dir(self, path):
         try:
-            ftp = self.connect()
-            if not FtpUtil.exists(ftp, path):
-                ftp.mkd(path)
+            self.call(FtpUtil.make_dirs, path, self.known_dirs)
         except Exception as e:
             logger.exception('failed to make_dir: [%s]' % path)
-        finally:
-            ftp.close()
 
     def upload(self, local_path, remote_path):
         try:
-            session = self.connect()
             if os.path.isfile(local_path):
-                FtpUtil.upload_file(session, local_path, remote_path)
+                self.call(FtpUtil.upload_file, local_path, remote_path, self.known_dirs)
             elif os.path.isdir(local_path):
-                FtpUtil.upload_dir(session, local_path, remote_path)
+                self.upload_tree(local_path, remote_path)
             else:
                 logger.error('not find: %s to upload' % local_path)
         except Exception as e:
             logger.exception('failed to upload from [%s] to [%s]' % (local_path, remote_path))
-        finally:
-            session.close()
+
+    def upload_stream(self, fh, remote_path):
+        '''
+        upload the content of a file object, without a local file
+        :return: bytes sent, None on failure
+        '''
+        position = fh.tell()
+
+        def send(session):
+            # a retry after reconnecting sends the content from the start again
+            fh.seek(position)
+            return FtpUtil.upload_fileobj(session, fh, remote_path, self.known_dirs)
+        try:
+            start = time.time()
+            sent = self.call(send)
+            elapsed = max(time.time() - start, 1e-6)
+            logger.info('Upload(%s Byte) To: %s in %.2fs, %.1f KB/s' % (sent, remote_path, elapsed, sent / 1024.0 / elapsed))
+            return sent
+        except Exception as e:
+            logger.exception('failed to upload stream to [%s]' % remote_path)
 
     def download(self, remote_path, local_path):
         try:
-            session = self.connect()
-            if FtpUtil.isdir(session, remote_path):
-                FtpUtil.download_dir(session, remote_path, local_path)
-            elif FtpUtil.isfile(session, remote_path):
-                FtpUtil.download_file(session, remote_path, local_path)
+            if self.call(FtpUtil.isdir, remote_path):
+                self.download_tree(remote_path, local_path)
+            elif self.call(FtpUtil.isfile, remote_path):
+                self.call(FtpUtil.download_file, remote_path, local_path)
             else:
                 logger.error('not find: %s to download' % remote_path)
         except Exception as e:
             logger.exception('failed to download from [%s] to [%s]' % (remote_path, local_path))
+
+    def upload_tree(self, local_dir, remote_dir, connections=None, resume=True):
+        '''
+        upload a local directory over parallel connections, see FtpTransfer
+        :return: stats, see FtpTransfer.run
+        '''
+        return FtpTransfer(self, connections or self.connections, resume).upload_tree(local_dir, remote_dir)
+
+    def download_tree(self, remote_dir, local_dir, connections=None, resume=True):
+        '''
+        download a remote directory over parallel connections, see FtpTransfer
+        :return: stats, see FtpTransfer.run
+        '''
+        return FtpTransfer(self, connections or self.connections, resume).download_tree(remote_dir, local_dir)
+
+    def sync(self, local_dir, remote_dir, direction='upload', checksum=False, dry_run=False, connections=None):
+        '''
+        incremental directory sync, only the files that differ are sent, see FtpSync
+        :param direction: upload local to remote, download remote to local
+        :param checksum: compare sha1 with the manifest in the remote root (FtpSync.MANIFEST_NAME)
+        :param dry_run: only count the files to send, nothing is sent or changed on the remote
+        :return: stats, see FtpTransfer.run
+        '''
+        transfer = FtpSync(self, connections or self.connections, checksum, dry_run)
+        if direction == 'upload':
+            return transfer.upload_tree(local_dir, remote_dir)
+        if direction == 'download':
+            return transfer.download_tree(remote_dir, local_dir)
+        raise ValueError('unknown sync direction: %s' % direction)
+
+
+class FtpTransfer(object):
+    # Transfers a directory tree over several connections. The tree is
+    # listed on the service's own session, one MLSD per directory gives the
+    # type, size and mtime of every entry, then the files are spread over
+    # `connections` threads, each with a session of its own (service.clone).
+    # plan() decides per file: with resume, a target shorter than its source
+    # is continued from its size (REST), a target of the same size is taken
+    # as complete and skipped, anything else is transferred from the start.
+    # Downloaded files get the remote mtime.
+    ignored = ()
+
+    def __init__(self, service, connections=4, resume=True):
+        self.service = service
+        self.connections = max(int(connections), 1)
+        self.resume = resume
+        self.remote_root = None
+        self.mtimes = {}
+        self.local = threading.local()
+        self.sessions = []
+        self.sessions_lock = threading.Lock()
+
+    def worker(self):
+        # the FtpService of the current transfer thread
+        service = getattr(self.local, 'service', None)
+        if service is None:
+            service = self.service.clone()
+            self.local.service = service
+            with self.sessions_lock:
+                self.sessions.append(service)
+        return service
+
+    def plan(self, local_path, remote_path, source, target):
+        '''
+        :param source: {'size': bytes, 'modify': timestamp} of the source file, target: of the target file, None when missing
+        :return: resume position, 0 sends the whole file, None when the target is complete
+        '''
+        source_size, target_size = source['size'], target and target['size']
+        if not self.resume or target_size is None or source_size is None or target_size > source_size:
+            return 0
+        if target_size == source_size:
+            return None
+        return target_size
+
+    @staticmethod
+    def local_facts(path):
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        return {'size': stat.st_size, 'modify': stat.st_mtime}
+
+    @staticmethod
+    def remote_facts(entry):
+        if entry is None or entry['type'] != 'file':
+            return None
+        return {'size': entry['size'], 'modify': FtpUtil.parse_modify(entry['modify'])}
+
+    def remote_entries(self, remote_dir):
+        '''
+        make the remote directory and list it, a directory made just now is empty
+        '''
+        created = self.service.call(FtpUtil.make_dirs, remote_dir, self.service.known_dirs)
+        # nothing to resume in a directory made just now
+        entries = self.service.call(FtpUtil.list_entries, remote_dir) if self.resume and not created else {}
+        # the subdirectories in the listing exist, make_dirs does not probe them
+        self.service.known_dirs.update(os.path.join(remote_dir, name) for name in entries if entries[name]['type'] == 'dir')
+        return entries
+
+    def upload_tree(self, local_dir, remote_dir):
+        self.remote_root = remote_dir
+        jobs = []
+        for parent, dirs, files in os.walk(local_dir):
+            dirs.sort()
+            relative = os.path.relpath(parent, local_dir)
+            target_dir = remote_dir if relative == '.' else os.path.join(remote_dir, relative).replace('\\', '/')
+            existing = self.remote_entries(target_dir)
+            for name in sorted(files):
+                if name in self.ignored:
+                    continue
+                local_path = os.path.join(parent, name)
+                remote_path = os.path.join(target_dir, name)
+                source = self.local_facts(local_path)
+                jobs.append((local_path, remote_path, source['size'],
+                             self.plan(local_path, remote_path, source, self.remote_facts(existing.get(name)))))
+        return self.run('upload', jobs, self.upload_one)
+
+    def upload_one(self, local_path, remote_path, offset):
+        # the directories were made by upload_tree, known_dirs skips the probes
+        self.worker().call(FtpUtil.upload_file, local_path, remote_path, self.service.known_dirs, offset)
+
+    def walk_remote(self, remote_dir):
+        '''
+        :return: [(relative directory, list_entries of it)], listed level by level
+        '''
+        listing = []
+        pending = ['']
+        while pending:
+            relative = pending.pop(0)
+            entries = self.service.call(FtpUtil.list_entries, os.path.join(remote_dir, relative) if relative else remote_dir)
+            listing.append((relative, entries))
+            pending.extend(os.path.join(relative, name) for name in sorted(entries) if entries[name]['type'] == 'dir')
+        return listing
+
+    def make_local_dir(self, path):
+        os.makedirs(path, exist_ok=True)
+
+    def download_tree(self, remote_dir, local_dir):
+        self.remote_root = remote_dir
+        jobs = []
+        for relative, entries in self.walk_remote(remote_dir):
+            parent = os.path.join(local_dir, relative)
+            self.make_local_dir(parent)
+            for name in sorted(entries):
+                source = self.remote_facts(entries[name])
+                if source is None or name in self.ignored:
+                    continue
+                local_path = os.path.join(parent, name)
+                remote_path = os.path.join(remote_dir, relative, name) if relative else os.path.join(remote_dir, name)
+                self.mtimes[local_path] = source['modify']
+                jobs.append((remote_path, local_path, source['size'],
+                             self.plan(local_path, remote_path, source, self.local_facts(local_path))))
+        return self.run('download', jobs, self.download_one)
+
+    def download_one(self, remote_path, local_path, offset):
+        self.worker().call(FtpUtil.download_file, remote_path, local_path, offset)
+        if self.mtimes.get(local_path) is not None:
+            os.utime(local_path, (self.mtimes[local_path], self.mtimes[local_path]))
+
+    def run(self, action, jobs, transfer):
+        '''
+        :param jobs: [(source, target, source size, offset)]
+        :return: {'files': files sent, 'resumed': of them resumed, 'bytes': bytes sent,
+                  'skipped': files skipped, 'skipped_bytes': bytes skipped, 'failed': source paths that failed}
+        '''
+        stats = {'files': 0, 'resumed': 0, 'bytes': 0, 'skipped': 0, 'skipped_bytes': 0, 'failed': []}
+        start = time.time()
+        todo = []
+        for source, target, size, offset in jobs:
+            if offset is None:
+                stats['skipped'] += 1
+                stats['skipped_bytes'] += size or 0
+            else:
+                todo.append((source, target, size, offset))
+        try:
+            with ThreadPoolExecutor(max_workers=self.connections) as executor:
+                futures = [(executor.submit(transfer, source, target, offset), source, size, offset) for source, target, size, offset in todo]
+                for future, source, size, offset in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.exception('failed to %s [%s]' % (action, source))
+                        stats['failed'].append(source)
+                        continue
+                    stats['files'] += 1
+                    stats['resumed'] += 1 if offset else 0
+                    stats['bytes'] += (size or 0) - offset
         finally:
-            session.close()
+            for service in self.sessions:
+                service.close()
+        logger.info('%s: %s files, %s Byte (%s resumed, %s failed), skipped %s files, %s Byte in %.2fs over %s connections' % (
+            action, stats['files'], stats['bytes'], stats['resumed'], len(stats['failed']), stats['skipped'],
+            stats['skipped_bytes'], time.time() - start, self.connections))
+        return stats
+
+
+class FtpSync(FtpTransfer):
+    # Transfers only the files that differ between the two trees. A file is
+    # unchanged when the sizes match and the target is not older than the
+    # source (local mtime against MLSD modify, a download gets the remote
+    # mtime). With checksum, the sha1 in the manifest (MANIFEST_NAME in the
+    # remote root, written after each upload) decides instead of the mtime,
+    # so a regenerated file with the same content is skipped. Without an
+    # mtime (no MLSD) a file of the same size is sent again. dry_run only
+    # lists: no transfer, no remote directory, no manifest.
+    MANIFEST_NAME = '.sync_manifest.json'
+    ignored = (MANIFEST_NAME,)
+
+    def __init__(self, service, connections=4, checksum=False, dry_run=False):
+        FtpTransfer.__init__(self, service, connections, resume=True)
+        self.checksum = checksum
+        self.dry_run = dry_run
+        self.manifest = {}
+        self.hashes = {}
+
+    @staticmethod
+    def file_hash(path):
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as fh:
+            for block in iter(lambda: fh.read(1 << 20), b''):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+    def manifest_key(self, remote_path):
+        return os.path.relpath(remote_path, self.remote_root).replace('\\', '/')
+
+    def local_hash(self, local_path):
+        if local_path not in self.hashes:
+            self.hashes[local_path] = self.file_hash(local_path)
+        return self.hashes[local_path]
+
+    def plan(self, local_path, remote_path, source, target):
+        if target is None or target['size'] != source['size']:
+            return 0
+        entry = self.manifest.get(self.manifest_key(remote_path))
+        if self.checksum and entry and entry['size'] == source['size']:
+            return None if entry['sha1'] == self.local_hash(local_path) else 0
+        if source['modify'] is None or target['modify'] is None:
+            return 0
+        # MLSD has whole seconds
+        return None if target['modify'] >= int(source['modify']) else 0
+
+    def remote_entries(self, remote_dir):
+        if not self.dry_run:
+            return FtpTransfer.remote_entries(self, remote_dir)
+        try:
+            return self.service.call(FtpUtil.list_entries, remote_dir)
+        except error_perm:
+            return {}   # not created yet
+
+    def make_local_dir(self, path):
+        if not self.dry_run:
+            FtpTransfer.make_local_dir(self, path)
+
+    def load_manifest(self):
+        buf = io.BytesIO()
+        try:
+            self.service.call(lambda session: session.retrbinary('RETR %s' % os.path.join(self.remote_root, self.MANIFEST_NAME), buf.write))
+        except error_perm:
+            return {}   # first sync
+        return json.loads(buf.getvalue().decode('utf-8'))
+
+    def upload_tree(self, local_dir, remote_dir):
+        self.remote_root = remote_dir
+        if self.checksum:
+            self.manifest = self.load_manifest()
+        stats = FtpTransfer.upload_tree(self, local_dir, remote_dir)
+        if self.checksum and not self.dry_run:
+            self.save_manifest(local_dir, stats['failed'])
+        return stats
+
+    def save_manifest(self, local_dir, failed):
+        for parent, dirs, files in os.walk(local_dir):
+            for name in files:
+                local_path = os.path.join(parent, name)
+                if name in self.ignored or local_path in failed:
+                    continue
+                key = os.path.relpath(local_path, local_dir).replace('\\', '/')
+                self.manifest[key] = {'size': os.path.getsize(local_path), 'sha1': self.local_hash(local_path)}
+        body = io.BytesIO(json.dumps(self.manifest, indent=1, sort_keys=True).encode('utf-8'))
+        self.service.call(FtpUtil.upload_fileobj, body, os.path.join(self.remote_root, self.MANIFEST_NAME), self.service.known_dirs)
+
+    def download_tree(self, remote_dir, local_dir):
+        self.remote_root = remote_dir
+        if self.checksum:
+            self.manifest = self.load_manifest()
+        return FtpTransfer.download_tree(self, remote_dir, local_dir)
+
+    def run(self, action, jobs, transfer):
+        if not self.dry_run:
+            return FtpTransfer.run(self, action, jobs, transfer)
+        stats = {'files': 0, 'resumed': 0, 'bytes': 0, 'skipped': 0, 'skipped_bytes': 0, 'failed': []}
+        for source, target, size, offset in jobs:
+            if offset is None:
+                stats['skipped'] += 1
+                stats['skipped_bytes'] += size or 0
+            else:
+                logger.info('dry run, would %s [%s] to [%s]' % (action, source, target))
+                stats['files'] += 1
+                stats['bytes'] += size or 0
+        logger.info('dry run %s: %s files, %s Byte, skipped %s files, %s Byte' % (
+            action, stats['files'], stats['bytes'], stats['skipped'], stats['skipped_bytes']))
+        return stats
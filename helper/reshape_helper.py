@@ -0,0 +1,99 @@
+# coding=utf8
+import numpy as np
+import pandas as pd
+
+MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+
+
+def month_number(label):
+    '''
+    月份列名转月份数字, 只看前三个字母: JAN/Jan/JUNE/Jun 22 -> 1/1/6/6
+    :param label: 列名
+    :return: 1-12, 不是月份时抛ValueError
+    '''
+    key = str(label).strip()[0:3].upper()
+    if key not in MONTHS:
+        raise ValueError('not a month column: %s' % label)
+    return MONTHS.index(key) + 1
+
+
+def month_labels(columns, year):
+    '''
+    月份列名转DATADATE字符串, ['JAN', 'FEB'], 2022 -> ['2022-1', '2022-2']
+    '''
+    return ['%s-%s' % (year, month_number(c)) for c in columns]
+
+
+def trim_header(df_hor, header):
+    '''
+    去掉最后两列, 用header列等于header的那一行(年份行)把月份列名改为'年-月', 并删除该行
+    :param df_hor: read_tables的表格, 列名为Jan, Feb...
+    :param header: 维度列名
+    '''
+    df = df_hor.iloc[:, :-2]
+    is_year_row = df[header] == header
+    month_to_year = df[is_year_row].iloc[0, 1:]
+    df = df[~is_year_row]
+    columns = []
+    for c in df.columns:
+        if c in month_to_year.index:
+            columns.append('%s-%s' % (int(month_to_year[c]), month_number(c)))
+        else:
+            columns.append(c)
+    df.columns = columns
+    return df
+
+
+def _long_frame(data, columns):
+    df = pd.DataFrame(data, columns=columns)
+    # same dtypes as a frame built from a list of dicts
+    return df.infer_objects()
+
+
+def wide_to_long(df_hor, header, dates=None):
+    '''
+    宽表转长表, 每行的每个值一条记录, 记录顺序与逐行逐列遍历相同
+    :param df_hor: 第一列为header的宽表, 其余列为各月的值
+    :param header: 维度列名
+    :param dates: 其余各列对应的DATADATE, 默认为列名
+    :return: DataFrame[header, DATADATE, VALUE]
+    '''
+    value_columns = [c for c in df_hor.columns if c != header]
+    if dates is None:
+        dates = value_columns
+    rows, cols = len(df_hor), len(value_columns)
+    values = df_hor[value_columns].to_numpy()
+    return _long_frame({
+        header: np.repeat(df_hor[header].to_numpy(), cols),
+        'DATADATE': np.tile(np.asarray(dates, dtype=object), rows),
+        'VALUE': values.reshape(rows * cols),
+    }, [header, 'DATADATE', 'VALUE'])
+
+
+def _split_section(title):
+    # PRODUCTION (TONNES)/CLOSING STOCK (TONNES)/PRICE (1% OER EQUIVALENT) -> category, unit
+    title = str(title).strip()
+    return title[0:title.index('(')].strip(), title[title.index('(')+1:title.index(')')].strip()
+
+
+def sectioned_wide_to_long(df_hor, header):
+    '''
+    分段的宽表转长表: 第二列为空或与第一列相同的行是段标题, 如PRODUCTION (TONNES),
+    其后各行属于该段, 段标题拆为CATEGORY和UNIT
+    :param df_hor: 第一列为header的宽表, 其余列名为DATADATE
+    :param header: 维度列名, 其值记为PRODUCT
+    :return: DataFrame[CATEGORY, PRODUCT, DATADATE, VALUE, UNIT]
+    '''
+    first, second = df_hor.iloc[:, 0].to_numpy(), df_hor.iloc[:, 1]
+    is_title = second.isnull().to_numpy() | (first == second.to_numpy())
+    title_rows = np.flatnonzero(is_title)
+    sections = [_split_section(first[i]) for i in title_rows]
+    categories = np.array([None] + [c for c, _ in sections], dtype=object)
+    units = np.array([None] + [u for _, u in sections], dtype=object)
+    # 1 + index of the last title row above each data row, 0 before the first title
+    section = np.searchsorted(title_rows, np.flatnonzero(~is_title), side='right')
+    df = wide_to_long(df_hor[~is_title], header)
+    cols = len(df_hor.columns) - 1
+    df.insert(0, 'CATEGORY', np.repeat(categories[section], cols))
+    df['UNIT'] = np.repeat(units[section], cols)
+    return df.rename(columns={header: 'PRODUCT'})
@@ -0,0 +1,113 @@
+# coding=utf8
+'''
+pipeline的入库后端, 由settings.STORAGE_BACKEND选择
+后端接收以主键为索引的DataFrame, 按主键新增或更新目标表
+'''
+import os
+import pandas as pd
+from helper.database_helper import merge_db_oracle_dataframe, merge_db_mysql, merge_db_sqlite_dataframe, dataframe_to_binds
+
+
+class StorageBackend(object):
+    '''
+    入库后端的接口, 每个pipeline一个实例, store在线程池中调用
+    '''
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings)
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    def store(self, df, table):
+        '''
+        按主键新增或更新
+        :param df: 以主键为索引的DataFrame
+        :param table: 目标表
+        :return: 写入的行数, 或MergeResult
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class OracleBackend(StorageBackend):
+    '''
+    DATABASE_URI, 经临时表一次MERGE, 只写有变化的行, MPOB_MERGE_MODE为'auto'时空表直接路径批量插入
+    '''
+
+    def __init__(self, settings):
+        super(OracleBackend, self).__init__(settings)
+        self.conn = settings.get('DATABASE_URI')
+        self.mode = settings.get('MPOB_MERGE_MODE')
+        self.rebuild_indexes = settings.getbool('MPOB_BULK_REBUILD_INDEXES', False)
+
+    def store(self, df, table):
+        return merge_db_oracle_dataframe(df, table, self.conn, istmp=True, diff=True,
+                                         mode=self.mode, rebuild_indexes=self.rebuild_indexes)
+
+
+class MysqlBackend(StorageBackend):
+    '''
+    MYSQL_SETTINGS(pymysql.connect的参数), REPLACE INTO, 表需已建好主键
+    '''
+
+    def __init__(self, settings):
+        super(MysqlBackend, self).__init__(settings)
+        self.conn = settings.getdict('MYSQL_SETTINGS')
+
+    def store(self, df, table):
+        # a frame without keys has a RangeIndex, which is not a column of the table
+        df = df.reset_index(drop=all(name is None for name in df.index.names))
+        cols = list(df.columns)
+        datas = [dict(zip(cols, row)) for row in dataframe_to_binds(df, cols)]
+        if datas:
+            merge_db_mysql(datas, table, self.conn)
+        return len(datas)
+
+
+class SqliteBackend(StorageBackend):
+    '''
+    SQLITE_PATH(默认TEMP_DATA_DIR/mpob.db), merge_db_sqlite_dataframe按主键upsert
+    连接在进程内共用, 由DatabasePoolExtension关闭
+    '''
+
+    def __init__(self, settings):
+        super(SqliteBackend, self).__init__(settings)
+        self.path = settings.get('SQLITE_PATH') or os.path.join(settings.get('TEMP_DATA_DIR'), 'mpob.db')
+
+    def store(self, df, table):
+        return merge_db_sqlite_dataframe(df, table, self.path)
+
+
+class ParquetBackend(StorageBackend):
+    '''
+    PARQUET_DIR(默认TEMP_DATA_DIR/parquet)/<table>/YEAR=<年份>/data.parquet, 按DATADATE的年份分区
+    写入时与分区中已有的行合并, 主键相同时保留新行, 没有主键时只去掉完全相同的行
+    需要可选依赖pyarrow, 见requirements.txt
+    '''
+
+    def __init__(self, settings):
+        super(ParquetBackend, self).__init__(settings)
+        # missing pyarrow fails when the pipeline is created, not at the merge after the crawl
+        import pyarrow
+        self.dir = settings.get('PARQUET_DIR') or os.path.join(settings.get('TEMP_DATA_DIR'), 'parquet')
+
+    def store(self, df, table):
+        keys = [name for name in df.index.names if name is not None]
+        df = df.reset_index(drop=not keys)
+        years = df['DATADATE'].dt.year if 'DATADATE' in df.columns else pd.Series(0, index=df.index)
+        for year, part in df.groupby(years):
+            part_dir = os.path.join(self.dir, table, 'YEAR=%s' % year)
+            path = os.path.join(part_dir, 'data.parquet')
+            if os.path.exists(path):
+                part = pd.concat([pd.read_parquet(path), part], ignore_index=True)
+                part = part.drop_duplicates(subset=keys or None, keep='last')
+            elif not os.path.exists(part_dir):
+                os.makedirs(part_dir)
+            tmp_path = path + '.tmp'
+            part.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+        return len(df)
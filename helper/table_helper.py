@@ -0,0 +1,125 @@
+# coding=utf8
+import re
+from pandas.io.parsers import TextParser
+from pandas.errors import EmptyDataError
+
+_RE_WHITESPACE = re.compile(r'[\r\n]+|\s{2,}')
+_RE_HIDDEN = re.compile(r'display:\s*none')
+_RE_MATCH = re.compile(r'.+')
+
+
+def _hidden(element):
+    return bool(_RE_HIDDEN.search(element.get('style') or ''))
+
+
+def _is_text_node(element):
+    # comments and processing instructions have a function as tag
+    return isinstance(element.tag, str)
+
+
+def _texts(element):
+    if element.text and element.tag != 'style':
+        yield element.text
+    for child in element:
+        if _is_text_node(child) and not _hidden(child) and child.tag != 'style':
+            for text in _texts(child):
+                yield text
+        if child.tail:
+            yield child.tail
+
+
+def _cell_text(element):
+    return _RE_WHITESPACE.sub(' ', ''.join(_texts(element)).strip())
+
+
+def _cells(row):
+    return [c for c in row if c.tag in ('td', 'th') and not _hidden(c)]
+
+
+def _rows(table, path):
+    return [r for r in table.xpath(path) if not _hidden(r)]
+
+
+def _expand_spans(rows):
+    '''
+    展开colspan/rowspan, 合并单元格的文本在其覆盖的每个位置重复
+    '''
+    all_texts = []
+    remainder = []  # (index, text, rows left) of cells spanning from the rows above
+    for row in rows:
+        texts = []
+        next_remainder = []
+        index = 0
+        for cell in _cells(row):
+            while remainder and remainder[0][0] <= index:
+                prev_index, prev_text, prev_rowspan = remainder.pop(0)
+                texts.append(prev_text)
+                if prev_rowspan > 1:
+                    next_remainder.append((prev_index, prev_text, prev_rowspan - 1))
+                index += 1
+            text = _cell_text(cell)
+            rowspan = int(cell.get('rowspan') or 1)
+            colspan = int(cell.get('colspan') or 1)
+            for _ in range(colspan):
+                texts.append(text)
+                if rowspan > 1:
+                    next_remainder.append((index, text, rowspan - 1))
+                index += 1
+        for prev_index, prev_text, prev_rowspan in remainder:
+            texts.append(prev_text)
+            if prev_rowspan > 1:
+                next_remainder.append((prev_index, prev_text, prev_rowspan - 1))
+        all_texts.append(texts)
+        remainder = next_remainder
+    while remainder:
+        next_remainder = []
+        texts = []
+        for prev_index, prev_text, prev_rowspan in remainder:
+            texts.append(prev_text)
+            if prev_rowspan > 1:
+                next_remainder.append((prev_index, prev_text, prev_rowspan - 1))
+        all_texts.append(texts)
+        remainder = next_remainder
+    return all_texts
+
+
+def table_rows(table):
+    '''
+    表格的单元格文本, thead, tbody, tfoot依次排列, 各行补齐到相同长度
+    没有thead时, 顶部全为<th>的行作为表头
+    :param table: lxml的<table>元素
+    '''
+    header_rows = _rows(table, './thead/tr')
+    body_rows = _rows(table, './tbody/tr | ./tr')
+    footer_rows = _rows(table, './tfoot/tr')
+    if not header_rows:
+        while body_rows and all(c.tag == 'th' for c in _cells(body_rows[0])):
+            header_rows.append(body_rows.pop(0))
+    rows = _expand_spans(header_rows) + _expand_spans(body_rows) + _expand_spans(footer_rows)
+    width = max([len(r) for r in rows] or [0])
+    for r in rows:
+        r.extend([''] * (width - len(r)))
+    return rows
+
+
+def read_tables(selector, header=0):
+    '''
+    从scrapy已解析的页面中读取全部<table>, 结果与pd.read_html(text, header=0, flavor='bs4')相同:
+    千分位逗号和空白单元格由TextParser处理, 数值列为数值类型
+    :param selector: scrapy的response或Selector
+    :param header: 表头行号
+    :return: DataFrame列表
+    '''
+    frames = []
+    for table in selector.xpath('//table'):
+        element = table.root
+        if _hidden(element) or not _RE_MATCH.search(''.join(_texts(element))):
+            continue
+        rows = table_rows(element)
+        try:
+            frames.append(TextParser(rows, header=header, thousands=',').read())
+        except EmptyDataError:
+            continue
+    if not frames:
+        raise ValueError('No tables found')
+    return frames
@@ -3,8 +3,36 @@ import logging
 import datetime
 import zipfile
 import os
+import io
+import time
+import threading
 from helper.ftp_helper import FtpService
 
+_ftp_services = {}
+_ftp_lock = threading.Lock()
+
+
+def get_ftp_service(settings):
+    '''
+    返回进程内共享的FtpService, 同一个进程中的多个爬虫共用
+    :param settings: FTP_SETTINGS
+    '''
+    key = (settings.get('HOST'), settings.get('PORT'), settings.get('USERNAME'))
+    with _ftp_lock:
+        if key not in _ftp_services:
+            _ftp_services[key] = FtpService.from_settings(settings)
+        return _ftp_services[key]
+
+
+def close_ftp_services():
+    '''
+    关闭共享FtpService的会话, 最后一个爬虫关闭时调用
+    '''
+    with _ftp_lock:
+        for ftp_service in _ftp_services.values():
+            ftp_service.close()
+        _ftp_services.clear()
+
 
 def upload_csv_to_ftp(local_file_path, tag, settings):
     logging.info('%s uploading...' % tag)
@@ -12,12 +40,47 @@ def upload_csv_to_ftp(local_file_path, tag, settings):
     basename = '%s_%s' % (datetime.datetime.now().strftime('%Y%m%d'), os.path.basename(zip_filepath))
     remote_name = os.path.join(settings.get('BASE_DIR'), tag, basename)
     remote_name = remote_name.replace('\\', '/')   # for windows only
-    ftp_service = FtpService(settings.get('HOST'), settings.get('PORT'), settings.get('USERNAME'), settings.get('PASSWORD'))
+    ftp_service = get_ftp_service(settings)
     ftp_service.upload(zip_filepath, remote_name)
     os.remove(zip_filepath)
     logging.info('%s uploaded.' % tag)
 
 
+def compress_dataframe(df, arcname):
+    '''
+    把DataFrame写成csv并直接压缩到内存中的zip, 与compress_file的结果相同, 不产生临时文件
+    :param df: DataFrame, 索引一并写出
+    :param arcname: zip中的csv文件名
+    :return: BytesIO, 位于开头
+    '''
+    buf = io.BytesIO()
+    info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o644 << 16
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr(info, df.to_csv().encode('utf-8'))
+    buf.seek(0)
+    return buf
+
+
+def upload_zip_to_ftp(zip_buf, csv_name, tag, settings):
+    '''
+    上传compress_dataframe的结果, 远程文件名与upload_csv_to_ftp相同
+    :param zip_buf: 压缩后的BytesIO
+    :param csv_name: csv文件名, 如Ports_2022.csv
+    :param tag: 远程子目录, 爬虫名
+    :param settings: FTP_SETTINGS
+    :return: 发送的字节数, 失败时为None
+    '''
+    logging.info('%s uploading...' % tag)
+    basename = '%s_%s' % (datetime.datetime.now().strftime('%Y%m%d'), csv_name.replace('.csv', '.zip'))
+    remote_name = os.path.join(settings.get('BASE_DIR'), tag, basename)
+    remote_name = remote_name.replace('\\', '/')   # for windows only
+    sent = get_ftp_service(settings).upload_stream(zip_buf, remote_name)
+    logging.info('%s uploaded.' % tag)
+    return sent
+
+
 def compress_file(file_path):
     parent_dir = os.path.dirname(file_path)
     basename = os.path.basename(file_path)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# Define here the extensions of your project
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/extensions.html
+
+import time
+import logging
+from contextlib import contextmanager
+from twisted.internet import task, threads
+from scrapy import signals
+from helper.database_helper import close_pools, close_sqlite_connections
+from helper.audit_helper import AuditLog
+from helper.upload_helper import close_ftp_services
+
+
+@contextmanager
+def stage_timer(spider, stage):
+    '''
+    把代码块的耗时累加到爬虫的mpob/time/<stage>统计, 由run_mpob.py汇总
+    :param spider: 爬虫
+    :param stage: 阶段名, 如read_tables
+    '''
+    start = time.time()
+    try:
+        yield
+    finally:
+        spider.crawler.stats.inc_value('mpob/time/%s' % stage, time.time() - start, spider=spider)
+
+
+class AuditLogExtension(object):
+    # Writes the SCRIPT_RUN_LOG records buffered by the pipeline (AuditLog)
+    # every AUDIT_FLUSH_INTERVAL seconds in a pool thread and once more at
+    # spider_closed. Listed before DatabasePoolExtension in EXTENSIONS, the
+    # last flush needs the session pool that extension closes.
+
+    def __init__(self, audit, interval):
+        self.audit = audit
+        self.interval = interval
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        ext = cls(AuditLog.from_settings(crawler.settings), crawler.settings.getfloat('AUDIT_FLUSH_INTERVAL', 60))
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        return ext
+
+    def spider_opened(self, spider):
+        if self.interval > 0:
+            self.task = task.LoopingCall(self.flush_in_thread)
+            self.task.start(self.interval, now=False)
+
+    def flush_in_thread(self):
+        d = threads.deferToThread(self.audit.flush)
+        d.addErrback(lambda failure: logging.error('audit log flush: %s' % failure.getErrorMessage()))
+        return d
+
+    def spider_closed(self, spider):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        # blocks until a flush running in a thread is done
+        self.audit.flush()
+
+
+class DatabasePoolExtension(object):
+    # Closes the process-wide Oracle session pools, sqlite connections and ftp
+    # sessions when the last spider of the process closes, several crawlers
+    # may share them (run_mpob.py).
+    open_spiders = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        ext = cls()
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        return ext
+
+    def spider_opened(self, spider):
+        DatabasePoolExtension.open_spiders += 1
+
+    def spider_closed(self, spider):
+        DatabasePoolExtension.open_spiders -= 1
+        if DatabasePoolExtension.open_spiders > 0:
+            return
+        spider.logger.info('Close oracle session pools: %s' % spider.name)
+        close_pools()
+        close_sqlite_connections()
+        spider.logger.info('Close ftp sessions: %s' % spider.name)
+        close_ftp_services()
@@ -12,3 +12,16 @@ class MalaysiaApItem(scrapy.Item):
     # define the fields for your item here like:
     # name = scrapy.Field()
     pass
+
+
+class MpobTableItem(scrapy.Item):
+    # one parsed MPOB table, stored by MalaysiaApPipeline
+    df = scrapy.Field()          # long format dataframe
+    table = scrapy.Field()       # target Oracle table
+    keys = scrapy.Field()        # key columns of table, the index of the merge
+    filename = scrapy.Field()    # local csv archive, uploaded to ftp
+    start_time = scrapy.Field()  # crawl start time for SCRIPT_RUN_LOG
+    url = scrapy.Field()         # table page url, key of the fetch state
+    fetch_state = scrapy.Field() # etag/last_modified/hash of the page, saved after the merge
+    unchanged = scrapy.Field()   # why the page was skipped, df is None then
+    backfill = scrapy.Field()    # (category, year) of a backfill, merged with the other years at close
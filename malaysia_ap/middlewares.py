@@ -5,7 +5,30 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import os
+import json
+import time
+import logging
+import functools
+from http.cookies import SimpleCookie
+from email.utils import parsedate_tz, mktime_tz
+import scrapy
 from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import HtmlResponse
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.settings import Settings
+from scrapy.utils.project import data_path
+from scrapy.downloadermiddlewares.httpcache import HttpCacheMiddleware
+from scrapy.downloadermiddlewares.retry import RetryMiddleware
+from scrapy.extensions.httpcache import DummyPolicy, FilesystemCacheStorage
+from twisted.internet import defer, reactor, task
+from helper.fetch_state_helper import FetchState, body_hash
+from helper.backfill_helper import BackfillCheckpoint, parse_years
+from malaysia_ap.items import MpobTableItem
+from malaysia_ap.extensions import stage_timer
+
+logger = logging.getLogger(__name__)
 
 
 class MalaysiaApSpiderMiddleware(object):
@@ -101,3 +124,502 @@ class MalaysiaApDownloaderMiddleware(object):
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class MpobSession(object):
+    # Joomla session cookies of bepi.mpob.gov.my, persisted to a json file so
+    # that later crawls within the validity window skip the login. One
+    # instance per file is shared by all crawlers of the process, requests
+    # of other crawlers wait for a login in progress instead of starting
+    # their own.
+    _sessions = {}
+
+    def __init__(self, path):
+        self.path = path
+        self.cookies = {}
+        self.expires = 0
+        self.logging_in = False
+        self.waiters = []
+        self.load()
+
+    @classmethod
+    def get(cls, path):
+        if path not in cls._sessions:
+            cls._sessions[path] = cls(path)
+        return cls._sessions[path]
+
+    def valid(self):
+        return bool(self.cookies) and time.time() < self.expires
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            self.cookies = data.get('cookies', {})
+            self.expires = data.get('expires', 0)
+        except ValueError:
+            logger.warning('ignore broken session file: %s' % self.path)
+
+    def save(self, cookies, expires):
+        self.cookies = dict(cookies)
+        self.expires = expires
+        parent = os.path.dirname(self.path)
+        if parent and not os.path.exists(parent):
+            os.makedirs(parent)
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump({'cookies': self.cookies, 'expires': self.expires}, f)
+
+    def clear(self):
+        self.cookies = {}
+        self.expires = 0
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def wait(self):
+        d = defer.Deferred()
+        self.waiters.append(d)
+        return d
+
+    def login_started(self):
+        self.logging_in = True
+
+    def login_finished(self, error=None):
+        # after a failed login the waiting requests are dropped with error,
+        # instead of each of them starting a login of its own
+        self.logging_in = False
+        waiters, self.waiters = self.waiters, []
+        for d in waiters:
+            if error:
+                d.errback(IgnoreRequest(error))
+            else:
+                d.callback(None)
+
+
+class MpobLoginMiddleware(object):
+    # Logs in to MPOB with MPOB_USERNAME/MPOB_PASSWORD for spiders that define
+    # login_url, and attaches the cached session cookies to their requests.
+    # A request redirected to the com-users-login__form page re-authenticates
+    # and is replayed. Runs below HttpCompressionMiddleware (590), so that it
+    # inspects decompressed pages. The login submit is sent with dont_redirect,
+    # so that the Set-Cookie of its redirect is seen here.
+
+    def __init__(self, settings):
+        self.username = settings.get('MPOB_USERNAME')
+        self.password = settings.get('MPOB_PASSWORD')
+        self.session_ttl = settings.getint('MPOB_SESSION_TTL', 900)
+        self.max_retries = settings.getint('MPOB_LOGIN_RETRIES', 2)
+        session_file = settings.get('MPOB_SESSION_FILE') or os.path.join(settings.get('TEMP_DATA_DIR'), 'mpob_session.json')
+        if settings.get('MPOB_REPLAY_MODE'):
+            # record and replay always go through the login of the corpus
+            session_file = os.path.join(data_path(settings.get('MPOB_REPLAY_DIR'), createdir=True), 'mpob_session.json')
+        self.session = MpobSession.get(session_file)
+        if settings.get('MPOB_REPLAY_MODE') and not self.session.logging_in:
+            self.session.clear()
+        self.login_cookies = {}
+        self.login_expires = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings)
+
+    def process_request(self, request, spider):
+        if not self._needs_login(request, spider) or request.meta.get('mpob_login'):
+            return None
+        if self.session.valid():
+            cookies = dict(request.cookies) if isinstance(request.cookies, dict) else {}
+            cookies.update(self.session.cookies)
+            request.cookies = cookies
+            return None
+        if self.session.logging_in:
+            d = self.session.wait()
+            d.addCallback(lambda _: self.process_request(request, spider))
+            return d
+        spider.logger.info('No valid MPOB session, login before %s' % request.url)
+        return self._login_request(request, spider)
+
+    def process_response(self, request, response, spider):
+        if not self._needs_login(request, spider):
+            return response
+        if request.meta.get('mpob_login'):
+            return self._login_response(request, response, spider)
+        if self._is_login_page(response):
+            retries = request.meta.get('mpob_login_retries', 0)
+            if retries >= self.max_retries:
+                spider.logger.error('Still redirected to login after %s logins: %s' % (retries, request.url))
+                return response
+            spider.logger.info('Got redirected to login page, need to authenticate: %s' % request.url)
+            self.session.clear()
+            # replay the url the spider asked for, not where it was redirected to
+            redirect_urls = request.meta.get('redirect_urls')
+            replay = request.replace(url=redirect_urls[0] if redirect_urls else request.url, dont_filter=True)
+            replay.meta['mpob_login_retries'] = retries + 1
+            return self._login_request(replay, spider)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if request.meta.get('mpob_login'):
+            spider.logger.error('Login request failed: %s' % exception)
+            self.session.login_finished('MPOB login failed: %s' % exception)
+        return None
+
+    @staticmethod
+    def _needs_login(request, spider):
+        # robots.txt is public, and the login request itself waits for it
+        return bool(getattr(spider, 'login_url', None)) and urlparse_cached(request).path != '/robots.txt'
+
+    def _login_request(self, request, spider):
+        self.session.login_started()
+        self.login_cookies = {}
+        self.login_expires = None
+        return scrapy.Request(
+            spider.login_url,
+            meta={'mpob_login': 'form', 'mpob_replay': request},
+            priority=request.priority + 1,
+            dont_filter=True,
+        )
+
+    def _login_response(self, request, response, spider):
+        # every way out of the login but the submit request finishes it, so
+        # that no request keeps waiting for a login that is gone
+        error = 'MPOB login failed'
+        try:
+            self._collect_cookies(response)
+            if request.meta['mpob_login'] == 'form':
+                submit = self._submit_request(request, response, spider)
+                error = None
+                return submit
+            # a redirect away from the login page is a success, no need to follow it
+            if self._is_login_page(response):
+                self.session.clear()
+                spider.logger.error('Login failed')
+                raise IgnoreRequest(error)
+            self.session.save(self.login_cookies, self.login_expires or time.time() + self.session_ttl)
+            error = None
+            self.session.login_finished()
+            spider.logger.info('Logged in, session cached until %s' % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.session.expires)))
+            return request.meta['mpob_replay'].replace(dont_filter=True)
+        finally:
+            if error:
+                self.session.login_finished(error)
+
+    def _submit_request(self, request, response, spider):
+        script_json = response.xpath('//script[@type="application/json"]/text()').get()
+        crsf_token = None
+        if script_json:
+            try:
+                crsf_token = json.loads(script_json).get('csrf.token')
+            except ValueError:
+                spider.logger.error('Failed to extract token')
+        if not crsf_token:
+            spider.logger.error('Csrf token not found')
+            raise IgnoreRequest('MPOB csrf token not found')
+        return scrapy.FormRequest.from_response(
+            response,
+            formdata={
+                'username': self.username,
+                'password': self.password,
+                'return': '',
+                crsf_token: '1'
+            },
+            meta={'mpob_login': 'submit', 'mpob_replay': request.meta['mpob_replay'], 'dont_redirect': True},
+            dont_filter=True,
+        )
+
+    def _collect_cookies(self, response):
+        for header in response.headers.getlist('Set-Cookie'):
+            cookie = SimpleCookie()
+            cookie.load(header.decode('latin-1'))
+            for name, morsel in cookie.items():
+                self.login_cookies[name] = morsel.value
+                expires = None
+                if morsel['max-age']:
+                    expires = time.time() + int(morsel['max-age'])
+                elif morsel['expires']:
+                    parsed = parsedate_tz(morsel['expires'])
+                    expires = mktime_tz(parsed) if parsed else None
+                if expires is not None and expires <= time.time():
+                    # deleted cookie
+                    self.login_cookies.pop(name, None)
+                elif expires is not None:
+                    cap = time.time() + self.session_ttl
+                    self.login_expires = min(expires, cap, self.login_expires or cap)
+
+    @staticmethod
+    def _is_login_page(response):
+        if 300 <= response.status < 400:
+            location = response.headers.get('Location', b'').decode('latin-1')
+            return 'users/login' in location or 'view=login' in location
+        return isinstance(response, HtmlResponse) and \
+            bool(response.xpath('//form[contains(@class, "com-users-login__form")]'))
+
+
+class ConditionalFetchMiddleware(object):
+    # Sends requests marked with meta mpob_conditional (the table pages behind
+    # parse_iframe) as conditional GETs, with the ETag/Last-Modified of the
+    # fetch state. A 304, or a 200 whose body hash did not change, is marked
+    # mpob_unchanged and skipped by skip_unchanged. The new state is kept in
+    # meta mpob_fetch_state, the pipeline saves it once the table is merged.
+    # Runs below HttpCompressionMiddleware (590), the hash is of the
+    # decompressed page, and below MpobLoginMiddleware (585), login pages
+    # never get here.
+
+    def __init__(self, settings):
+        self.state = FetchState.from_settings(settings)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        # record/replay keep every table, a 304 would not replay the parsing
+        if not crawler.settings.getbool('MPOB_CONDITIONAL_FETCH', True) or crawler.settings.get('MPOB_REPLAY_MODE'):
+            raise NotConfigured
+        return cls(crawler.settings)
+
+    def process_request(self, request, spider):
+        if not request.meta.get('mpob_conditional'):
+            return None
+        # redirects and login replays keep the url of the first request
+        key = request.meta.setdefault('mpob_state_key', request.url)
+        previous = self.state.lookup(key)
+        if not previous:
+            return None
+        if previous.get('etag'):
+            request.headers['If-None-Match'] = previous['etag']
+        if previous.get('last_modified'):
+            request.headers['If-Modified-Since'] = previous['last_modified']
+        handled = request.meta.get('handle_httpstatus_list', [])
+        if 304 not in handled:
+            request.meta['handle_httpstatus_list'] = list(handled) + [304]
+        return None
+
+    def process_response(self, request, response, spider):
+        if not request.meta.get('mpob_conditional') or response.status not in (200, 304):
+            return response
+        key = request.meta.get('mpob_state_key', request.url)
+        previous = self.state.lookup(key) or {}
+        if response.status == 304:
+            request.meta['mpob_unchanged'] = 'not modified'
+            request.meta['mpob_fetch_state'] = dict(previous, url=key)
+            return response
+        digest = body_hash(response.body)
+        request.meta['mpob_fetch_state'] = {
+            'url': key,
+            'etag': self._header(response, 'ETag'),
+            'last_modified': self._header(response, 'Last-Modified'),
+            'hash': digest,
+            'table': previous.get('table'),
+        }
+        if previous.get('hash') == digest:
+            request.meta['mpob_unchanged'] = 'same hash'
+        return response
+
+    @staticmethod
+    def _header(response, name):
+        value = response.headers.get(name)
+        return value.decode('latin-1') if value else None
+
+
+class RecordPolicy(DummyPolicy):
+    # Always downloads, and replaces the recorded response
+
+    def is_cached_response_fresh(self, cachedresponse, request):
+        return False
+
+    def is_cached_response_valid(self, cachedresponse, response, request):
+        return False
+
+
+class ReplayCacheStorage(FilesystemCacheStorage):
+    # One corpus for all spiders, the login recorded by one of them replays
+    # for the others
+
+    def _get_request_path(self, spider, request):
+        parent, key = os.path.split(super(ReplayCacheStorage, self)._get_request_path(spider, request))
+        return os.path.join(self.cachedir, os.path.basename(parent), key)
+
+
+class ReplayCacheMiddleware(HttpCacheMiddleware):
+    # MPOB_REPLAY_MODE = 'record' stores every response (robots.txt, login,
+    # listing, article and iframe table pages) in MPOB_REPLAY_DIR, 'replay'
+    # serves them from there and ignores requests that were not recorded, so
+    # the spiders run offline and reproducibly. Disabled when the mode is not
+    # set, the HTTPCACHE_* settings are left alone.
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        mode = crawler.settings.get('MPOB_REPLAY_MODE')
+        if not mode:
+            raise NotConfigured
+        if mode not in ('record', 'replay'):
+            raise ValueError('MPOB_REPLAY_MODE must be record or replay: %s' % mode)
+        settings = Settings(crawler.settings.copy_to_dict())
+        settings.set('HTTPCACHE_ENABLED', True)
+        settings.set('HTTPCACHE_DIR', crawler.settings.get('MPOB_REPLAY_DIR'))
+        settings.set('HTTPCACHE_EXPIRATION_SECS', 0)
+        settings.set('HTTPCACHE_GZIP', True)
+        settings.set('HTTPCACHE_IGNORE_HTTP_CODES', [])
+        settings.set('HTTPCACHE_STORAGE', 'malaysia_ap.middlewares.ReplayCacheStorage')
+        if mode == 'record':
+            settings.set('HTTPCACHE_POLICY', 'malaysia_ap.middlewares.RecordPolicy')
+        else:
+            settings.set('HTTPCACHE_POLICY', 'scrapy.extensions.httpcache.DummyPolicy')
+        settings.set('HTTPCACHE_IGNORE_MISSING', mode == 'replay')
+        o = cls(settings, crawler.stats)
+        crawler.signals.connect(o.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signal=signals.spider_closed)
+        return o
+
+
+class FetchTimingMiddleware(object):
+    # Adds the time each request spends below it (network, or the replay
+    # corpus) to the mpob/time/fetch stat. Runs first on requests and last on
+    # responses.
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.stats)
+
+    def process_request(self, request, spider):
+        request.meta['mpob_fetch_start'] = time.time()
+        return None
+
+    def process_response(self, request, response, spider):
+        self._add(request, spider)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        self._add(request, spider)
+        return None
+
+    def _add(self, request, spider):
+        start = request.meta.pop('mpob_fetch_start', None)
+        if start is not None:
+            self.stats.inc_value('mpob/time/fetch', time.time() - start, spider=spider)
+
+
+def apply_crawl_profile(settings):
+    '''
+    把CRAWL_PROFILES中MPOB_CRAWL_PROFILE指定的设置写入settings, 由爬虫的update_settings调用
+    以spider优先级写入, 命令行-s指定的同名设置优先
+    :param settings: 还未冻结的爬虫settings
+    '''
+    name = settings.get('MPOB_CRAWL_PROFILE')
+    if not name:
+        return
+    profiles = settings.getdict('CRAWL_PROFILES')
+    if name not in profiles:
+        raise ValueError('unknown crawl profile: %s, one of %s' % (name, ', '.join(sorted(profiles))))
+    settings.setdict(profiles[name], priority='spider')
+
+
+class BackoffRetryMiddleware(RetryMiddleware):
+    # RetryMiddleware that waits before sending a retry: the n-th retry of a
+    # request is delayed RETRY_BACKOFF_BASE * 2 ** (n - 1) seconds, at most
+    # RETRY_BACKOFF_MAX, so a 5xx burst or timeouts of the MPOB site do not
+    # use up RETRY_TIMES at once. RETRY_BACKOFF_BASE = 0 retries at once.
+
+    def __init__(self, settings):
+        super(BackoffRetryMiddleware, self).__init__(settings)
+        self.backoff_base = settings.getfloat('RETRY_BACKOFF_BASE', 1)
+        self.backoff_max = settings.getfloat('RETRY_BACKOFF_MAX', 30)
+
+    def process_response(self, request, response, spider):
+        return self._backoff(super(BackoffRetryMiddleware, self).process_response(request, response, spider))
+
+    def process_exception(self, request, exception, spider):
+        return self._backoff(super(BackoffRetryMiddleware, self).process_exception(request, exception, spider))
+
+    def _backoff(self, result):
+        if not isinstance(result, scrapy.Request):
+            return result
+        delay = min(self.backoff_base * 2 ** (result.meta.get('retry_times', 1) - 1), self.backoff_max)
+        if delay <= 0:
+            return result
+        return task.deferLater(reactor, delay, lambda: result)
+
+
+class MpobBackfillMiddleware(object):
+    # Spider middleware for the backfill spider argument
+    # (scrapy crawl mpob_production -a backfill=all|2015|2010-2015).
+    # The category listing only shows the latest years: on listing pages the
+    # archive and pagination links (MPOB_BACKFILL_ARCHIVE_XPATH) are followed
+    # with the spider's parse as well, so parse yields the article of every
+    # year. Articles outside the years or already spooled or merged by an
+    # earlier backfill (BackfillCheckpoint) are dropped, the others and their tables
+    # are fetched through the download slot mpob-backfill, whose concurrency
+    # is set in DOWNLOAD_SLOTS, and are always parsed (no conditional fetch). The pipeline merges all years of a table at once.
+
+    SLOT = 'mpob-backfill'
+
+    def __init__(self, settings, stats):
+        self.settings = settings
+        self.stats = stats
+        self.archive_xpath = settings.get('MPOB_BACKFILL_ARCHIVE_XPATH')
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings, crawler.stats)
+
+    def process_spider_output(self, response, result, spider):
+        if not getattr(spider, 'backfill', None):
+            for r in result:
+                yield r
+            return
+        years = parse_years(spider.backfill)
+        checkpoint = BackfillCheckpoint.from_settings(self.settings, spider.name)
+        for r in result:
+            if isinstance(r, MpobTableItem):
+                r['backfill'] = (response.meta['CATEGORY'], response.meta['YEAR'].strip())
+            elif isinstance(r, scrapy.Request) and 'YEAR' in r.meta:
+                if 'CATEGORY' in r.meta and not r.meta.get('mpob_conditional'):
+                    # article of parse
+                    year, category = r.meta['YEAR'].strip(), r.meta['CATEGORY']
+                    if years is not None and year not in years:
+                        continue
+                    state = checkpoint.state(category, year)
+                    if state:
+                        spider.log('backfill: skip %s %s %s' % (state, category, year), level=logging.INFO)
+                        self.stats.inc_value('mpob/backfill/skipped', spider=spider)
+                        continue
+                    self.stats.inc_value('mpob/backfill/articles', spider=spider)
+                r.meta['mpob_conditional'] = False
+                r.meta['download_slot'] = self.SLOT
+            yield r
+        if 'YEAR' not in response.meta:
+            for href in response.xpath(self.archive_xpath).getall():
+                meta = dict((k, v) for k, v in response.meta.items() if k in ('tag', 'start_time'))
+                yield scrapy.Request(response.urljoin(href), meta=meta, callback=spider.parse)
+
+
+def skip_unchanged(table_parser):
+    '''
+    表格解析回调的装饰器, 配合ConditionalFetchMiddleware
+    页面未变化时不解析, 产出df为None的item, 由pipeline记录跳过
+    页面有变化时把本次的抓取状态附到item上, 合入成功后由pipeline保存, 解析耗时计入mpob/time/parse
+    '''
+    @functools.wraps(table_parser)
+    def wrapper(spider, rsp):
+        fetch_state = rsp.meta.get('mpob_fetch_state')
+        unchanged = rsp.meta.get('mpob_unchanged')
+        if unchanged:
+            spider.log('skip unchanged table (%s): %s' % (unchanged, fetch_state['url']), level=logging.INFO)
+            yield MpobTableItem(
+                df=None,
+                table=fetch_state.get('table'),
+                start_time=rsp.meta.get('start_time'),
+                url=fetch_state['url'],
+                fetch_state=fetch_state,
+                unchanged=unchanged,
+            )
+            return
+        with stage_timer(spider, 'parse'):
+            items = list(table_parser(spider, rsp))
+        for item in items:
+            if isinstance(item, MpobTableItem) and fetch_state:
+                item['url'] = fetch_state['url']
+                item['fetch_state'] = fetch_state
+            yield item
+    return wrapper
@@ -5,7 +5,178 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
+import os
+import time
+import traceback
+import six
+import pandas as pd
+from twisted.internet import defer, threads
+from scrapy.utils.misc import load_object
+from helper.database_helper import MergeResult, RowsRejectedError
+from helper.audit_helper import AuditLog
+from helper.upload_helper import compress_dataframe, upload_zip_to_ftp
+from helper.fetch_state_helper import FetchState
+from helper.backfill_helper import BackfillCheckpoint
+from helper.batch_helper import TableBatches, concat_frames
+from malaysia_ap.items import MpobTableItem
+
 
 class MalaysiaApPipeline(object):
+    # Stores MpobTableItem in the reactor thread pool, at most PIPELINE_MAX_WORKERS
+    # items at a time, and merges the collected frames of each table once at
+    # close_spider through STORAGE_BACKEND. MPOB_STORE = False only parses (offline replay).
+
+    def __init__(self, settings, stats, max_workers):
+        self.settings = settings
+        self.stats = stats
+        self.semaphore = defer.DeferredSemaphore(max_workers)
+        self.pending = set()
+        self.fetch_state = FetchState.from_settings(settings)
+        self.audit = AuditLog.from_settings(settings)
+        self.batches = TableBatches()
+        self.store = settings.getbool('MPOB_STORE', True)
+        self.keep_csv = settings.getbool('MPOB_KEEP_CSV', False)
+        self.backend = load_object(settings.get('STORAGE_BACKEND')).from_settings(settings)
+        # start_time of the first item, for the SCRIPT_RUN_LOG rows of the merges
+        self.start_time = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings, crawler.stats, crawler.settings.getint('PIPELINE_MAX_WORKERS', 4))
+
     def process_item(self, item, spider):
+        # returns the deferred, so scrapy holds back new responses while the workers are busy
+        if not isinstance(item, MpobTableItem):
+            return item
+        if not self.store:
+            if item['df'] is not None:
+                self.stats.inc_value('mpob/rows_parsed', len(item['df']), spider=spider)
+            return item
+        if self.start_time is None:
+            self.start_time = item['start_time']
+        store = self.log_skipped_item if item['df'] is None else self.store_item
+        d = self.semaphore.run(threads.deferToThread, store, item, spider)
+        self.pending.add(d)
+        d.addBoth(self._finished, d)
+        d.addCallback(self._count, item, spider)
+        return d
+
+    def _finished(self, result, d):
+        self.pending.discard(d)
+        return result
+
+    def _count(self, stored, item, spider):
+        # stats are updated on the reactor thread, read by run_mpob.py
+        timings, sent = stored
+        for stage, elapsed in timings.items():
+            self.stats.inc_value('mpob/time/%s' % stage, elapsed, spider=spider)
+        self.stats.inc_value('mpob/ftp_bytes', sent, spider=spider)
+        if item['df'] is None:
+            self.stats.inc_value('mpob/tables_unchanged', spider=spider)
+        else:
+            self.stats.inc_value('mpob/rows_parsed', len(item['df']), spider=spider)
         return item
+
+    def close_spider(self, spider):
+        # flush items still in the thread pool, then merge the tables
+        if self.pending:
+            spider.logger.info('Wait for %s pending items' % len(self.pending))
+        d = defer.DeferredList(list(self.pending))
+        if self.store:
+            d.addCallback(lambda _: threads.deferToThread(self.merge_tables, spider))
+            d.addCallback(self._count_merged, spider)
+            d.addBoth(self._close_backend)
+        return d
+
+    def _close_backend(self, result):
+        self.backend.close()
+        return result
+
+    def _count_merged(self, merged, spider):
+        for table, result, rejected, elapsed in merged:
+            self.stats.inc_value('mpob/time/merge', elapsed, spider=spider)
+            if rejected:
+                self.stats.inc_value('mpob/rows_rejected', rejected, spider=spider)
+            if result is None:
+                self.stats.inc_value('mpob/merge_failed', spider=spider)
+            else:
+                count = result.inserted + result.updated if isinstance(result, MergeResult) else result
+                self.stats.inc_value('mpob/rows_merged', count, spider=spider)
+
+    def store_item(self, item, spider):
+        # zips the csv in memory (MPOB_KEEP_CSV also writes it to disk) and uploads it to the ftp,
+        # the frame is collected per table (TableBatches) or, during a backfill, spooled by BackfillCheckpoint
+        timings = {}
+        start = time.time()
+        df = item['df'].set_index(item['keys'])
+        if self.keep_csv:
+            df.to_csv(item['filename'])
+        csv_name = os.path.basename(item['filename'])
+        zip_buf = compress_dataframe(df, csv_name)
+        if item.get('backfill'):
+            category, year = item['backfill']
+            BackfillCheckpoint.from_settings(self.settings, spider.name).spool(category, year, item['table'], df)
+        else:
+            self.batches.add(item['table'], df, item.get('url'), item.get('fetch_state'))
+        timings['csv'] = time.time() - start
+        start = time.time()
+        sent = upload_zip_to_ftp(zip_buf, csv_name, spider.name, self.settings.get('FTP_SETTINGS'))
+        timings['upload'] = time.time() - start
+        return timings, sent or 0
+
+    def merge_tables(self, spider):
+        '''
+        merge the frames collected for each table, and the years spooled by a backfill, once
+        on success the fetch states of the pages are saved and the backfill years marked merged
+        :return: [(table, result, rejected rows, seconds)], result is None on failure
+        '''
+        script_name = 'scrapy:malaysia:%s.py' % spider.name
+        start_time = self.start_time if self.start_time is not None else pd.Timestamp(pd.Timestamp.now())
+        checkpoint = BackfillCheckpoint.from_settings(self.settings, spider.name) if getattr(spider, 'backfill', None) else None
+        spooled = checkpoint.parsed() if checkpoint else {}
+        merged = []
+        for table in sorted(set(self.batches.tables()) | set(spooled)):
+            frames, fetch_states = self.batches.pop(table)
+            spool = spooled.get(table, [])
+            count = len(frames) + len(spool)
+            rows = 0
+            result = None
+            rejected = 0
+            start = time.time()
+            try:
+                if spool:
+                    frames.insert(0, checkpoint.load_table(spool))
+                df = concat_frames(frames)
+                rows = len(df)
+                result = self.backend.store(df, table)
+                self.audit.record(script_name, table, start_time, '成功', str(result), "")
+            except RowsRejectedError as e:
+                rejected = e.rejected
+                if e.committed:
+                    result = e.count
+                    self.audit.record(script_name, table, start_time, '部分成功', '合入{0}条数据, 拒绝{1}条'.format(e.count, e.rejected), str(e))
+                else:
+                    self.audit.record(script_name, table, start_time, '失败', '合入数据, 拒绝{0}条'.format(e.rejected), str(e))
+            except Exception as e:
+                buf = six.StringIO()
+                traceback.print_exc(file=buf)
+                error_info = buf.getvalue()
+                self.audit.record(script_name, table, start_time, '失败', '合入数据', str(error_info))
+            elapsed = time.time() - start
+            spider.logger.info('Merge %s: %s frames, %s rows in %.2fs: %s' % (table, count, rows, elapsed, result))
+            # after rejected rows the fetch states are not saved and the backfill years stay parsed, the next run loads them again
+            if result is not None and not rejected:
+                if spool:
+                    checkpoint.mark_merged(spool)
+                for url, state in fetch_states:
+                    self.fetch_state.update(url, dict(state, table=table))
+            merged.append((table, result, rejected, elapsed))
+        return merged
+
+    def log_skipped_item(self, item, spider):
+        # a table skipped by ConditionalFetchMiddleware (df is None) is only written to SCRIPT_RUN_LOG
+        script_name = 'scrapy:malaysia:%s.py' % spider.name
+        self.audit.record(script_name, item['table'] or '', item['start_time'], '跳过', '未变化(%s)' % item['unchanged'], item['url'])
+        # keep the validators of the last response, the hash is the same
+        self.fetch_state.update(item['url'], item['fetch_state'])
+        return {}, 0
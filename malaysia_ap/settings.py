@@ -19,20 +19,180 @@ TEMP_DATA_DIR = 'temp'
 DATABASE_URI = 'user/password@localhost:1521/dbname'
 # prod
 # DATABASE_URI = 'user/password@localhost:1521/dbname'
+# Oracle session pool shared by all helpers of the process
+DATABASE_POOL = {
+    'MIN': 1,
+    'MAX': 4,
+    'INCREMENT': 1,
+}
 FTP_SETTINGS = {
     'HOST': 'ftp.example.com',
     'PORT': 21,
     'USERNAME': 'ftpuser',
     'PASSWORD': 'ftppassword',
-    'BASE_DIR': '/IndustDataCollection/AP/MPOB'
+    'BASE_DIR': '/IndustDataCollection/AP/MPOB',
+    # parallel connections for directory uploads/downloads (FtpTransfer)
+    'CONNECTIONS': 4,
+    # passive mode for workers behind NAT, active mode falls back to passive
+    # when the server cannot open the data connection (PASSIVE_FALLBACK)
+    'PASSIVE': True,
+    'PASSIVE_FALLBACK': True,
+    # bytes per storbinary/retrbinary block, socket timeout in seconds
+    'BLOCK_SIZE': 64 * 1024,
+    'TIMEOUT': 60,
+    # FTPS (explicit AUTH TLS) with an encrypted data channel
+    'TLS': False,
+}
+
+# where the pipeline stores the tables, a helper.storage_helper.StorageBackend:
+# OracleBackend (DATABASE_URI), MysqlBackend (MYSQL_SETTINGS), SqliteBackend (SQLITE_PATH)
+# or ParquetBackend (PARQUET_DIR, needs pyarrow); set AUDIT_TO_DATABASE = False without Oracle
+STORAGE_BACKEND = 'helper.storage_helper.OracleBackend'
+# pymysql.connect arguments
+MYSQL_SETTINGS = {
+    'host': 'localhost',
+    'port': 3306,
+    'user': 'user',
+    'password': 'password',
+    'database': 'dbname',
+    'charset': 'utf8',
 }
+# default TEMP_DATA_DIR/mpob.db and TEMP_DATA_DIR/parquet
+SQLITE_PATH = None
+PARQUET_DIR = None
 
 # MPOB Login credentials
 MPOB_USERNAME = 'mpobuser'
 MPOB_PASSWORD = 'mpobpassword'
+# Joomla session cached on disk by MpobLoginMiddleware, default TEMP_DATA_DIR/mpob_session.json
+MPOB_SESSION_FILE = None
+# seconds a session is reused when its cookies carry no expiry
+MPOB_SESSION_TTL = 900
+# logins per request before a login redirect is given up
+MPOB_LOGIN_RETRIES = 2
+# conditional GETs of the table pages, unchanged tables are not parsed, merged or uploaded
+MPOB_CONDITIONAL_FETCH = True
+# ETag/Last-Modified/hash per table url, default TEMP_DATA_DIR/fetch_state.json
+MPOB_FETCH_STATE_FILE = None
+# record every response to MPOB_REPLAY_DIR ('record') or crawl offline from it ('replay')
+MPOB_REPLAY_MODE = None
+# relative to the project data dir .scrapy
+MPOB_REPLAY_DIR = 'mpob_replay'
+# merge into Oracle and upload to ftp, False only parses the tables
+MPOB_STORE = True
+# also write each table to TEMP_DATA_DIR/<spider>/<table>.csv, the upload is zipped in memory
+MPOB_KEEP_CSV = False
+# None or 'merge' merges, 'auto' bulk loads (direct-path insert) when the target table
+# is empty and merges otherwise, 'bulk' after truncating a table to rebuild it
+MPOB_MERGE_MODE = None
+# rebuild the non-unique indexes after a bulk load instead of maintaining them row by row
+MPOB_BULK_REBUILD_INDEXES = False
+
+# backfill spider argument (-a backfill=all|2015|2010-2015, run_mpob.py --backfill): every year of
+# the archive, articles and tables fetched through the mpob-backfill download slot, each table merged
+# once at spider close, progress in TEMP_DATA_DIR/backfill/<spider>/checkpoint.json
+MPOB_BACKFILL_ARCHIVE_XPATH = ('//ul[contains(@class, "pagination")]//a/@href'
+                               ' | //ul[contains(@class, "mod-articlesarchive")]//a/@href')
+DOWNLOAD_SLOTS = {
+    'mpob-backfill': {'concurrency': 4},
+}
+
+# SCRIPT_RUN_LOG rows are written every AUDIT_FLUSH_INTERVAL seconds and at spider_closed,
+# kept in AUDIT_SPOOL_FILE (default TEMP_DATA_DIR/audit_spool.jsonl) while Oracle is unreachable
+AUDIT_FLUSH_INTERVAL = 60
+AUDIT_SPOOL_FILE = None
+# False only appends the rows to AUDIT_SPOOL_FILE, for local storage backends without Oracle
+AUDIT_TO_DATABASE = True
+
+# MPOB is a single host behind a slow Joomla, CRAWL_PROFILES[MPOB_CRAWL_PROFILE] is applied
+# by each spider on top of this file (run_mpob.py --profile, a -s setting still wins):
+# polite  - one request at a time with a delay, for daytime or after a ban
+# balanced - a few parallel requests, AutoThrottle keeps the latency of the site
+# fast    - offline replay or an unloaded site, no delay
+MPOB_CRAWL_PROFILE = 'balanced'
+CRAWL_PROFILES = {
+    'polite': {
+        'CONCURRENT_REQUESTS': 4,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 1,
+        'DOWNLOAD_DELAY': 1,
+        'AUTOTHROTTLE_ENABLED': True,
+        'AUTOTHROTTLE_START_DELAY': 1,
+        'AUTOTHROTTLE_MAX_DELAY': 30,
+        'AUTOTHROTTLE_TARGET_CONCURRENCY': 1.0,
+        'RETRY_TIMES': 5,
+        'RETRY_BACKOFF_BASE': 5,
+        'RETRY_BACKOFF_MAX': 120,
+        'DOWNLOAD_TIMEOUT': 120,
+    },
+    'balanced': {
+        'CONCURRENT_REQUESTS': 8,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 4,
+        'DOWNLOAD_DELAY': 0.1,
+        'AUTOTHROTTLE_ENABLED': True,
+        'AUTOTHROTTLE_START_DELAY': 0.25,
+        'AUTOTHROTTLE_MAX_DELAY': 10,
+        'AUTOTHROTTLE_TARGET_CONCURRENCY': 3.0,
+        'RETRY_TIMES': 4,
+        'RETRY_BACKOFF_BASE': 2,
+        'RETRY_BACKOFF_MAX': 60,
+        'DOWNLOAD_TIMEOUT': 60,
+    },
+    'fast': {
+        'CONCURRENT_REQUESTS': 16,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 8,
+        'DOWNLOAD_DELAY': 0,
+        'AUTOTHROTTLE_ENABLED': False,
+        'RETRY_TIMES': 3,
+        'RETRY_BACKOFF_BASE': 1,
+        'RETRY_BACKOFF_MAX': 10,
+        'DOWNLOAD_TIMEOUT': 30,
+    },
+}
+# transient errors of the site and its proxy, retried by BackoffRetryMiddleware
+RETRY_HTTP_CODES = [500, 502, 503, 504, 522, 524, 408, 429]
+DNSCACHE_ENABLED = True
+DNSCACHE_SIZE = 1000
+DNS_TIMEOUT = 20
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 #USER_AGENT = 'Malaysia_ap (+http://www.yourdomain.com)'
 
 # Obey robots.txt rules
 ROBOTSTXT_OBEY = True
+
+# Enable or disable extensions
+# See https://docs.scrapy.org/en/latest/topics/extensions.html
+EXTENSIONS = {
+    # before DatabasePoolExtension, the last flush needs the session pool
+    'malaysia_ap.extensions.AuditLogExtension': 400,
+    'malaysia_ap.extensions.DatabasePoolExtension': 500,
+}
+
+# Enable or disable spider middlewares
+# See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
+SPIDER_MIDDLEWARES = {
+    'malaysia_ap.middlewares.MpobBackfillMiddleware': 600,
+}
+
+# Enable or disable downloader middlewares
+# See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
+DOWNLOADER_MIDDLEWARES = {
+    'malaysia_ap.middlewares.FetchTimingMiddleware': 10,
+    # below HttpCompressionMiddleware (590) and MpobLoginMiddleware, hashes decompressed table pages
+    'malaysia_ap.middlewares.ConditionalFetchMiddleware': 580,
+    # RetryMiddleware with an exponential delay before each retry
+    'scrapy.downloadermiddlewares.retry.RetryMiddleware': None,
+    'malaysia_ap.middlewares.BackoffRetryMiddleware': 550,
+    # below HttpCompressionMiddleware (590), login pages are inspected decompressed
+    'malaysia_ap.middlewares.MpobLoginMiddleware': 585,
+    # HttpCacheMiddleware on the replay corpus, only enabled by MPOB_REPLAY_MODE
+    'malaysia_ap.middlewares.ReplayCacheMiddleware': 900,
+}
+
+# Configure item pipelines
+# See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
+ITEM_PIPELINES = {
+    'malaysia_ap.pipelines.MalaysiaApPipeline': 300,
+}
+# tables stored concurrently by the pipeline, each in a reactor pool thread
+PIPELINE_MAX_WORKERS = 4
@@ -5,12 +5,12 @@ import logging
 import pandas as pd
 import os
 import re
-import six
-import traceback
 import datetime
-from helper.database_helper import merge_db_oracle_dataframe
-from helper.upload_helper import upload_csv_to_ftp
-from helper.database_helper import insert_log_table
+from malaysia_ap.items import MpobTableItem
+from malaysia_ap.middlewares import skip_unchanged, apply_crawl_profile
+from helper.table_helper import read_tables
+from malaysia_ap.extensions import stage_timer
+from helper.reshape_helper import sectioned_wide_to_long, month_number
 
 
 class PalmOilSummarySpider(scrapy.Spider):
@@ -18,6 +18,11 @@ class PalmOilSummarySpider(scrapy.Spider):
     DATA_SOURCE = 'https://bepi.mpob.gov.my/index.php/summary-2'
     DATA_SUPPLIER = 'MPOB'
 
+    @classmethod
+    def update_settings(cls, settings):
+        super(PalmOilSummarySpider, cls).update_settings(settings)
+        apply_crawl_profile(settings)
+
     def temporary_dir(self):
         temp_dir = os.path.join(get_project_settings().get('TEMP_DATA_DIR'), self.name)
         if not os.path.exists(temp_dir):
@@ -58,74 +63,44 @@ class PalmOilSummarySpider(scrapy.Spider):
         url = rsp.urljoin(src.replace('../', ''))
         self.log('parse_iframe: %s' % url, level=logging.INFO)
         table_parser = rsp.meta.pop('TABLE_PARSER')
+        # ConditionalFetchMiddleware skips the table when the page did not change
+        rsp.meta['mpob_conditional'] = True
         yield scrapy.http.Request(url, meta=rsp.meta, callback=table_parser)
 
+    @skip_unchanged
     def parse_table(self, rsp):
         self.log('parse_table:%s' % rsp, level=logging.INFO)
         start_time = rsp.meta['start_time']
         year = rsp.meta.get('YEAR')
         category = rsp.meta.get('CATEGORY')
-        df = pd.read_html(rsp.text, header=0, flavor='bs4')[0]
+        with stage_timer(self, 'read_tables'):
+            df = read_tables(rsp)[0]
         df = self.rename_columns(df, year)
-        df = self.transform(df)
+        df = sectioned_wide_to_long(df, 'MIXTURE')
         df['DATADATE'] = pd.to_datetime(df['DATADATE'], format="%Y-%m")
         df['SOURCE'] = self.DATA_SOURCE
         df['SUPPLIER'] = self.DATA_SUPPLIER
         df.dropna(axis=0, subset=['VALUE'], inplace=True)
-        df.set_index(['DATADATE', 'CATEGORY', 'PRODUCT'], inplace=True)
         filename = os.path.join(self.temporary_dir(), '%s_%s.csv' % (category, year))
-        df.to_csv(filename)
-        
-        try:
-            count = merge_db_oracle_dataframe(df, 'T_AP_MYS_INDUSTRY_SUMMARY', get_project_settings().get('DATABASE_URI'))
-            insert_log_table('scrapy:malaysia:mpob_summary.py', 'T_AP_MYS_INDUSTRY_SUMMARY', start_time, '成功', '合入{count}条数据'.format(count=count), "")
-        except Exception as e:
-            buf = six.StringIO()
-            traceback.print_exc(file=buf)
-            error_info = buf.getvalue()
-            insert_log_table('scrapy:malaysia:mpob_summary.py', 'T_AP_MYS_INDUSTRY_SUMMARY', start_time, '失败', '合入数据', str(error_info))
-        
-        upload_csv_to_ftp(filename, self.name, get_project_settings().get('FTP_SETTINGS'))
+        yield MpobTableItem(
+            df=df,
+            table='T_AP_MYS_INDUSTRY_SUMMARY',
+            keys=['DATADATE', 'CATEGORY', 'PRODUCT'],
+            filename=filename,
+            start_time=start_time,
+        )
 
     @staticmethod
     def rename_columns(df_hor, year):
-        months = ['NULL', 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
         columns = ['MIXTURE']
         for c in df_hor.columns[1:]:
-            month = c.strip()[0:3]
             year_re = re.search(r'(\d{2,4})', c)
             if year_re:
                 year_number = year_re.group(1)
-                date = '20%s-%s' % (year_number, months.index(month))
+                date = '20%s-%s' % (year_number, month_number(c))
             else:
-                date = '%s-%s' % (year, months.index(month))
+                date = '%s-%s' % (year, month_number(c))
             columns.append(date)
         print(columns)
         df_hor.columns = columns
         return df_hor
-
-    @staticmethod
-    def transform(df_hor):
-        category = None
-        unit = None
-        datas = []
-        for r in df_hor.itertuples():
-            product = None
-            if str(r[1]) == str(r[2]) or pd.isnull(r[2]):
-                # PRODUCTION (TONNES)/CLOSING STOCK (TONNES)/EXPORT (TONNES)/IMPORT (TONNES)/PRICE (1% OER EQUIVALENT)
-                first_col_value = str(r[1]).strip()
-                category = first_col_value[0:first_col_value.index('(')].strip()
-                unit = first_col_value[first_col_value.index('(')+1:first_col_value.index(')')].strip()
-            else:
-                for i, c in enumerate(df_hor.columns):
-                    if c == 'MIXTURE':
-                        product = r[i+1]
-                    else:
-                        datas.append({
-                            'CATEGORY': category,
-                            'PRODUCT': product,
-                            'DATADATE': c,
-                            'VALUE': r[i+1],
-                            'UNIT': unit
-                        })
-        return pd.DataFrame(datas)
@@ -0,0 +1,145 @@
+# coding=utf8
+'''
+在同一个reactor中运行多个MPOB爬虫, 共用登录会话、数据库连接池和FTP服务
+用法: python run_mpob.py [mpob_export mpob_production mpob_stock mpob_summary]
+不指定爬虫时运行全部, 任一爬虫失败时返回非0退出码
+--record录制全部响应, --replay离线回放录制的响应, 加--no-store只解析不入库, 用于评测各阶段耗时
+--profile选择settings.CRAWL_PROFILES中的并发与限速配置
+--backfill [年份]回填历史上的全部年份(或指定年份, 如2010-2015), 中断后再次运行从断点继续
+'''
+import sys
+import os
+import time
+import argparse
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from scrapy.crawler import CrawlerProcess
+from scrapy.utils.project import get_project_settings
+from helper.backfill_helper import parse_years
+
+SPIDERS = ['mpob_export', 'mpob_production', 'mpob_stock', 'mpob_summary']
+# mpob/time/<stage> stats, reshape is the part of parse outside read_tables
+STAGES = ['fetch', 'read_tables', 'reshape', 'csv', 'merge', 'upload']
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run MPOB spiders in one process')
+    parser.add_argument('spiders', nargs='*', metavar='spider',
+                        help='spiders to run, one of %s, all when omitted' % ', '.join(SPIDERS))
+    parser.add_argument('--full', action='store_true',
+                        help='fetch, merge and upload every table, even if its page did not change')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--record', action='store_true',
+                      help='store every response in the replay corpus')
+    mode.add_argument('--replay', action='store_true',
+                      help='crawl offline from the replay corpus')
+    parser.add_argument('--replay-dir',
+                        help='replay corpus, default MPOB_REPLAY_DIR')
+    parser.add_argument('--no-store', action='store_true',
+                        help='only parse the tables, no Oracle merge and ftp upload')
+    parser.add_argument('--backfill', nargs='?', const='all', metavar='YEARS',
+                        help='crawl every year of the archive (or YEARS, e.g. 2010-2015), each table merged once')
+    parser.add_argument('--profile', choices=sorted(get_project_settings().getdict('CRAWL_PROFILES')),
+                        help='concurrency and throttling profile, default MPOB_CRAWL_PROFILE')
+    args = parser.parse_args(argv)
+    if args.backfill:
+        try:
+            parse_years(args.backfill)
+        except ValueError as e:
+            parser.error(str(e))
+    unknown = [name for name in args.spiders if name not in SPIDERS]
+    if unknown:
+        parser.error('unknown spider: %s' % ', '.join(unknown))
+    return args
+
+
+def run(spider_names, settings=None, spider_kwargs=None):
+    '''
+    并发运行爬虫, 阻塞到全部结束
+    :param spider_names: 爬虫名列表
+    :param settings: scrapy settings, 默认为项目settings
+    :param spider_kwargs: 爬虫参数, 如{'backfill': 'all'}
+    :return: [(name, crawler, error)]
+    '''
+    process = CrawlerProcess(settings or get_project_settings())
+    results = []
+    for name in spider_names:
+        crawler = process.create_crawler(name)
+        result = [name, crawler, None]
+        d = process.crawl(crawler, **(spider_kwargs or {}))
+        d.addErrback(_crawl_failed, result)
+        results.append(result)
+    process.start()
+    return results
+
+
+def _crawl_failed(failure, result):
+    result[2] = failure.getErrorMessage()
+
+
+def _elapsed(stats):
+    start, finish = stats.get('start_time'), stats.get('finish_time')
+    if start and finish:
+        return (finish - start).total_seconds()
+    return 0.0
+
+
+def report(results, elapsed):
+    '''
+    打印各爬虫的耗时和行数
+    :return: 失败的爬虫数
+    '''
+    failed = 0
+    print('%-16s %-10s %6s %9s %10s %10s %8s %9s' % ('spider', 'status', 'items', 'unchanged', 'rows', 'merged', 'errors', 'elapsed'))
+    total_rows = total_merged = 0
+    for name, crawler, error in results:
+        stats = crawler.stats.get_stats() if crawler.stats else {}
+        reason = error or stats.get('finish_reason', 'not started')
+        errors = stats.get('log_count/ERROR', 0) + stats.get('mpob/merge_failed', 0)
+        rows = stats.get('mpob/rows_parsed', 0)
+        merged = stats.get('mpob/rows_merged', 0)
+        total_rows += rows
+        total_merged += merged
+        if error or reason != 'finished' or errors:
+            failed += 1
+        print('%-16s %-10s %6s %9s %10s %10s %8s %8.1fs' % (name, reason, stats.get('item_scraped_count', 0), stats.get('mpob/tables_unchanged', 0),
+                                                           rows, merged, errors, _elapsed(stats)))
+    print('%-16s %-10s %6s %9s %10s %10s %8s %8.1fs' % ('total', '%s failed' % failed, '', '', total_rows, total_merged, '', elapsed))
+    return failed
+
+
+def report_stages(results):
+    '''
+    打印各爬虫每个阶段的累计耗时(秒), fetch为各请求耗时之和, 请求并发时大于实际时间
+    '''
+    print('%-16s' % 'stage' + ''.join('%12s' % stage for stage in STAGES))
+    for name, crawler, error in results:
+        stats = crawler.stats.get_stats() if crawler.stats else {}
+        times = dict((stage, stats.get('mpob/time/%s' % stage, 0.0)) for stage in STAGES)
+        times['reshape'] = max(stats.get('mpob/time/parse', 0.0) - times['read_tables'], 0.0)
+        print('%-16s' % name + ''.join('%12.3f' % times[stage] for stage in STAGES))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    spider_names = args.spiders or SPIDERS
+    settings = get_project_settings()
+    if args.full:
+        settings.set('MPOB_CONDITIONAL_FETCH', False)
+    if args.record or args.replay:
+        settings.set('MPOB_REPLAY_MODE', 'record' if args.record else 'replay')
+    if args.replay_dir:
+        settings.set('MPOB_REPLAY_DIR', args.replay_dir)
+    if args.no_store:
+        settings.set('MPOB_STORE', False)
+    if args.profile:
+        settings.set('MPOB_CRAWL_PROFILE', args.profile)
+    start = time.time()
+    results = run(spider_names, settings, {'backfill': args.backfill} if args.backfill else None)
+    failed = report(results, time.time() - start)
+    report_stages(results)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,7 @@
-from scrapy import cmdline
 import sys
 import os
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-cmdline.execute(['scrapy', 'crawl', 'mpob_summary'])
+from run_mpob import main
+
+sys.exit(main(['mpob_summary']))
@@ -0,0 +1,33 @@
+# coding=utf8
+'''
+dataframe转为绑定变量的耗时: dataframe_to_binds对比原来to_dict后逐个单元格pd.isnull的实现
+python scripts/bench_binds.py [行数 ...]
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helper.database_helper import dataframe_to_binds
+from helper.fixture_helper import long_table, loop_binds
+
+
+def timeit(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def main(sizes):
+    print('%10s %10s %10s %8s %6s' % ('rows', 'loop(s)', 'numpy(s)', 'speedup', 'same'))
+    for rows in sizes:
+        df = long_table(rows)
+        cols = list(df.columns)
+        loop, expected = timeit(lambda: loop_binds(df, cols))
+        vectorized, result = timeit(lambda: dataframe_to_binds(df, cols))
+        print('%10d %10.2f %10.2f %7.0fx %6s' % (rows, loop, vectorized, loop / vectorized, result == expected))
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [1000000])
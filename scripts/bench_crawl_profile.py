@@ -0,0 +1,84 @@
+# coding=utf8
+'''
+mpob_production对本地模拟站点(mpob_stub_site)在各CRAWL_PROFILES下的耗时, 重试和放弃的表格
+python scripts/bench_crawl_profile.py [--outage 秒] [配置 ...]
+配置default为scrapy默认设置: 不用配置, RetryMiddleware立即重试
+每个配置在单独的进程中运行(reactor不能重启), 不写数据库也不上传(MPOB_STORE = False)
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+
+
+def crawl(profile, outage):
+    '''
+    在当前进程中运行一次, 结果以json打印到最后一行
+    '''
+    import run_mpob
+    from scrapy.utils.project import get_project_settings
+    from malaysia_ap.spiders.mpob_production import PalmOilProductionSpider
+    from mpob_stub_site import MpobStubSite
+    site = MpobStubSite(outage=(1, 1 + outage) if outage else None)
+    base = site.serve()
+    PalmOilProductionSpider.DATA_SOURCE = base + '/production'
+    PalmOilProductionSpider.login_url = base + '/login'
+    settings = get_project_settings()
+    settings.set('LOG_LEVEL', 'ERROR')
+    settings.set('TELNETCONSOLE_ENABLED', False)
+    settings.set('MPOB_USERNAME', 'mpob')
+    settings.set('MPOB_PASSWORD', 'secret')
+    settings.set('MPOB_STORE', False)
+    settings.set('MPOB_CONDITIONAL_FETCH', False)
+    settings.set('TEMP_DATA_DIR', tempfile.mkdtemp())
+    if profile == 'default':
+        settings.set('MPOB_CRAWL_PROFILE', None)
+        middlewares = dict(settings.getdict('DOWNLOADER_MIDDLEWARES'))
+        middlewares.pop('scrapy.downloadermiddlewares.retry.RetryMiddleware')
+        middlewares.pop('malaysia_ap.middlewares.BackoffRetryMiddleware')
+        settings.set('DOWNLOADER_MIDDLEWARES', middlewares)
+    else:
+        settings.set('MPOB_CRAWL_PROFILE', profile)
+    start = time.time()
+    results = run_mpob.run(['mpob_production'], settings)
+    wall = time.time() - start
+    stats = results[0][1].stats.get_stats()
+    print(json.dumps({
+        'wall': wall,
+        'pages': stats.get('response_received_count', 0),
+        'tables': stats.get('item_scraped_count', 0),
+        'all_tables': site.tables,
+        'retries': stats.get('retry/count', 0),
+        'gave_up': stats.get('retry/max_reached', 0),
+        '503': site.stats['503'],
+        'max_inflight': site.stats['max_inflight'],
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('profiles', nargs='*', default=['default', 'fast', 'balanced', 'polite'])
+    parser.add_argument('--outage', type=float, default=0, help='seconds of 503 responses, 1s after the first request')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        return crawl(args.run, args.outage)
+    print('%-9s %7s %8s %8s %8s %8s %6s %9s' % ('profile', 'wall', 'pages/s', 'tables', 'retries', 'gave up', '503s', 'inflight'))
+    for profile in args.profiles:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--run', profile, '--outage', str(args.outage)],
+                                cwd=ROOT, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        r = json.loads(output.strip().splitlines()[-1])
+        print('%-9s %6.1fs %8.2f %5d/%-3d %8d %8d %6d %9d' % (
+            profile, r['wall'], r['pages'] / r['wall'], r['tables'], r['all_tables'], r['retries'], r['gave_up'],
+            r['503'], r['max_inflight']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# coding=utf8
+'''
+FtpService目录传输的耗时和命令数, 对一个模拟广域网的本地pyftpdlib服务器:
+每条命令延迟RTT秒, 每个数据连接限速BANDWIDTH字节/秒
+python scripts/bench_ftp_transfer.py [连接数 ...]
+需要pyftpdlib
+'''
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import collections
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler, DTPHandler
+from pyftpdlib.servers import ThreadedFTPServer
+from helper.ftp_helper import FtpService
+from helper.fixture_helper import make_tree, same_tree
+
+RTT = 0.01
+BANDWIDTH = 4 * 1024 * 1024
+
+
+class SlowDTPHandler(DTPHandler):
+
+    def handle_read(self):
+        received = self.receivedbytes
+        DTPHandler.handle_read(self)
+        time.sleep((self.receivedbytes - received) / BANDWIDTH)
+
+    def send(self, data):
+        sent = DTPHandler.send(self, data)
+        time.sleep(sent / BANDWIDTH)
+        return sent
+
+
+class SlowFTPHandler(FTPHandler):
+    dtp_handler = SlowDTPHandler
+    use_sendfile = False
+    commands = collections.Counter()
+
+    def pre_process_command(self, line, cmd, arg):
+        self.commands[cmd] += 1
+        time.sleep(RTT)
+        return FTPHandler.pre_process_command(self, line, cmd, arg)
+
+
+def serve(root):
+    authorizer = DummyAuthorizer()
+    authorizer.add_user('mpob', 'secret', root, perm='elradfmwMT')
+    SlowFTPHandler.authorizer = authorizer
+    server = ThreadedFTPServer(('127.0.0.1', 0), SlowFTPHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def timed(label, func):
+    SlowFTPHandler.commands.clear()
+    start = time.perf_counter()
+    stats = func()
+    elapsed = time.perf_counter() - start
+    print('%-18s %7.2fs %6d cmds %4d files %9d bytes' % (label, elapsed, sum(SlowFTPHandler.commands.values()), stats['files'], stats['bytes']))
+
+
+def main(connections):
+    logging.basicConfig(level=logging.WARNING)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        root, src = os.path.join(tmpdir, 'ftproot'), os.path.join(tmpdir, 'src')
+        os.makedirs(root)
+        make_tree(src, years=range(2016, 2024), tables=('export', 'production', 'stock'), files=3, size=300000)
+        server = serve(root)
+        for n in connections:
+            with FtpService('127.0.0.1', server.address[1], 'mpob', 'secret', connections=n, passive=True) as service:
+                timed('upload_tree x%d' % n, lambda: service.upload_tree(src, '/arch%d' % n))
+                local = os.path.join(tmpdir, 'download%d' % n)
+                timed('download_tree x%d' % n, lambda: service.download_tree('/arch%d' % n, local))
+            assert same_tree(src, local)
+        server.close_all()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [1, 4, 8])
@@ -0,0 +1,44 @@
+# coding=utf8
+'''
+读取页面表格的耗时: table_helper.read_tables对比pd.read_html(flavor='bs4'), 都包含页面的解析
+python scripts/bench_read_tables.py [行数 ...]
+'''
+import os
+import sys
+import time
+from io import StringIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pandas as pd
+from scrapy.http import HtmlResponse
+from helper.table_helper import read_tables
+from helper.fixture_helper import stock_page
+
+
+def timeit(func, repeat=5):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench(name, text):
+    body = text.encode('utf-8')
+    bs4 = timeit(lambda: pd.read_html(StringIO(text), header=0, flavor='bs4'))
+    # a fresh response each time, so the lxml parse is timed too
+    lxml = timeit(lambda: read_tables(HtmlResponse('http://mpob.gov.my/', body=body, encoding='utf-8')))
+    print('%-12s %8d %10.3f %10.4f %7.0fx' % (name, len(body) // 1024, bs4, lxml, bs4 / lxml))
+
+
+def main(sizes):
+    print('%-12s %8s %10s %10s %8s' % ('page', 'KB', 'bs4(s)', 'lxml(s)', 'speedup'))
+    for rows in sizes:
+        bench('stock %d' % rows, stock_page(rows))
+    with open(os.path.join(ROOT, 'index.html'), encoding='utf-8') as f:
+        bench('index.html', f.read())
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [50, 200])
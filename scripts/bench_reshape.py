@@ -0,0 +1,41 @@
+# coding=utf8
+'''
+宽表转长表的耗时: reshape_helper对比原来逐行逐列遍历的实现
+python scripts/bench_reshape.py [行数 ...]
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helper.reshape_helper import month_labels, wide_to_long, sectioned_wide_to_long
+from helper.fixture_helper import export_table, summary_table, loop_export_transform, loop_summary_transform
+
+
+def timeit(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(sizes):
+    print('%-8s %8s %10s %10s %8s' % ('table', 'rows', 'loop(s)', 'numpy(s)', 'speedup'))
+    for rows in sizes:
+        df = export_table(rows)
+        dates = month_labels(df.columns[1:], 2022)
+        loop = timeit(lambda: loop_export_transform(df, 'COUNTRY', 2022))
+        vectorized = timeit(lambda: wide_to_long(df, 'COUNTRY', dates).dropna(subset=['VALUE']))
+        print('%-8s %8d %10.3f %10.4f %7.0fx' % ('export', rows, loop, vectorized, loop / vectorized))
+        df = summary_table(10, rows // 10)
+        loop = timeit(lambda: loop_summary_transform(df))
+        vectorized = timeit(lambda: sectioned_wide_to_long(df, 'MIXTURE'))
+        print('%-8s %8d %10.3f %10.4f %7.0fx' % ('summary', rows, loop, vectorized, loop / vectorized))
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [2000, 20000])
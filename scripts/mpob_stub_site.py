@@ -0,0 +1,125 @@
+# coding=utf8
+'''
+本地模拟的bepi.mpob.gov.my, 供基准脚本使用: 登录页, 产量文章列表, 文章的iframe和表格页
+文章和表格页有延迟, 同时处理的请求超过2个时每多一个慢25%, 可以在一段时间内全部返回503
+'''
+import time
+import random
+import threading
+import http.server
+
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+LOGIN_PAGE = '''<html><head><script type="application/json">{"csrf.token":"tok123"}</script></head><body>
+<form class="com-users-login__form" action="/login?task=user.login" method="post">
+<input name="username"><input name="password"></form></body></html>'''
+
+
+def listing(articles):
+    items = ''.join('<li><a href="/art/%s">%s</a></li>' % (key, title) for key, title in articles)
+    return '<html><body><ul class="mod-articlescategory category-module mod-list"><li><ul>%s</ul></li></ul></body></html>' % items
+
+
+def half_table(header, months, names, year, rng):
+    head = '<tr>%s</tr>' % ''.join('<th>%s</th>' % c for c in [header] + months + ['Total', 'Note'])
+    rows = '<tr><td>%s</td>%s<td></td><td></td></tr>' % (header, '<td>%s</td>' % year * len(months))
+    for name in names:
+        rows += '<tr><td>%s</td>%s<td>1</td><td></td></tr>' % (
+            name, ''.join('<td>{:,.2f}</td>'.format(rng.random() * 1e5) for _ in months))
+    return '<table>%s%s</table>' % (head, rows)
+
+
+def table_page(header, rows, year, rng):
+    names = ['%s %d' % (header.upper(), i) for i in range(rows)]
+    return '<html><body>%s%s</body></html>' % (half_table(header, MONTHS[:6], names, year, rng),
+                                               half_table(header, MONTHS[6:], names, year, rng))
+
+
+class MpobStubSite(object):
+    # /production lists two articles per year (Crude Palm Oil by state and
+    # Selected Processed Palm Oil by product), /art/<key> is the article with
+    # the iframe of /art/tables/<key>. Pages other than the login and
+    # robots.txt need the session cookie of the login.
+
+    def __init__(self, years=range(2003, 2023), article_latency=0.5, table_latency=0.3, outage=None):
+        '''
+        :param outage: (开始, 结束)秒, 从第一个请求算起, 期间文章和表格页返回503
+        '''
+        rng = random.Random(3)
+        articles = []
+        self.pages = {}
+        for year in years:
+            articles += [('c%d' % year, 'Production of Crude Palm Oil %d' % year),
+                         ('r%d' % year, 'Production of Selected Processed Palm Oil %d' % year)]
+            self.pages['/art/tables/c%d' % year] = table_page('States', 14, year, rng)
+            self.pages['/art/tables/r%d' % year] = table_page('Products', 40, year, rng)
+        self.pages['/production'] = listing(articles)
+        self.tables = len(articles)
+        self.article_latency = article_latency
+        self.table_latency = table_latency
+        self.outage = outage
+        self.started = None
+        self.stats = {'requests': 0, '503': 0, 'inflight': 0, 'max_inflight': 0}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def serve(self, port=0):
+        site = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                site.handle(self)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                site.send(self, 303, '', [('Set-Cookie', 'sess=auth; path=/'), ('Location', '/')])
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:%s' % self.server.server_address[1]
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def send(self, handler, status, body='', headers=()):
+        handler.send_response(status)
+        for name, value in headers:
+            handler.send_header(name, value)
+        handler.send_header('Content-Type', 'text/html; charset=utf-8')
+        handler.end_headers()
+        handler.wfile.write(body.encode('utf-8'))
+
+    def handle(self, handler):
+        path = handler.path
+        with self.lock:
+            if self.started is None:
+                self.started = time.time()
+            self.stats['requests'] += 1
+            self.stats['inflight'] += 1
+            self.stats['max_inflight'] = max(self.stats['max_inflight'], self.stats['inflight'])
+            inflight = self.stats['inflight']
+        try:
+            if path.startswith('/login'):
+                return self.send(handler, 200, LOGIN_PAGE, [('Set-Cookie', 'sess=pre; path=/')])
+            if path == '/robots.txt':
+                return self.send(handler, 404)
+            if 'sess=auth' not in (handler.headers.get('Cookie') or ''):
+                return self.send(handler, 303, '', [('Location', '/login')])
+            if path.startswith('/art/'):
+                latency = self.table_latency if '/tables/' in path else self.article_latency
+                time.sleep(latency * (1 + 0.25 * max(0, inflight - 2)))
+                elapsed = time.time() - self.started
+                if self.outage and self.outage[0] <= elapsed < self.outage[1]:
+                    with self.lock:
+                        self.stats['503'] += 1
+                    return self.send(handler, 503, 'busy')
+                if '/tables/' not in path:
+                    return self.send(handler, 200, '<html><body><iframe src="../tables/%s"></iframe></body></html>' % path.split('/')[-1])
+            if path not in self.pages:
+                return self.send(handler, 404)
+            return self.send(handler, 200, self.pages[path])
+        finally:
+            with self.lock:
+                self.stats['inflight'] -= 1
@@ -0,0 +1,94 @@
+# coding=utf8
+'''
+ConditionalFetchMiddleware经完整的下载中间件链处理表格页面, 含gzip压缩的页面
+'''
+import gzip
+import shutil
+import tempfile
+import unittest
+import scrapy
+from scrapy import signals
+from scrapy.core.downloader.middleware import DownloaderMiddlewareManager
+from scrapy.responsetypes import responsetypes
+from scrapy.settings import Settings
+from scrapy.utils.test import get_crawler
+from helper.fetch_state_helper import FetchState
+
+TABLE_URL = 'https://bepi.mpob.gov.my/index.php/tables/p1'
+TABLE_PAGE = b'<html><body><table><tr><td>1</td></tr></table></body></html>'
+
+
+class TableSpider(scrapy.Spider):
+    name = 'conditional_test'
+
+
+class TableSite(object):
+    # serves the table page gzip-encoded with a new gzip timestamp each time,
+    # the compressed bytes change while the page does not
+
+    def __init__(self, etag=None):
+        self.etag = etag
+        self.requests = []
+
+    def download(self, request, spider):
+        self.requests.append(request)
+        headers = {'Content-Type': 'text/html; charset=utf-8', 'Content-Encoding': 'gzip'}
+        if self.etag:
+            headers['ETag'] = self.etag
+            if request.headers.get('If-None-Match', b'').decode('latin-1') == self.etag:
+                return scrapy.http.Response(url=request.url, status=304, headers={'ETag': self.etag}, request=request)
+        body = gzip.compress(TABLE_PAGE, mtime=len(self.requests))
+        cls = responsetypes.from_args(headers=headers, url=request.url, body=body)
+        return cls(url=request.url, status=200, headers=headers, body=body, request=request)
+
+
+class ConditionalFetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        settings = Settings()
+        settings.setmodule('malaysia_ap.settings', priority='project')
+        settings.set('TEMP_DATA_DIR', self.tmpdir)
+        # robots.txt is fetched through the engine, which is not running here
+        settings.set('ROBOTSTXT_OBEY', False)
+        self.crawler = get_crawler(TableSpider, settings.copy_to_dict())
+        self.spider = self.crawler._create_spider('conditional_test')
+        self.mwman = DownloaderMiddlewareManager.from_crawler(self.crawler)
+        self.crawler.signals.send_catch_log(signals.spider_opened, spider=self.spider)
+        self.state = FetchState.from_settings(self.crawler.settings)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def fetch(self, site):
+        '''
+        下载一次表格页面, 并像pipeline合入成功后那样保存抓取状态
+        :return: 响应
+        '''
+        results = []
+        request = scrapy.Request(TABLE_URL, meta={'mpob_conditional': True}, dont_filter=True)
+        self.mwman.download(lambda request, spider: site.download(request, spider), request, self.spider) \
+            .addBoth(results.append)
+        response = results[0]
+        self.state.update(TABLE_URL, response.meta['mpob_fetch_state'])
+        return response
+
+    def test_same_page_gzip(self):
+        site = TableSite()
+        first = self.fetch(site)
+        self.assertEqual(first.body, TABLE_PAGE)
+        self.assertNotIn('mpob_unchanged', first.meta)
+        second = self.fetch(site)
+        self.assertEqual(second.meta.get('mpob_unchanged'), 'same hash')
+
+    def test_not_modified(self):
+        site = TableSite(etag='"v1"')
+        self.fetch(site)
+        response = self.fetch(site)
+        self.assertEqual(site.requests[-1].headers.get('If-None-Match'), b'"v1"')
+        self.assertEqual(response.status, 304)
+        self.assertEqual(response.meta.get('mpob_unchanged'), 'not modified')
+
+
+if __name__ == '__main__':
+    unittest.main()
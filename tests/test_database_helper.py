@@ -0,0 +1,183 @@
+# coding=utf8
+'''
+database_helper中不依赖Oracle客户端的部分: 绑定变量的转换, 与库中已有行的比对, sqlite的upsert
+'''
+import os
+import datetime
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from helper.database_helper import MergeResult, dataframe_to_binds, diff_dataframe, compile_sqlite_sql, merge_db_sqlite, merge_db_sqlite_dataframe, \
+    close_sqlite_connections
+from helper.fixture_helper import long_table, loop_binds
+
+
+class DataframeToBindsTest(unittest.TestCase):
+
+    def test_same_as_loop(self):
+        df = long_table(2000)
+        cols = list(df.columns)
+        self.assertEqual(dataframe_to_binds(df, cols), loop_binds(df, cols))
+
+    def test_column_order(self):
+        df = long_table(50)
+        cols = ['VALUE', 'UNIT', 'DATADATE', 'PRODUCT']
+        rows = dataframe_to_binds(df, cols)
+        self.assertEqual(rows, loop_binds(df, cols))
+        self.assertEqual(rows[0], (df['VALUE'][0], 'TONNES', df['DATADATE'][0], df['PRODUCT'][0]))
+
+    def test_missing(self):
+        df = pd.DataFrame({
+            'DATADATE': pd.to_datetime(['2022-01-01', None]),
+            'VALUE': [np.nan, 1.0],
+            'PRODUCT': [None, 'CPO'],
+            'COUNT': pd.array([None, 1], dtype='Int64'),
+        })
+        rows = dataframe_to_binds(df, list(df.columns))
+        self.assertEqual(rows, [(datetime.datetime(2022, 1, 1), None, None, None), (None, 1.0, 'CPO', 1)])
+
+    def test_python_types(self):
+        # numpy scalars and Timestamps are converted, the drivers bind plain python values
+        df = long_table(200)
+        types = {type(value) for row in dataframe_to_binds(df, list(df.columns)) for value in row}
+        self.assertEqual(types, {datetime.datetime, str, float, int, bool, type(None)})
+
+    def test_empty(self):
+        df = long_table(0)
+        self.assertEqual(dataframe_to_binds(df, list(df.columns)), [])
+
+
+class DiffDataframeTest(unittest.TestCase):
+    keys = ('DATADATE', 'PRODUCT')
+    cols = ('DATADATE', 'PRODUCT', 'VALUE', 'NOTE')
+
+    def frame(self, rows):
+        df = pd.DataFrame(rows, columns=list(self.cols))
+        return df.assign(DATADATE=pd.to_datetime(df['DATADATE']))
+
+    def diff(self, df, existing):
+        rows, result = diff_dataframe(df, existing, self.keys, self.cols)
+        return rows['DATADATE'].dt.strftime('%Y-%m-%d').tolist(), result
+
+    def test_nan(self):
+        df = self.frame([
+            ('2022-01-01', 'CPO', np.nan, None),
+            ('2022-02-01', 'CPO', np.nan, 'a'),
+            ('2022-03-01', 'CPO', 3.0, None),
+            ('2022-04-01', 'CPO', 4.0, 'd'),
+        ])
+        existing = self.frame([
+            ('2022-01-01', 'CPO', np.nan, None),  # NaN equals NaN, unchanged
+            ('2022-02-01', 'CPO', 2.0, 'a'),      # value removed
+            ('2022-03-01', 'CPO', np.nan, None),  # value added
+            ('2022-04-01', 'CPO', 4.0, None),     # text added
+        ])
+        self.assertEqual(self.diff(df, existing), (['2022-02-01', '2022-03-01', '2022-04-01'], MergeResult(0, 3, 1)))
+
+    def test_dtypes(self):
+        # as read from the database: datetimes of another unit or text, numbers as float or object
+        df = self.frame([('2022-01-01', 'CPO', 1.0, 'a'), ('2022-02-01', 'CPO', 2.0, 'b')]).astype({'VALUE': 'int64'})
+        for existing in (
+            self.frame([('2022-01-01', 'CPO', 1.0, 'a'), ('2022-02-01', 'CPO', 2.5, 'b')]),
+            self.frame([('2022-01-01', 'CPO', 1.0, 'a'), ('2022-02-01', 'CPO', 2.5, 'b')]).astype({'DATADATE': 'datetime64[ns]', 'VALUE': object}),
+            pd.DataFrame([('2022-01-01', 'CPO', 1, 'a'), ('2022-02-01', 'CPO', 2.5, 'b')], columns=list(self.cols)),
+        ):
+            rows, result = diff_dataframe(df, existing, self.keys, self.cols)
+            self.assertEqual(result, MergeResult(0, 1, 1))
+            # the rows to write keep the dtypes of df
+            self.assertEqual(rows.dtypes.tolist(), df.dtypes.tolist())
+            self.assertEqual(rows['VALUE'].tolist(), [2])
+
+    def test_one_side(self):
+        df = self.frame([('2022-01-01', 'CPO', 1.0, 'a'), ('2022-02-01', 'CPO', 2.0, 'b'), ('2022-02-01', 'PK', 3.0, 'c')])
+        existing = self.frame([
+            ('2021-12-01', 'CPO', 0.0, 'z'),  # only in the table, left alone
+            ('2022-01-01', 'CPO', 1.0, 'a'),
+            ('2022-01-01', 'PK', 5.0, 'y'),   # only in the table, same date as a new row
+        ])
+        self.assertEqual(self.diff(df, existing), (['2022-02-01', '2022-02-01'], MergeResult(2, 0, 1)))
+        self.assertEqual(self.diff(df, existing.iloc[:0]), (['2022-01-01', '2022-02-01', '2022-02-01'], MergeResult(3, 0, 0)))
+        self.assertEqual(self.diff(df.iloc[:0], existing), ([], MergeResult(0, 0, 0)))
+
+    def test_duplicate_existing(self):
+        # the last of the duplicated keys in the table is compared
+        df = self.frame([('2022-01-01', 'CPO', 1.0, 'a')])
+        existing = self.frame([('2022-01-01', 'CPO', 9.0, 'a'), ('2022-01-01', 'CPO', 1.0, 'a')])
+        self.assertEqual(self.diff(df, existing), ([], MergeResult(0, 0, 1)))
+
+
+class SqliteMergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.db = os.path.join(self.tmpdir, 'mpob.db')
+
+    def tearDown(self):
+        close_sqlite_connections()
+        shutil.rmtree(self.tmpdir)
+
+    def frame(self, rows):
+        df = pd.DataFrame(rows, columns=['DATADATE', 'PRODUCT', 'VALUE', 'COUNT'])
+        return df.assign(DATADATE=pd.to_datetime(df['DATADATE'])).set_index(['DATADATE', 'PRODUCT'])
+
+    def query(self, sql, *args):
+        with sqlite3.connect(self.db) as connection:
+            return connection.execute(sql, args).fetchall()
+
+    def test_compile(self):
+        self.assertEqual(compile_sqlite_sql('T', ('A',), ('A', 'B'), 'create', ('TEXT', 'REAL')),
+                         'CREATE TABLE IF NOT EXISTS "T" ("A" TEXT, "B" REAL, PRIMARY KEY ("A"))')
+        self.assertEqual(compile_sqlite_sql('T', ('A',), ('A', 'B')),
+                         'INSERT INTO "T" ("A", "B") VALUES (?, ?) ON CONFLICT ("A") DO UPDATE SET "B" = excluded."B"')
+        self.assertEqual(compile_sqlite_sql('T', ('A',), ('A',)), 'INSERT INTO "T" ("A") VALUES (?) ON CONFLICT ("A") DO NOTHING')
+        self.assertEqual(compile_sqlite_sql('T', (), ('A', 'B'), 'insert'), 'INSERT INTO "T" ("A", "B") VALUES (?, ?)')
+        self.assertRaises(ValueError, compile_sqlite_sql, 'T', ('A',), ('A', 'B'), 'merge')
+
+    def test_create(self):
+        self.assertEqual(merge_db_sqlite_dataframe(self.frame([('2022-01-01', 'CPO', 1.5, 3)]), 'T_X', self.db), 1)
+        columns = self.query('PRAGMA table_info("T_X")')
+        self.assertEqual([(c[1], c[2], c[5]) for c in columns],
+                         [('VALUE', 'REAL', 0), ('COUNT', 'INTEGER', 0), ('DATADATE', 'TEXT', 1), ('PRODUCT', 'TEXT', 2)])
+        self.assertEqual(self.query('PRAGMA journal_mode'), [('wal',)])
+        # datetimes are ISO-8601 text
+        self.assertEqual(self.query('SELECT DATADATE, typeof(DATADATE) FROM T_X'), [('2022-01-01 00:00:00', 'text')])
+
+    def test_upsert(self):
+        merge_db_sqlite_dataframe(self.frame([('2022-01-01', 'CPO', 1.0, 1), ('2022-02-01', 'CPO', 2.0, 2)]), 'T_X', self.db)
+        rowid = self.query("SELECT rowid FROM T_X WHERE DATADATE = '2022-02-01 00:00:00'")
+        merge_db_sqlite_dataframe(self.frame([('2022-02-01', 'CPO', 3.0, 3), ('2022-03-01', 'CPO', None, 4)]), 'T_X', self.db)
+        self.assertEqual(self.query('SELECT DATADATE, VALUE, COUNT FROM T_X ORDER BY DATADATE'), [
+            ('2022-01-01 00:00:00', 1.0, 1),
+            ('2022-02-01 00:00:00', 3.0, 3),
+            ('2022-03-01 00:00:00', None, 4),
+        ])
+        # updated in place
+        self.assertEqual(self.query("SELECT rowid FROM T_X WHERE DATADATE = '2022-02-01 00:00:00'"), rowid)
+
+    def test_primary_key_of_table(self):
+        # without meta the conflict target is read from the table
+        merge_db_sqlite_dataframe(self.frame([('2022-01-01', 'CPO', 1.0, 1)]), 'T_X', self.db)
+        close_sqlite_connections()
+        merge_db_sqlite([{'DATADATE': '2022-01-01 00:00:00', 'PRODUCT': 'CPO', 'VALUE': 2.0}], 'T_X', self.db)
+        self.assertEqual(self.query('SELECT VALUE, COUNT FROM T_X'), [(2.0, 1)])
+
+    def test_rollback(self):
+        meta = {'ID': 'key', 'VALUE': None}
+        merge_db_sqlite([(1, 1.0)], 'T_X', self.db, meta, {'ID': 'INTEGER', 'VALUE': 'REAL'})
+        # the second batch fails on a value sqlite cannot bind, the first is rolled back with it
+        datas = [(1, 10.0), (2, 2.0), (3, object())]
+        self.assertRaises(sqlite3.Error, merge_db_sqlite, datas, 'T_X', self.db, meta, batch_size=2)
+        self.assertEqual(self.query('SELECT ID, VALUE FROM T_X'), [(1, 1.0)])
+        # the connection is usable afterwards
+        self.assertEqual(merge_db_sqlite([(2, 2.0)], 'T_X', self.db, meta), 1)
+        self.assertEqual(self.query('SELECT ID, VALUE FROM T_X ORDER BY ID'), [(1, 1.0), (2, 2.0)])
+
+    def test_missing_table(self):
+        self.assertRaises(ValueError, merge_db_sqlite, [{'ID': 1}], 'T_NONE', self.db)
+
+
+if __name__ == '__main__':
+    unittest.main()
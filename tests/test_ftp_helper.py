@@ -0,0 +1,100 @@
+# coding=utf8
+'''
+FtpService对本地pyftpdlib服务器的目录传输, 续传和增量同步
+'''
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from helper.ftp_helper import FtpService
+from helper.fixture_helper import make_tree, same_tree
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+    ThreadedFTPServer = None
+
+
+@unittest.skipIf(ThreadedFTPServer is None, 'needs pyftpdlib')
+class FtpTransferTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.ftproot = tempfile.mkdtemp()
+        authorizer = DummyAuthorizer()
+        authorizer.add_user('mpob', 'secret', cls.ftproot, perm='elradfmwMT')
+        handler = type('Handler', (FTPHandler,), {'authorizer': authorizer})
+        cls.server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+        cls.port = cls.server.address[1]
+        threading.Thread(target=cls.server.serve_forever, kwargs={'timeout': 0.1}, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close_all()
+        shutil.rmtree(cls.ftproot)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'src')
+        make_tree(self.src)
+        self.remote = '/%s' % self._testMethodName
+        self.service = FtpService('127.0.0.1', self.port, 'mpob', 'secret', connections=4, passive=True, timeout=10)
+
+    def tearDown(self):
+        self.service.close()
+        shutil.rmtree(self.tmpdir)
+        shutil.rmtree(self.ftproot + self.remote, ignore_errors=True)
+
+    def test_tree_roundtrip(self):
+        stats = self.service.upload_tree(self.src, self.remote)
+        self.assertEqual((stats['files'], stats['failed']), (12, []))
+        self.assertTrue(same_tree(self.src, self.ftproot + self.remote))
+        local = os.path.join(self.tmpdir, 'download')
+        stats = self.service.download_tree(self.remote, local)
+        self.assertEqual((stats['files'], stats['failed']), (12, []))
+        self.assertTrue(same_tree(self.src, local))
+
+    def test_active_mode(self):
+        service = FtpService('127.0.0.1', self.port, 'mpob', 'secret', connections=2, passive=False, timeout=10)
+        with service:
+            self.assertEqual(service.upload_tree(self.src, self.remote)['files'], 12)
+        self.assertTrue(same_tree(self.src, self.ftproot + self.remote))
+
+    def test_resume_upload(self):
+        self.service.upload_tree(self.src, self.remote)
+        with open(self.ftproot + self.remote + '/2020/stock/T1.zip', 'r+b') as f:
+            f.truncate(10000)
+        os.remove(self.ftproot + self.remote + '/2021/export/T0.zip')
+        stats = self.service.upload_tree(self.src, self.remote)
+        self.assertEqual((stats['files'], stats['resumed'], stats['skipped']), (2, 1, 10))
+        self.assertEqual(stats['bytes'], 40000 + 50000)
+        self.assertTrue(same_tree(self.src, self.ftproot + self.remote))
+
+    def test_resume_download(self):
+        self.service.upload_tree(self.src, self.remote)
+        local = os.path.join(self.tmpdir, 'download')
+        self.service.download_tree(self.remote, local)
+        with open(os.path.join(local, '2021', 'stock', 'T2.zip'), 'r+b') as f:
+            f.truncate(12345)
+        stats = self.service.download_tree(self.remote, local)
+        self.assertEqual((stats['files'], stats['resumed'], stats['skipped']), (1, 1, 11))
+        self.assertTrue(same_tree(self.src, local))
+
+    def test_sync(self):
+        dry = self.service.sync(self.src, self.remote, dry_run=True)
+        self.assertEqual(dry['files'], 12)
+        self.assertFalse(os.path.exists(self.ftproot + self.remote))
+        self.assertEqual(self.service.sync(self.src, self.remote)['files'], 12)
+        self.assertEqual(self.service.sync(self.src, self.remote)['skipped'], 12)
+        with open(os.path.join(self.src, '2021', 'stock', 'T1.zip'), 'ab') as f:
+            f.write(b'x')
+        stats = self.service.sync(self.src, self.remote)
+        self.assertEqual((stats['files'], stats['skipped']), (1, 11))
+        self.assertTrue(same_tree(self.src, self.ftproot + self.remote))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+# coding=utf8
+'''
+MpobLoginMiddleware经完整的下载中间件链(含HttpCompressionMiddleware和RedirectMiddleware)登录
+下载由一个按url返回固定响应的假站点代替
+'''
+import gzip
+import shutil
+import tempfile
+import unittest
+import scrapy
+from scrapy import signals
+from scrapy.exceptions import IgnoreRequest
+from scrapy.core.downloader.middleware import DownloaderMiddlewareManager
+from scrapy.http import Response
+from scrapy.responsetypes import responsetypes
+from scrapy.settings import Settings
+from scrapy.utils.test import get_crawler
+from twisted.python.failure import Failure
+from malaysia_ap.middlewares import MpobLoginMiddleware
+
+LOGIN_URL = 'https://bepi.mpob.gov.my/index.php/component/users/login'
+DATA_URL = 'https://bepi.mpob.gov.my/index.php/data'
+LOGIN_PAGE = b'''<html><head><script type="application/json">{"csrf.token":"tok123"}</script></head><body>
+<form class="com-users-login__form" action="/index.php/component/users/login?task=user.login" method="post">
+<input name="username"><input name="password"></form></body></html>'''
+NO_TOKEN_PAGE = b'''<html><body><form class="com-users-login__form" action="/index.php/component/users/login?task=user.login"
+method="post"><input name="username"></form></body></html>'''
+
+
+class LoginSpider(scrapy.Spider):
+    name = 'login_test'
+    login_url = LOGIN_URL
+
+
+class FakeSite(object):
+    # bepi.mpob.gov.my: the data page redirects to the login page without the
+    # session cookie, a correct login redirects back to the home page
+
+    def __init__(self, login_page=LOGIN_PAGE, gzip_pages=False, accept_login=True):
+        self.login_page = login_page
+        self.gzip_pages = gzip_pages
+        self.accept_login = accept_login
+        self.hits = []
+
+    def download(self, request, spider):
+        self.hits.append((request.method, request.url))
+        cookie = request.headers.get('Cookie', b'').decode('latin-1')
+        if request.method == 'POST':
+            if self.accept_login and b'username=mpob' in request.body:
+                return self.response(request, 303, headers={'Location': '/index.php', 'Set-Cookie': 'sess=auth; path=/'})
+            return self.response(request, 303, headers={'Location': '/index.php/component/users/login'})
+        if request.url.startswith(LOGIN_URL):
+            return self.response(request, 200, self.login_page, {'Set-Cookie': 'sess=pre; path=/'})
+        if 'sess=auth' not in cookie:
+            return self.response(request, 303, headers={'Location': LOGIN_URL})
+        return self.response(request, 200, b'<html><body><table><tr><td>1</td></tr></table></body></html>')
+
+    def response(self, request, status, body=b'', headers=None):
+        headers = dict(headers or {})
+        if body:
+            headers['Content-Type'] = 'text/html; charset=utf-8'
+            if self.gzip_pages:
+                headers['Content-Encoding'] = 'gzip'
+                body = gzip.compress(body)
+        cls = responsetypes.from_args(headers=headers, url=request.url, body=body)
+        return cls(url=request.url, status=status, headers=headers, body=body, request=request)
+
+
+class LoginMiddlewareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        settings = Settings()
+        settings.setmodule('malaysia_ap.settings', priority='project')
+        settings.set('TEMP_DATA_DIR', self.tmpdir)
+        # robots.txt is fetched through the engine, which is not running here
+        settings.set('ROBOTSTXT_OBEY', False)
+        settings.set('MPOB_SESSION_FILE', '%s/mpob_session.json' % self.tmpdir)
+        settings.set('MPOB_USERNAME', 'mpob')
+        settings.set('MPOB_PASSWORD', 'secret')
+        self.crawler = get_crawler(LoginSpider, settings.copy_to_dict())
+        self.spider = self.crawler._create_spider('login_test')
+        self.mwman = DownloaderMiddlewareManager.from_crawler(self.crawler)
+        self.crawler.signals.send_catch_log(signals.spider_opened, spider=self.spider)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def login_middleware(self):
+        return [mw for mw in self.mwman.middlewares if isinstance(mw, MpobLoginMiddleware)][0]
+
+    def fetch(self, site, request):
+        '''
+        一个请求经中间件链下载一次
+        :return: Response, Request(中间件要求先发的请求)或Failure, 请求等待其他登录时为None
+        '''
+        results = []
+        self.mwman.download(lambda request, spider: site.download(request, spider), request, self.spider) \
+            .addBoth(results.append)
+        return results[0] if results else None
+
+    def crawl(self, site, request):
+        '''
+        像引擎一样下载中间件返回的请求, 直到得到响应或失败
+        '''
+        result = self.fetch(site, request)
+        while isinstance(result, scrapy.Request):
+            result = self.fetch(site, result)
+        return result
+
+    def assert_logged_in(self, site, result):
+        self.assertIsInstance(result, Response)
+        self.assertEqual(result.url, DATA_URL)
+        self.assertIn(b'<table>', result.body)
+        self.assertEqual(result.request.cookies.get('sess'), 'auth')
+        self.assertEqual([hit for hit in site.hits if hit[0] == 'POST'],
+                         [('POST', LOGIN_URL + '?task=user.login')])
+
+    def test_login(self):
+        site = FakeSite()
+        self.assert_logged_in(site, self.crawl(site, scrapy.Request(DATA_URL)))
+
+    def test_login_gzip(self):
+        # the login page is inspected after HttpCompressionMiddleware
+        site = FakeSite(gzip_pages=True)
+        self.assert_logged_in(site, self.crawl(site, scrapy.Request(DATA_URL)))
+
+    def test_cached_session(self):
+        site = FakeSite()
+        self.crawl(site, scrapy.Request(DATA_URL))
+        del site.hits[:]
+        result = self.crawl(site, scrapy.Request(DATA_URL + '?page=2'))
+        self.assertIsInstance(result, Response)
+        self.assertEqual(site.hits, [('GET', DATA_URL + '?page=2')])
+
+    def test_waiters_replayed_after_login(self):
+        site = FakeSite(gzip_pages=True)
+        login = self.fetch(site, scrapy.Request(DATA_URL))
+        waiter = []
+        self.mwman.download(lambda request, spider: site.download(request, spider),
+                            scrapy.Request(DATA_URL + '?page=2'), self.spider).addBoth(waiter.append)
+        self.assertEqual(waiter, [])
+        self.assert_logged_in(site, self.crawl(site, login))
+        self.assertIsInstance(waiter[0], Response)
+        self.assertEqual(waiter[0].status, 200)
+
+    def check_failed_login(self, site):
+        login = self.fetch(site, scrapy.Request(DATA_URL))
+        self.assertEqual(login.url, LOGIN_URL)
+        waiter = []
+        self.mwman.download(lambda request, spider: site.download(request, spider),
+                            scrapy.Request(DATA_URL + '?page=2'), self.spider).addBoth(waiter.append)
+        result = self.crawl(site, login)
+        self.assertIsInstance(result, Failure)
+        self.assertIsInstance(result.value, IgnoreRequest)
+        # the waiting request is dropped, not logged in again
+        self.assertIsInstance(waiter[0], Failure)
+        self.assertIsInstance(waiter[0].value, IgnoreRequest)
+        self.assertEqual(len([hit for hit in site.hits if hit[1] == LOGIN_URL]), 1)
+        self.assertFalse(self.login_middleware().session.logging_in)
+
+    def test_failed_login_drops_waiters(self):
+        self.check_failed_login(FakeSite(gzip_pages=True, accept_login=False))
+
+    def test_missing_token_drops_waiters(self):
+        self.check_failed_login(FakeSite(login_page=NO_TOKEN_PAGE))
+
+
+if __name__ == '__main__':
+    unittest.main()
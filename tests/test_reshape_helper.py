@@ -0,0 +1,60 @@
+# coding=utf8
+'''
+reshape_helper与各爬虫原来逐行逐列遍历的实现(fixture_helper.loop_*)结果相同, 包括列的dtype
+'''
+import unittest
+import pandas as pd
+from pandas.testing import assert_frame_equal
+from helper.reshape_helper import month_number, month_labels, trim_header, wide_to_long, sectioned_wide_to_long
+from helper.fixture_helper import EXPORT_MONTHS, export_table, monthly_table, summary_table, \
+    loop_export_transform, loop_trim_header, loop_transpose_date, loop_summary_transform
+
+
+class ReshapeHelperTest(unittest.TestCase):
+
+    def assert_same(self, expected, result):
+        assert_frame_equal(expected.reset_index(drop=True), result.reset_index(drop=True), check_dtype=True)
+
+    def test_month_number(self):
+        self.assertEqual([month_number(c) for c in EXPORT_MONTHS], list(range(1, 13)))
+        self.assertEqual([month_number(c[:3].title() + ' 22') for c in EXPORT_MONTHS], list(range(1, 13)))
+        self.assertRaises(ValueError, month_number, 'Total')
+
+    def test_export(self):
+        for kind in ('float', 'int', 'mixed'):
+            df = export_table(300, kind)
+            result = wide_to_long(df, 'COUNTRY', month_labels(df.columns[1:], 2022)).dropna(subset=['VALUE'])
+            self.assert_same(loop_export_transform(df, 'COUNTRY', 2022), result)
+
+    def test_trim_header(self):
+        df = monthly_table('States', 50)
+        self.assert_same(loop_trim_header(df, 'States'), trim_header(df, 'States'))
+
+    def test_monthly(self):
+        for header in ('States', 'Products'):
+            df = trim_header(monthly_table(header, 50), header)
+            cols = ['DATADATE', header, 'VALUE']
+            self.assert_same(loop_transpose_date(df, header)[cols], wide_to_long(df, header)[cols])
+
+    def test_monthly_outer_merge(self):
+        # the two half-year tables merged with how='outer', rows missing from one half have NaN months
+        first = trim_header(monthly_table('States', 10), 'States')
+        second = trim_header(monthly_table('States', 12, seed=1), 'States')
+        second.columns = ['States'] + ['2023-%d' % m for m in range(1, 13)]
+        df = pd.merge(first, second, on='States', how='outer')
+        cols = ['DATADATE', 'States', 'VALUE']
+        self.assert_same(loop_transpose_date(df, 'States')[cols], wide_to_long(df, 'States')[cols])
+
+    def test_summary(self):
+        df = summary_table(4, 30)
+        self.assert_same(loop_summary_transform(df), sectioned_wide_to_long(df, 'MIXTURE'))
+
+    def test_empty(self):
+        df = export_table(0)
+        result = wide_to_long(df, 'COUNTRY', month_labels(df.columns[1:], 2022))
+        self.assertEqual(list(result.columns), ['COUNTRY', 'DATADATE', 'VALUE'])
+        self.assertEqual(len(result), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+# coding=utf8
+'''
+ParquetBackend按年份分区写入, 与已有的行合并
+'''
+import shutil
+import tempfile
+import unittest
+import pandas as pd
+from scrapy.settings import Settings
+from helper.storage_helper import ParquetBackend
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+@unittest.skipIf(pyarrow is None, 'ParquetBackend needs pyarrow')
+class ParquetBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.backend = ParquetBackend.from_settings(Settings({'TEMP_DATA_DIR': self.tmpdir}))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def frame(self, rows):
+        return pd.DataFrame(rows, columns=['DATADATE', 'PRODUCT', 'VALUE']).assign(DATADATE=lambda df: pd.to_datetime(df['DATADATE']))
+
+    def read(self, table):
+        df = pd.read_parquet('%s/parquet/%s' % (self.tmpdir, table))
+        return df.sort_values(['DATADATE', 'PRODUCT', 'VALUE']).reset_index(drop=True)
+
+    def test_keys(self):
+        self.backend.store(self.frame([('2021-12-01', 'CPO', 1.0), ('2022-01-01', 'CPO', 2.0)]).set_index(['DATADATE', 'PRODUCT']), 'T_X')
+        self.backend.store(self.frame([('2022-01-01', 'CPO', 3.0), ('2022-02-01', 'CPO', 4.0)]).set_index(['DATADATE', 'PRODUCT']), 'T_X')
+        df = self.read('T_X')
+        self.assertEqual(df['VALUE'].tolist(), [1.0, 3.0, 4.0])
+        self.assertEqual(sorted(df['YEAR'].astype(str).unique()), ['2021', '2022'])
+
+    def test_no_keys(self):
+        # without keys only identical rows are dropped, a frame sent again adds nothing
+        df = self.frame([('2022-01-01', 'CPO', 1.0), ('2022-01-01', 'CPO', 2.0)])
+        self.backend.store(df, 'T_Y')
+        self.backend.store(df, 'T_Y')
+        stored = self.read('T_Y')
+        self.assertNotIn('index', stored.columns)
+        self.assertFalse(stored.duplicated().any())
+        self.assertEqual(stored['VALUE'].tolist(), [1.0, 2.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# coding=utf8
+'''
+table_helper.read_tables与pd.read_html(text, header=0, flavor='bs4')结果相同, 包括列的dtype
+'''
+import os
+import unittest
+from io import StringIO
+import pandas as pd
+from pandas.testing import assert_frame_equal
+from scrapy.http import HtmlResponse
+from helper.table_helper import read_tables
+from helper.fixture_helper import stock_page
+
+INDEX_HTML = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'index.html')
+
+
+class ReadTablesTest(unittest.TestCase):
+
+    def assert_same(self, text):
+        expected = pd.read_html(StringIO(text), header=0, flavor='bs4')
+        result = read_tables(HtmlResponse('http://mpob.gov.my/', body=text, encoding='utf-8'))
+        self.assertEqual(len(expected), len(result))
+        for e, r in zip(expected, result):
+            assert_frame_equal(e, r, check_dtype=True)
+        return result
+
+    def test_spans(self):
+        df = self.assert_same(
+            '<table><tr><th rowspan="2">States</th><th colspan="2">2022</th></tr>'
+            '<tr><th>Jan</th><th>Feb</th></tr>'
+            '<tr><td rowspan="3">Johor</td><td>1</td><td>2</td></tr>'
+            '<tr><td colspan="2">3</td></tr>'
+            '<tr><td>5</td></tr></table>')[0]
+        self.assertEqual(df['States'].tolist()[1:], ['Johor'] * 3)
+
+    def test_hidden(self):
+        df = self.assert_same(
+            '<table style="display:none"><tr><td>menu</td></tr></table>'
+            '<table><tr><th>States</th><th style="display: none">Old</th><th>Jan</th></tr>'
+            '<tr style="display:none"><td>Hidden</td><td>0</td></tr>'
+            '<tr><td>Perak<span style="display:none">x</span><!-- c --></td><td>1</td></tr>'
+            '<style>td {}</style></table>')[0]
+        self.assertEqual(list(df.columns), ['States', 'Jan'])
+        self.assertEqual(df['States'].tolist(), ['Perak'])
+
+    def test_thousands(self):
+        df = self.assert_same(
+            '<table><thead><tr><th>States</th><th>Jan</th><th>Feb</th></tr></thead>'
+            '<tbody><tr><td>Sabah</td><td>1,234.50</td><td>1,000</td></tr>'
+            '<tr><td>Sarawak</td><td>&nbsp;</td><td>12,345</td></tr></tbody></table>')[0]
+        self.assertEqual(df['Jan'].dtype, 'float64')
+        self.assertEqual(df['Feb'].tolist(), [1000, 12345])
+
+    def test_stock_page(self):
+        for seed in range(3):
+            self.assert_same(stock_page(30, seed))
+
+    def test_index_html(self):
+        with open(INDEX_HTML, encoding='utf-8') as f:
+            self.assert_same(f.read())
+
+    def test_no_tables(self):
+        self.assertRaises(ValueError, read_tables, HtmlResponse('http://mpob.gov.my/', body=b'<p>none</p>'))
+
+
+if __name__ == '__main__':
+    unittest.main()